@@ -0,0 +1,128 @@
+"""Measure DANA startup cost.
+
+Each scenario runs the DANA command line in a fresh interpreter with
+``-X importtime``, and records the wall time, the total import time and
+the heavy libraries imported. Results are written as JSON, so they can
+be tracked across commits.
+
+Usage:
+
+python3 benchmarks/import_time.py [--repeat N] [--out FILE] [--check]
+"""
+
+from typing import Dict, List
+
+import argparse
+import statistics
+import subprocess
+import time
+import json
+import sys
+import os
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DANA_DIR = os.path.join(ROOT, "src", "dana")
+DEFAULT_DATASET = os.path.join(ROOT, "datasets", "LEOSS_PublicDataSet_anonym.csv")
+HEAVY_MODULES = ["pandas", "scipy", "sklearn", "matplotlib", "seaborn", "xlsxwriter"]
+# heavy libraries each scenario must not import (checked with --check)
+FORBIDDEN = {
+    "import": HEAVY_MODULES,
+    "help": HEAVY_MODULES,
+    "validation": HEAVY_MODULES,
+    "introduce": ["scipy", "sklearn", "matplotlib", "seaborn", "xlsxwriter"],
+}
+
+
+def scenarios(dataset: str, separator: str) -> Dict[str, List[str]]:
+    return {
+        "import": ["-c", "import dana"],
+        "help": ["__main__.py", "--help"],
+        "validation": ["__main__.py", "-f", "unknown"],
+        "introduce": [
+            "__main__.py",
+            "-f",
+            "introduce",
+            "-d",
+            dataset,
+            "-s",
+            separator,
+            "--pid",
+            "1000000",
+        ],
+    }
+
+
+def parse_importtime(stderr: str) -> Dict:
+    """Total import time (top-level imports only, they include their
+    dependencies) and imported heavy libraries.
+    """
+    total, modules = 0, set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name[1:].startswith(" "):  # top-level import
+            total += int(cumulative)
+        modules.add(name.strip().split(".")[0])
+    return {
+        "import_ms": total / 1000,
+        "heavy_modules": sorted(modules & set(HEAVY_MODULES)),
+    }
+
+
+def run_scenario(args: List[str], repeat: int) -> Dict:
+    walls, result = [], {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime"] + args,
+            cwd=DANA_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        walls.append((time.perf_counter() - start) * 1000)
+        result = parse_importtime(proc.stderr)
+        result["returncode"] = proc.returncode
+    result["wall_ms_min"] = min(walls)
+    result["wall_ms_median"] = statistics.median(walls)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure DANA startup cost")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per scenario")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="introduce dataset")
+    parser.add_argument("--separator", default=";", help="Dataset separator")
+    parser.add_argument("--out", default=None, help="JSON report (default: stdout)")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with error if a scenario imports a forbidden heavy library",
+    )
+    args = parser.parse_args()
+    report = {
+        "python": sys.version.split()[0],
+        "repeat": args.repeat,
+        "scenarios": {},
+    }
+    failed = []
+    for name, cmd in scenarios(args.dataset, args.separator).items():
+        result = run_scenario(cmd, args.repeat)
+        report["scenarios"][name] = result
+        if set(result["heavy_modules"]) & set(FORBIDDEN[name]):
+            failed.append(name)
+    report_json = json.dumps(report, indent=2)
+    if args.out is None:
+        print(report_json)
+    else:
+        with open(args.out, mode="w") as outfile:
+            outfile.write(report_json + "\n")
+    if args.check and failed:
+        sys.stderr.write(f"Heavy libraries imported by: {', '.join(failed)}\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""DANA KNN imputation benchmark.
+
+Synthetic LEOSS-like datasets of increasing size are imputed with the
+exact and the approximate (--approximate) nearest neighbors search. The
+exact search compares each incomplete patient to every complete one, so
+its time grows with the square of the rows, while the approximate search
+compares each patient to a bounded number of candidates. The report
+gives the time of both searches and the share of imputed values they
+agree on, showing the size where the approximate search starts to win.
+
+The exact search is skipped above --max-exact-rows. The approximate
+search runs at every size, DANA falls back to the exact search below
+APPROXIMATE_MIN_DONORS complete patients.
+
+Usage:
+
+python3 benchmarks/impute_benchmark.py [--sizes N [N ...]] [--out FILE]
+"""
+
+from synthetic_leoss import generate_dataset
+
+from typing import Dict
+
+import argparse
+import platform
+import subprocess
+import time
+import json
+import sys
+import os
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "dana"))
+
+from dana import __version__
+from imputation import impute_dataset, IMPUTE_NEIGHBORS
+
+import imputation
+
+
+DEFAULT_SIZES = [10000, 50000, 100000, 200000]
+MAX_EXACT_ROWS = 500000  # rows, the exact search is quadratic
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark_size(
+    nrows: int, seed: int, neighbors: int, threads: int, max_exact_rows: int
+) -> Dict:
+    dataset = generate_dataset(nrows, seed)
+    missing = dataset.isna().to_numpy()
+    report = {
+        "rows": nrows,
+        "complete_rows": int((~missing.any(axis=1)).sum()),
+        "missing_values": int(missing.sum()),
+    }
+    imputed = {}
+    for search, approximate in [("exact", False), ("approximate", True)]:
+        if not approximate and nrows > max_exact_rows:
+            report["exact_s"] = None
+            continue
+        start = time.perf_counter()
+        imputed[search] = impute_dataset(
+            dataset, "knn", neighbors, approximate, threads, True
+        )
+        report[f"{search}_s"] = time.perf_counter() - start
+        print(f"{nrows} rows - {search}: {report[f'{search}_s']:.2f}s", file=sys.stderr)
+    if report["exact_s"] is not None:
+        report["speedup"] = report["exact_s"] / report["approximate_s"]
+        # share of the imputed values found by both searches
+        exact = imputed["exact"].astype(str).to_numpy()[missing]
+        approximate = imputed["approximate"].astype(str).to_numpy()[missing]
+        report["agreement"] = float((exact == approximate).mean())
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="DANA KNN imputation benchmark")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Dataset rows"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--neighbors", type=int, default=IMPUTE_NEIGHBORS, help="Imputation neighbors"
+    )
+    parser.add_argument("--threads", type=int, default=1, help="Search threads")
+    parser.add_argument(
+        "--max-exact-rows",
+        type=int,
+        default=MAX_EXACT_ROWS,
+        help="Skip the exact search above this number of rows",
+    )
+    parser.add_argument("--out", default=None, help="JSON report (default: stdout)")
+    args = parser.parse_args()
+    threshold = imputation.APPROXIMATE_MIN_DONORS
+    imputation.APPROXIMATE_MIN_DONORS = 0  # compare the searches at every size
+    report = {
+        "dana_version": __version__,
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "neighbors": args.neighbors,
+        "threads": args.threads,
+        "approximate_min_donors": threshold,
+        "results": [],
+    }
+    for nrows in args.sizes:
+        report["results"].append(
+            benchmark_size(
+                nrows, args.seed, args.neighbors, args.threads, args.max_exact_rows
+            )
+        )
+    report_json = json.dumps(report, indent=2)
+    if args.out is None:
+        print(report_json)
+    else:
+        with open(args.out, mode="w") as outfile:
+            outfile.write(report_json + "\n")
+
+
+if __name__ == "__main__":
+    main()
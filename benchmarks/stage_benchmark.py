@@ -0,0 +1,171 @@
+"""DANA scaling benchmark.
+
+Synthetic LEOSS-like datasets of increasing size are analyzed stage by
+stage, measured by DANA's StageProfiler: wall time, CPU time, peak RSS
+and (with --tracemalloc) the memory allocated. Results are written as
+JSON, so runs of different versions can be compared.
+
+The distance matrix is quadratic in the number of patients: distance
+and clustering stages are skipped when the complete patients exceed
+--max-distance-rows.
+
+Usage:
+
+python3 benchmarks/stage_benchmark.py [--sizes N [N ...]] [--out FILE]
+"""
+
+from synthetic_leoss import write_dataset, REFERENCE_SEPARATOR
+
+from typing import Callable, Dict
+
+import matplotlib
+
+matplotlib.use("Agg")  # figures are only saved
+
+import argparse
+import tempfile
+import platform
+import subprocess
+import time
+import json
+import sys
+import gc
+import os
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "dana"))
+
+from dana import __version__
+from instrumentation import StageProfiler
+from dataset_analyzer import (
+    csv_reader,
+    compute_count_stats,
+    write_summary_statistics_excel,
+    compute_euclidean_distance,
+)
+from plot_data import plot_age_data, plot_recovery_data, plot_clusters
+from patient import build_patients_ds
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+MAX_DISTANCE_ROWS = 10000  # complete patients, the matrix takes n^2 values
+
+
+def benchmark_size(
+    nrows: int, workdir: str, seed: int, max_distance_rows: int, trace: bool
+) -> Dict:
+    csv_file = os.path.join(workdir, f"synthetic_{nrows}.csv")
+    outdir = os.path.join(workdir, f"out_{nrows}")
+    os.makedirs(outdir, exist_ok=True)
+    start = time.perf_counter()
+    write_dataset(csv_file, nrows, seed)
+    report = {
+        "rows": nrows,
+        "file_mb": os.path.getsize(csv_file) / 1024 / 1024,
+        "generate_s": time.perf_counter() - start,
+        "stages": {},
+    }
+    stages = report["stages"]
+    profiler = StageProfiler(True, trace)
+
+    def run(name: str, stage: Callable):
+        gc.collect()  # garbage of the previous stages is not accounted
+        with profiler.stage(name):
+            result = stage()
+        stages[name] = profiler.stages[-1]
+        print(f"{nrows} rows - {name}: {stages[name]['wall_s']:.2f}s", file=sys.stderr)
+        return result
+
+    dataset = run("csv_reader", lambda: csv_reader(csv_file, REFERENCE_SEPARATOR, True))
+    run("compute_count_stats", lambda: compute_count_stats(dataset, True, False))
+    run(
+        "write_summary_statistics_excel",
+        lambda: write_summary_statistics_excel(dataset, outdir, True, False),
+    )
+    complete = int(dataset.notnull().all(axis=1).sum())
+    report["complete_rows"] = complete
+    if complete <= max_distance_rows:
+        dist_mat = run(
+            "compute_euclidean_distance",
+            lambda: compute_euclidean_distance(dataset, True, False),
+        )
+    else:
+        dist_mat = None
+        stages["compute_euclidean_distance"] = {
+            "skipped": f"{complete} complete rows > {max_distance_rows}"
+        }
+    run("plot_age_data", lambda: plot_age_data(dataset, outdir, True, False))
+    run("plot_recovery_data", lambda: plot_recovery_data(dataset, outdir, True, False))
+    if dist_mat is not None:
+        run(
+            "plot_clusters",
+            lambda dist_mat=dist_mat: plot_clusters(dist_mat, outdir, True, False),
+        )
+    else:
+        stages["plot_clusters"] = dict(stages["compute_euclidean_distance"])
+    del dist_mat
+    run("build_patients_ds", lambda: build_patients_ds(dataset, False, True))
+    os.remove(csv_file)  # 1M rows datasets take about 100 MB
+    return report
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="DANA scaling benchmark")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Dataset rows"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--max-distance-rows",
+        type=int,
+        default=MAX_DISTANCE_ROWS,
+        help="Skip distances above this number of complete patients",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Record the peak allocated memory (slows down Python code)",
+    )
+    parser.add_argument("--workdir", default=None, help="Scratch directory")
+    parser.add_argument("--out", default=None, help="JSON report (default: stdout)")
+    args = parser.parse_args()
+    report = {
+        "dana_version": __version__,
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "tracemalloc": args.tracemalloc,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for nrows in args.sizes:
+            report["results"].append(
+                benchmark_size(
+                    nrows, workdir, args.seed, args.max_distance_rows, args.tracemalloc
+                )
+            )
+    report_json = json.dumps(report, indent=2)
+    if args.out is None:
+        print(report_json)
+    else:
+        with open(args.out, mode="w") as outfile:
+            outfile.write(report_json + "\n")
+
+
+if __name__ == "__main__":
+    main()
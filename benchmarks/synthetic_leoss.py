@@ -0,0 +1,85 @@
+"""Synthetic LEOSS-like datasets generator.
+
+Synthetic patients follow the schema and the category distributions of
+the LEOSS public dataset. Each synthetic patient is a LEOSS patient drawn
+at random, whose non-missing fields are redrawn from the column
+distribution with probability NOISE. Column distributions and the
+missing values structure are preserved, while new patient profiles
+appear as in larger cohorts.
+
+Usage:
+
+python3 benchmarks/synthetic_leoss.py -n ROWS -o OUTFILE [--seed SEED]
+"""
+
+from typing import Optional
+
+import pandas as pd
+import numpy as np
+
+import argparse
+import os
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REFERENCE_DATASET = os.path.join(ROOT, "datasets", "LEOSS_PublicDataSet_anonym.csv")
+REFERENCE_SEPARATOR = ";"
+NOISE = 0.1  # probability of redrawing a non-missing field
+
+
+def generate_dataset(
+    nrows: int,
+    seed: int = 0,
+    noise: float = NOISE,
+    reference: Optional[pd.DataFrame] = None,
+) -> pd.DataFrame:
+    if nrows < 1:
+        raise ValueError(f"Forbidden number of rows ({nrows})")
+    if not 0 <= noise <= 1:
+        raise ValueError(f"Forbidden noise probability ({noise})")
+    if reference is None:
+        reference = pd.read_csv(REFERENCE_DATASET, sep=REFERENCE_SEPARATOR)
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, reference.shape[0], size=nrows)
+    columns = {}
+    for col in reference.columns:
+        codes, categories = pd.factorize(reference[col])  # -1 is missing
+        values = codes[base]
+        present = np.flatnonzero(codes >= 0)
+        # redraw from the non-missing values, keeping their frequencies
+        redraw = (values >= 0) & (rng.random(nrows) < noise)
+        values[redraw] = codes[rng.choice(present, size=int(redraw.sum()))]
+        column = np.asarray(categories, dtype=object)[np.maximum(values, 0)]
+        column[values < 0] = None
+        columns[col] = column
+    return pd.DataFrame(columns)
+
+
+def write_dataset(
+    outfile: str,
+    nrows: int,
+    seed: int = 0,
+    noise: float = NOISE,
+    separator: str = REFERENCE_SEPARATOR,
+) -> str:
+    generate_dataset(nrows, seed, noise).to_csv(outfile, sep=separator, index=False)
+    return outfile
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate a LEOSS-like dataset")
+    parser.add_argument("-n", "--rows", type=int, required=True, help="Patients")
+    parser.add_argument("-o", "--out", required=True, help="Output CSV file")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--noise", type=float, default=NOISE, help="Field redraw probability"
+    )
+    parser.add_argument(
+        "-s", "--separator", default=REFERENCE_SEPARATOR, help="CSV separator"
+    )
+    args = parser.parse_args()
+    write_dataset(args.out, args.rows, args.seed, args.noise, args.separator)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,18 +23,51 @@ Usage:
 
 python3 __main__.py -d DATASET -s CSV_SEPARATOR
 
+python3 __main__.py -f batch --datasets DATASET [DATASET ...] -s CSV_SEPARATOR
+
+python3 __main__.py -f serve -d DATASET -s CSV_SEPARATOR [--port PORT | --socket FILE]
+
+python3 __main__.py -f stratify -d DATASET -s CSV_SEPARATOR --by COLUMN [COLUMN ...]
+
+python3 __main__.py -f preprocess -d DATASET -s CSV_SEPARATOR [--rules RULES_FILE] [--impute METHOD] -o OUTFILE
+
+python3 __main__.py -f similar -d DATASET -s CSV_SEPARATOR [--pid PID [PID ...] | --query FILE]
+
 Run dana --help to see all command line options.
 """
 
 from dana import dana, __version__
-from utils import check_type, is_csv, DEFAULT_SEPARATOR
+from utils import (
+    check_type,
+    DEFAULT_SEPARATOR,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+)
+from csv_input import CsvInput
 from dana_argparse import DanaArgumentParser
+from distance import DISTANCE_DTYPES
+from plot_data import MAX_CLUSTERMAP_LEAVES
+from summary_report import REPORT_FORMATS
+from similarity import SIMILAR_PATIENTS
+from imputation import IMPUTE_METHODS, IMPUTE_NEIGHBORS, APPROXIMATE_MIN_DONORS
 
 from typing import Optional, List
 
 import sys
 
 
+FUNCTIONS = (
+    "analyze",
+    "introduce",
+    "batch",
+    "serve",
+    "stratify",
+    "similar",
+    "preprocess",
+)
+
+
 def get_parser() -> DanaArgumentParser:
     parser = DanaArgumentParser(usage=__doc__, add_help=False)
     # start command line args parsing
@@ -68,7 +101,8 @@ def get_parser() -> DanaArgumentParser:
         nargs="?",
         default="analyze",
         metavar="ACTION",
-        help='Available functions ("analyze" or "introduce")',
+        help='Available functions ("analyze", "introduce", "batch", "serve", '
+        '"stratify", "similar" or "preprocess")',
     )
     group.add_argument(
         "-d",
@@ -79,6 +113,24 @@ def get_parser() -> DanaArgumentParser:
         metavar="DATASET",
         help="Path to the dataset CSV file.",
     )
+    group.add_argument(
+        "--datasets",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="DATASET",
+        help="Dataset CSV files or glob patterns (e.g. 'extracts/*.csv'), "
+        "each analyzed in its own output directory with the \"analyze\" "
+        'options. Used with "batch" function.',
+    )
+    group.add_argument(
+        "--jobs",
+        type=int,
+        nargs="?",
+        default=1,
+        metavar="JOBS",
+        help='Number of datasets analyzed in parallel. Used with "batch" function.',
+    )
     group.add_argument(
         "-s",
         "--separator",
@@ -94,17 +146,282 @@ def get_parser() -> DanaArgumentParser:
         "--out",
         type=str,
         nargs="?",
-        default="./",
+        default=None,
         metavar="OUTFILE",
-        help='Path to summary statistics excel file. Used with "analyze" function.',
+        help='Path to summary statistics excel file (default: "./") with '
+        '"analyze" function; patient records file (default: standard output) '
+        'with "introduce" function; stratified counts CSV file (default: '
+        'standard output) with "stratify" function; similar patients CSV '
+        'file (default: standard output) with "similar" function; '
+        'preprocessed dataset CSV file with "preprocess" function.',
     )
     group.add_argument(
-        "--pid",
+        "--cache-dir",
+        type=str,
+        nargs="?",
+        const=DEFAULT_CACHE_DIR,
+        default=None,
+        metavar="CACHE_DIR",
+        dest="cache_dir",
+        help="Cache parsed datasets (and the \"introduce\" row index and "
+        '"similar" patients index) in CACHE_DIR, reused by later runs on the '
+        f"same dataset (default: {DEFAULT_CACHE_DIR}).",
+    )
+    group.add_argument(
+        "--categorical",
+        default=False,
+        action="store_true",
+        help="Store text columns as compact integer category codes.",
+    )
+    group.add_argument(
+        "--max-memory",
+        type=int,
+        nargs="?",
+        default=None,
+        metavar="MB",
+        dest="max_memory",
+        help="Memory limit (in MB) for streaming the dataset in chunks. "
+        'Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--threads",
+        type=int,
+        nargs="?",
+        default=1,
+        metavar="THREADS",
+        help="Number of threads used to compute the distance matrix and to "
+        'impute missing values. Used with "analyze" and "preprocess" functions.',
+    )
+    group.add_argument(
+        "--dist-dtype",
+        type=str,
+        nargs="?",
+        default="float64",
+        choices=DISTANCE_DTYPES,
+        dest="dist_dtype",
+        help="Type of the distance matrix values (uint8 stores the number of "
+        'mismatching columns). Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--report-format",
+        type=str,
+        nargs="?",
+        default="xlsx",
+        choices=REPORT_FORMATS,
+        dest="report_format",
+        help="Format of the summary statistics report (parquet requires "
+        'pyarrow). Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--condensed",
+        default=False,
+        action="store_true",
+        help="Store only the upper triangle of the distance matrix. "
+        'Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--dedup",
+        default=False,
+        action="store_true",
+        help="Collapse identical patients into weighted unique profiles before "
+        'computing distances and clusters. Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--impute",
+        type=str,
+        nargs="?",
+        default=None,
+        choices=IMPUTE_METHODS,
+        help="Fill the missing values of incomplete patients, which are "
+        "otherwise dropped from distances and clusters, with the column mode "
+        "(median for numerical columns) or the values of their nearest complete "
+        'patients (knn). Used with "analyze" and "preprocess" functions.',
+    )
+    group.add_argument(
+        "--neighbors",
         type=int,
         nargs="?",
+        default=IMPUTE_NEIGHBORS,
+        metavar="K",
+        help="Number of nearest complete patients imputing the missing values "
+        f'(default: {IMPUTE_NEIGHBORS}). Used with "--impute knn".',
+    )
+    group.add_argument(
+        "--approximate",
+        default=False,
+        action="store_true",
+        help="Search the nearest complete patients in hash tables instead of "
+        "comparing them all, on datasets with at least "
+        f'{APPROXIMATE_MIN_DONORS} complete patients. Used with "--impute knn".',
+    )
+    group.add_argument(
+        "--max-leaves",
+        type=int,
+        nargs="?",
+        default=MAX_CLUSTERMAP_LEAVES,
+        metavar="LEAVES",
+        dest="max_leaves",
+        help="Maximum number of rows drawn in the clusters heatmap, larger "
+        "datasets are drawn as average distances between clusters "
+        f'(default: {MAX_CLUSTERMAP_LEAVES}). Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--plot-jobs",
+        type=int,
+        nargs="?",
+        default=1,
+        metavar="JOBS",
+        dest="plot_jobs",
+        help="Number of processes rendering the plots in parallel. "
+        'Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--dist-file",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="NPY_FILE",
+        dest="dist_file",
+        help="Disk-backed .npy file storing the distance matrix, reused by "
+        'later runs on the same dataset. Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--state",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="STATE_DIR",
+        dest="state_dir",
+        help="Directory storing the analysis state. Later releases of the "
+        "dataset, appending rows to the analyzed ones, are analyzed "
+        'incrementally. Used with "analyze" function.',
+    )
+    group.add_argument(
+        "--profile-report",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="JSON_FILE",
+        dest="profile_report",
+        help="Measure wall time, CPU time and peak memory of each analysis "
+        "stage, and write them to a JSON run report.",
+    )
+    group.add_argument(
+        "--profile-summary",
+        default=False,
+        action="store_true",
+        dest="profile_summary",
+        help="Measure each analysis stage and print a summary table.",
+    )
+    group.add_argument(
+        "--profile-allocations",
+        default=False,
+        action="store_true",
+        dest="profile_allocations",
+        help="Also trace the memory allocated by each analysis stage "
+        "(slows down the analysis). Used with --profile-report or "
+        "--profile-summary.",
+    )
+    group.add_argument(
+        "--rules",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="RULES_FILE",
+        dest="rules_file",
+        help="JSON file of preprocessing rules (column types, units of measure, "
+        "decimal separator, dates format, missing values filling, derived and "
+        'dropped columns). Used with "preprocess" function.',
+    )
+    group.add_argument(
+        "--by",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="COLUMN",
+        help="Columns stratifying the patients counts (e.g. Sex "
+        'Age.at.diagnosis). Used with "stratify" function.',
+    )
+    group.add_argument(
+        "--within",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="COLUMN",
+        help="Compute the percentages within each stratum of these columns "
+        '(default: on all patients). Used with "stratify" function.',
+    )
+    group.add_argument(
+        "--dropna",
+        default=False,
+        action="store_true",
+        help='Do not report missing values strata. Used with "stratify" function.',
+    )
+    group.add_argument(
+        "--host",
+        type=str,
+        nargs="?",
+        default=DEFAULT_HOST,
+        metavar="HOST",
+        help=f"Address the server listens on (default: {DEFAULT_HOST}). "
+        'Used with "serve" function.',
+    )
+    group.add_argument(
+        "--port",
+        type=int,
+        nargs="?",
+        default=DEFAULT_PORT,
+        metavar="PORT",
+        help=f"Port the server listens on (default: {DEFAULT_PORT}). "
+        'Used with "serve" function.',
+    )
+    group.add_argument(
+        "--socket",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="SOCKET_FILE",
+        help="Unix socket the server listens on, instead of a TCP port. Used "
+        'with "serve" function.',
+    )
+    group.add_argument(
+        "--pid",
+        type=str,
+        nargs="+",
         default=None,
         metavar="PID",
-        help='Patient ID. Used with "introduce" function.',
+        help="Patient IDs or inclusive ID ranges (e.g. 1000010-1000020). "
+        'Used with "introduce" and "similar" functions.',
+    )
+    group.add_argument(
+        "--pid-file",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="FILE",
+        dest="pid_file",
+        help="File of patient IDs or ID ranges, separated by whitespaces or "
+        'commas. Used with "introduce" and "similar" functions.',
+    )
+    group.add_argument(
+        "--query",
+        type=str,
+        nargs="?",
+        default=None,
+        metavar="FILE",
+        dest="query_file",
+        help="CSV file of query patients, with some or all of the dataset "
+        "columns, looked up instead of dataset patients. Used with "
+        '"similar" function.',
+    )
+    group.add_argument(
+        "--top",
+        type=int,
+        nargs="?",
+        default=SIMILAR_PATIENTS,
+        metavar="K",
+        help="Number of similar patients reported for each query "
+        f'(default: {SIMILAR_PATIENTS}). Used with "similar" function.',
     )
     return parser
 
@@ -126,37 +443,205 @@ def main(commandline_args: Optional[List[str]] = None) -> None:
         errmsg = f"Expected {bool.__name__}, got {type(args.debug).__name__}"
         parser.error(errmsg)
     debug = args.debug
+    functions = ", ".join(f'"{func}"' for func in FUNCTIONS)
     if not args.func:
-        parser.error(
-            'No function selected. Please choose one between "analyze" and "introduce"'
-        )
+        parser.error(f"No function selected. Please choose one among {functions}")
     check_type(str, args.func)
-    if args.func != "analyze" and args.func != "introduce":
+    if args.func not in FUNCTIONS:
+        parser.error(f"Unknown function selected. Please choose one among {functions}")
+    if args.func == "batch":
+        if not args.datasets:
+            parser.error('No dataset files given ("--datasets")')
+        if args.dataset:
+            parser.error(
+                'Forbidden argument given ("--dataset") with functionality "batch"'
+            )
+        if args.jobs is None or args.jobs < 1:
+            parser.error(f"Forbidden number of parallel analyses ({args.jobs})")
+    elif args.datasets is not None:
         parser.error(
-            'Unknown function selected. Please choose one between "analyze" and "introduce"'
+            f'Forbidden argument given ("--datasets") with functionality "{args.func}"'
         )
-    if not args.dataset:
+    elif not args.dataset:
         parser.error("No dataset file given")
     check_type(str, args.separator)
-    if not is_csv(args.dataset, args.separator):
-        parser.error(f"{args.dataset} does not appear to be a CSV file")
+    if args.cache_dir is not None:
+        check_type(str, args.cache_dir)
+        if not args.cache_dir:
+            parser.error("Missing cache directory")
+    if args.profile_report is not None and not args.profile_report:
+        parser.error("Missing run report file")
+    # validated once, the open dataset file is handed to the loaders
+    # (batch datasets are validated by the worker analyzing them)
+    if args.func != "batch":
+        args.csv_input = CsvInput.open(args.dataset, args.separator, debug)
+        if args.csv_input is None:
+            parser.error(f"{args.dataset} does not appear to be a CSV file")
 
     # check args consistency with the chosen functionality
-    if args.func == "analyze":
+    if args.func in ("analyze", "batch"):
         if args.pid is not None:
             parser.error(
-                'Forbidden argument given ("--pid") with functionality "analyze"'
+                f'Forbidden argument given ("--pid") with functionality "{args.func}"'
+            )
+        if args.pid_file is not None:
+            parser.error(
+                f'Forbidden argument given ("--pid-file") with functionality "{args.func}"'
             )
+        if args.out is None:
+            args.out = "./"
         check_type(str, args.out, debug)
         if not args.out:
             parser.error("Missing output summary statistics file")
+        if args.max_memory is not None and args.max_memory <= 0:
+            parser.error(f"Forbidden memory limit ({args.max_memory} MB)")
+        if args.threads is None or args.threads < 1:
+            parser.error(f"Forbidden number of threads ({args.threads})")
+        if args.plot_jobs is None or args.plot_jobs < 1:
+            parser.error(f"Forbidden number of plotting processes ({args.plot_jobs})")
+        if args.max_leaves is None or args.max_leaves < 2:
+            parser.error(f"Forbidden number of clustermap leaves ({args.max_leaves})")
+        if args.dist_file is not None and not args.dist_file.endswith(".npy"):
+            parser.error(f"Distance matrix file must be a .npy file ({args.dist_file})")
+        if args.state_dir is not None:
+            if not args.state_dir:
+                parser.error("Missing analysis state directory")
+            for option, value in [
+                ("--max-memory", args.max_memory),
+                ("--condensed", args.condensed),
+                ("--dist-file", args.dist_file),
+                ("--impute", args.impute),
+            ]:
+                if value:
+                    parser.error(f'Forbidden argument given ("{option}") with "--state"')
+    if args.func == "stratify":
+        if args.by is None:
+            parser.error('No stratifying column given ("--by")')
+        columns = args.by + (args.within or [])
+        unknown = [col for col in columns if col not in args.csv_input.header]
+        if unknown:
+            parser.error(f"Unknown dataset columns ({', '.join(unknown)})")
+        if len(set(args.by)) != len(args.by):
+            parser.error("Stratifying columns given more than once")
+        if args.within is not None and not set(args.within) <= set(args.by):
+            parser.error('Columns given with "--within" must be given with "--by"')
+        if args.max_memory is not None and args.max_memory <= 0:
+            parser.error(f"Forbidden memory limit ({args.max_memory} MB)")
+        if args.out is not None and not args.out:
+            parser.error("Missing output stratified counts file")
+        for option, value in [
+            ("--pid", args.pid),
+            ("--pid-file", args.pid_file),
+            ("--state", args.state_dir),
+        ]:
+            if value is not None:
+                parser.error(
+                    f'Forbidden argument given ("{option}") with functionality "stratify"'
+                )
+    elif args.by is not None or args.within is not None:
+        option = "--by" if args.by is not None else "--within"
+        parser.error(
+            f'Forbidden argument given ("{option}") with functionality "{args.func}"'
+        )
+    if args.func == "serve":
+        for option, value in [
+            ("--pid", args.pid),
+            ("--pid-file", args.pid_file),
+            ("--max-memory", args.max_memory),
+            ("--state", args.state_dir),
+        ]:
+            if value is not None:
+                parser.error(
+                    f'Forbidden argument given ("{option}") with functionality "serve"'
+                )
+        if args.port is None or not 0 <= args.port <= 65535:
+            parser.error(f"Forbidden server port ({args.port})")
+        if args.socket is not None and not args.socket:
+            parser.error("Missing server socket file")
+    if args.func == "similar":
+        if args.state_dir is not None:
+            parser.error(
+                'Forbidden argument given ("--state") with functionality "similar"'
+            )
+        if args.pid is None and args.pid_file is None and args.query_file is None:
+            parser.error(
+                'No query patient given ("--pid", "--pid-file" or "--query")'
+            )
+        if args.query_file is not None and (
+            args.pid is not None or args.pid_file is not None
+        ):
+            parser.error('"--query" cannot be given with "--pid" or "--pid-file"')
+        if args.query_file is not None and not args.query_file:
+            parser.error("Missing query patients file")
+        if args.top is None or args.top < 1:
+            parser.error(f"Forbidden number of similar patients ({args.top})")
+        if args.max_memory is not None and args.max_memory <= 0:
+            parser.error(f"Forbidden memory limit ({args.max_memory} MB)")
+        if args.out is not None and not args.out:
+            parser.error("Missing output similar patients file")
+    elif args.query_file is not None:
+        parser.error(
+            f'Forbidden argument given ("--query") with functionality "{args.func}"'
+        )
+    if args.func == "preprocess":
+        if args.threads is None or args.threads < 1:
+            parser.error(f"Forbidden number of threads ({args.threads})")
+        if not args.out:
+            parser.error('No output preprocessed dataset file given ("--out")')
+        if args.rules_file is not None and not args.rules_file:
+            parser.error("Missing preprocessing rules file")
+        for option, value in [
+            ("--pid", args.pid),
+            ("--pid-file", args.pid_file),
+            ("--max-memory", args.max_memory),
+            ("--state", args.state_dir),
+        ]:
+            if value is not None:
+                parser.error(
+                    f'Forbidden argument given ("{option}") with functionality "preprocess"'
+                )
+    elif args.rules_file is not None:
+        parser.error(
+            f'Forbidden argument given ("--rules") with functionality "{args.func}"'
+        )
+    if args.func in ("analyze", "batch", "preprocess"):
+        if args.impute is not None and args.max_memory is not None:
+            parser.error('Forbidden argument given ("--impute") with "--max-memory"')
+        if args.neighbors is None or args.neighbors < 1:
+            parser.error(f"Forbidden number of imputation neighbors ({args.neighbors})")
+        if args.impute != "knn" and (
+            args.approximate or args.neighbors != IMPUTE_NEIGHBORS
+        ):
+            option = "--approximate" if args.approximate else "--neighbors"
+            parser.error(f'"{option}" can only be given with "--impute knn"')
+    elif args.impute is not None:
+        parser.error(
+            f'Forbidden argument given ("--impute") with functionality "{args.func}"'
+        )
     if args.func == "introduce":
-        if args.out:
+        if args.state_dir is not None:
+            parser.error(
+                'Forbidden argument given ("--state") with functionality "introduce"'
+            )
+        if args.max_memory is not None:
             parser.error(
-                'Forbidden argument given ("--out") with functionality "introduce"'
+                'Forbidden argument given ("--max-memory") with functionality "introduce"'
             )
+        if args.pid is None and args.pid_file is None:
+            parser.error('No patient ID given ("--pid" or "--pid-file")')
+        if args.out is not None and not args.out:
+            parser.error("Missing output patient records file")
     # DANA analysis
-    dana(args, verbose, debug)
+    if args.func == "batch":
+        from batch import dana_batch
+
+        dana_batch(args, verbose, debug)
+    elif args.func == "serve":
+        from server import dana_serve
+
+        dana_serve(args, verbose, debug)
+    else:
+        dana(args, verbose, debug)
 
 
 if __name__ == "__main__":
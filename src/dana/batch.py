@@ -0,0 +1,190 @@
+"""Batch analysis of multiple datasets.
+Datasets are analyzed by a bounded pool of worker processes, which
+import the analysis libraries once, when started, and then run the
+complete analysis of one dataset at a time. Each dataset gets its own
+output directory and log file, and a failed analysis does not stop the
+others. The combined index.json lists the outcome of every analysis.
+"""
+from utils import exception_handler, check_type, print_warning
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from argparse import Namespace
+from typing import Dict, List
+
+import traceback
+import importlib
+import datetime
+import glob
+import json
+import time
+import os
+
+
+INDEX_FILE = "index.json"
+LOG_FILE = "dana.log"
+# imported by each worker before its first dataset
+WORKER_MODULES = [
+    "matplotlib.pyplot",
+    "seaborn",
+    "scipy.cluster.hierarchy",
+    "dataset_analyzer",
+    "clustering",
+]
+
+
+def expand_datasets(patterns: List[str], debug: bool = False) -> List[str]:
+    """Dataset files matching the given paths or glob patterns, in the
+    given order and without duplicates.
+    """
+    check_type(list, patterns, debug)
+    datasets = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            print_warning(f"No dataset matches {pattern}")
+        for match in matches:
+            if os.path.isfile(match) and match not in datasets:
+                datasets.append(match)
+    return datasets
+
+
+def batch_outdirs(datasets: List[str], outdir: str) -> List[str]:
+    """Output directory of each dataset, named after the dataset file.
+    Datasets sharing the same name get numbered directories.
+    """
+    outdirs, used = [], set()
+    for dataset in datasets:
+        name = os.path.splitext(os.path.basename(dataset))[0]
+        candidate, i = name, 1
+        while candidate in used:
+            i += 1
+            candidate = f"{name}_{i}"
+        used.add(candidate)
+        outdirs.append(os.path.join(outdir, candidate))
+    return outdirs
+
+
+def _init_batch_worker() -> None:
+    """(PRIVATE) Import the analysis stack once per worker, before the
+    first dataset is scheduled.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")  # figures are only saved
+    for module in WORKER_MODULES:
+        importlib.import_module(module)
+
+
+def analyze_dataset(commandline_args: Namespace, verbose: bool, debug: bool) -> Dict:
+    """Run the analysis of a single dataset, logging its output in the
+    dataset output directory. Errors are reported in the returned
+    outcome, not raised.
+    """
+    from dana import dana
+
+    outcome = {
+        "dataset": commandline_args.dataset,
+        "outdir": commandline_args.out,
+        "status": "ok",
+    }
+    start = time.perf_counter()
+    try:
+        os.makedirs(commandline_args.out, exist_ok=True)
+        logfile = os.path.join(commandline_args.out, LOG_FILE)
+        with open(logfile, mode="w") as log:
+            with redirect_stdout(log), redirect_stderr(log):
+                try:
+                    dana(commandline_args, verbose, debug)
+                except SystemExit as e:  # errors handled by exception_handler
+                    if e.code:
+                        outcome["status"] = "failed"
+                except Exception:
+                    traceback.print_exc()
+                    outcome["status"] = "failed"
+        if outcome["status"] != "ok":
+            outcome["error"] = log_error(logfile)
+    except OSError as e:
+        outcome["status"] = "failed"
+        outcome["error"] = f"Unable to write the analysis output ({e})"
+    outcome["elapsed_s"] = round(time.perf_counter() - start, 3)
+    return outcome
+
+
+def log_error(logfile: str) -> str:
+    """Last error reported in an analysis log."""
+    with open(logfile, mode="r") as log:
+        lines = [line.strip() for line in log if line.strip()]
+    for line in reversed(lines):
+        if "ERROR: " in line:  # printed by exception_handler
+            return line[line.index("ERROR: ") + len("ERROR: ") :].split("\x1b")[0]
+    return f"{lines[-1] if lines else 'Analysis failed'} (see {logfile})"
+
+
+def dana_batch(commandline_args: Namespace, verbose: bool, debug: bool) -> Dict:
+    check_type(Namespace, commandline_args, debug)
+    datasets = expand_datasets(commandline_args.datasets, debug)
+    if not datasets:
+        errmsg = "No dataset file found"
+        exception_handler(FileNotFoundError, errmsg, debug)
+    outdir = commandline_args.out
+    jobs = min(commandline_args.jobs, len(datasets))
+    print(f"Analyzing {len(datasets)} datasets with {jobs} worker processes")
+    tasks = []
+    for dataset, dataset_outdir in zip(datasets, batch_outdirs(datasets, outdir)):
+        args = Namespace(**vars(commandline_args))
+        args.func, args.dataset, args.out = "analyze", dataset, dataset_outdir
+        args.csv_input = None  # validated and opened by the worker
+        name = os.path.basename(dataset_outdir)
+        if args.state_dir is not None:  # one analysis state per dataset
+            args.state_dir = os.path.join(args.state_dir, name)
+        if args.profile_report is not None:  # one run report per dataset
+            args.profile_report = os.path.join(
+                dataset_outdir, os.path.basename(args.profile_report)
+            )
+        tasks.append(args)
+    start = time.perf_counter()
+    started = datetime.datetime.now().isoformat(timespec="seconds")
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_batch_worker
+    ) as executor:
+        futures = [
+            executor.submit(analyze_dataset, args, verbose, debug) for args in tasks
+        ]
+        outcomes = []
+        for args, future in zip(tasks, futures):
+            try:
+                outcome = future.result()
+            except Exception as e:  # worker process died
+                outcome = {
+                    "dataset": args.dataset,
+                    "outdir": args.out,
+                    "status": "failed",
+                    "error": f"{e.__class__.__name__}: {e}",
+                }
+            if outcome["status"] != "ok":
+                print_warning(f"{outcome['dataset']}: {outcome['error']}")
+            elif verbose:
+                print(f"{outcome['dataset']}: analyzed in {outcome['elapsed_s']}s")
+            outcomes.append(outcome)
+    index = {
+        "started": started,
+        "elapsed_s": round(time.perf_counter() - start, 3),
+        "jobs": jobs,
+        "datasets": outcomes,
+    }
+    indexfile = os.path.join(outdir, INDEX_FILE)
+    try:
+        os.makedirs(outdir, exist_ok=True)
+        with open(indexfile, mode="w") as outstream:
+            json.dump(index, outstream, indent=2)
+            outstream.write("\n")
+    except OSError as e:
+        errmsg = f"An error occurred while writing the batch index {indexfile}"
+        exception_handler(e.__class__, errmsg, debug)
+    failed = sum(outcome["status"] != "ok" for outcome in outcomes)
+    print(
+        f"{len(outcomes) - failed} datasets analyzed, {failed} failed "
+        f"(index: {indexfile})"
+    )
+    return index
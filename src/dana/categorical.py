@@ -0,0 +1,81 @@
+"""Compact categorical representation of datasets.
+Text columns are stored as small integer codes plus the dictionary of
+their categories, and downstream analyses work directly on the codes.
+"""
+from __future__ import annotations
+
+from utils import check_type
+
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+import pandas as pd
+import numpy as np
+
+if TYPE_CHECKING:
+    from scipy.sparse import csr_matrix
+
+
+def codes_dtype(categories_num: int) -> np.dtype:
+    # smallest signed integer type able to store the codes (-1 is missing)
+    for dtype in (np.int8, np.int16, np.int32):
+        if categories_num <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def row_keys(codes: np.ndarray) -> np.ndarray:
+    """Rows of codes as single comparable (void) values."""
+    codes = np.ascontiguousarray(codes)
+    return codes.view(np.dtype((np.void, codes.dtype.itemsize * codes.shape[1]))).ravel()
+
+
+def to_categorical(dataset: pd.DataFrame, debug: bool = False) -> pd.DataFrame:
+    check_type(pd.DataFrame, dataset, debug)
+    # numerical columns are left untouched
+    categorical_cols = [
+        col
+        for col in dataset.columns
+        if not pd.api.types.is_numeric_dtype(dataset[col].dtype)
+    ]
+    if not categorical_cols:
+        return dataset
+    return dataset.astype({col: "category" for col in categorical_cols})
+
+
+def category_codes(
+    column: pd.Series, categories: Optional[List] = None
+) -> Tuple[np.ndarray, pd.Index]:
+    """Return the integer codes of column values and the corresponding
+    categories. Missing values (or values not in categories) get code -1.
+    Categorical columns are not recoded when possible.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        if categories is None or column.cat.categories.equals(pd.Index(categories)):
+            return column.cat.codes.to_numpy(), column.cat.categories
+    if categories is None:
+        codes, uniques = pd.factorize(column, sort=True)
+        return codes, pd.Index(uniques)
+    categorical = pd.Categorical(column, categories=categories)
+    return categorical.codes, categorical.categories
+
+
+def onehot_encode(dataset: pd.DataFrame, debug: bool = False) -> csr_matrix:
+    """One-hot encode the dataset columns from their category codes. Each
+    column is expanded to one indicator per category (sorted as by
+    sklearn's OneHotEncoder), missing values set no indicator.
+    """
+    from scipy.sparse import csr_matrix
+
+    check_type(pd.DataFrame, dataset, debug)
+    nrow = dataset.shape[0]
+    rows, cols = [], []
+    offset = 0
+    for col in dataset.columns:
+        codes, categories = category_codes(dataset[col])
+        present = codes >= 0
+        rows.append(np.flatnonzero(present))
+        cols.append(codes[present].astype(np.int64) + offset)
+        offset += len(categories)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    data = np.ones(rows.shape[0], dtype=np.float64)
+    return csr_matrix((data, (rows, cols)), shape=(nrow, offset))
@@ -0,0 +1,314 @@
+"""Hierarchical clustering of deduplicated patient profiles.
+Categorical datasets contain many identical patients. Identical rows are
+collapsed into unique profiles weighted by their multiplicity, distances
+and average linkage are computed on the unique profiles only, and
+per-patient results are expanded back only when requested.
+"""
+from utils import exception_handler, check_type
+from distance import as_euclidean, distance_rows
+
+from scipy.cluster.hierarchy import linkage as average_linkage, fcluster
+from scipy.spatial.distance import squareform
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+AGGREGATION_BLOCK_SIZE = 256  # distance matrix rows aggregated at a time
+
+
+class PatientProfiles:
+    """Unique patient profiles (rows of category codes) and their
+    multiplicity in the dataset.
+
+    ...
+
+    Attributes
+    ----------
+    codes : numpy.ndarray
+        Category codes of the unique profiles.
+    inverse : numpy.ndarray
+        Unique profile of each patient.
+    weights : numpy.ndarray
+        Number of patients sharing each unique profile.
+
+    Methods
+    -------
+    linkage(dist_mat)
+        Average linkage of the unique profiles, weighted by multiplicity.
+    patient_linkage(linkage)
+        Expand a unique profiles linkage to the patients.
+    patient_labels(labels)
+        Expand unique profiles cluster labels to the patients.
+    patient_distances(dist_mat)
+        Expand the unique profiles distance matrix to the patients.
+    """
+
+    def __init__(self, codes: np.ndarray) -> None:
+        check_type(np.ndarray, codes)
+        if codes.ndim != 2 or codes.shape[0] == 0:
+            errmsg = f"Forbidden codes matrix shape ({codes.shape})"
+            exception_handler(ValueError, errmsg, False)
+        unique, inverse, counts = np.unique(
+            codes, axis=0, return_inverse=True, return_counts=True
+        )
+        self._codes = unique
+        self._inverse = inverse.reshape(-1)
+        self._weights = counts
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {self._inverse.shape[0]} patients, {self._codes.shape[0]} profiles>"
+
+    def __len__(self) -> int:
+        return self._codes.shape[0]
+
+    def _get_codes(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._codes
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._get_codes()
+
+    def _get_inverse(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._inverse
+
+    @property
+    def inverse(self) -> np.ndarray:
+        return self._get_inverse()
+
+    def _get_weights(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._weights
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self._get_weights()
+
+    def linkage(self, dist_mat: np.ndarray) -> np.ndarray:
+        return weighted_average_linkage(dist_mat, self._weights)
+
+    def patient_linkage(self, linkage: np.ndarray) -> np.ndarray:
+        return expand_linkage(linkage, self._inverse, self._weights)
+
+    def patient_labels(self, labels: np.ndarray) -> np.ndarray:
+        check_type(np.ndarray, labels)
+        return labels[self._inverse]
+
+    def patient_distances(self, dist_mat: np.ndarray) -> np.ndarray:
+        check_type(np.ndarray, dist_mat)
+        if dist_mat.ndim == 1:
+            dist_mat = squareform(dist_mat)
+        return dist_mat[np.ix_(self._inverse, self._inverse)]
+
+
+def weighted_average_linkage(dist_mat: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Average linkage (UPGMA) of observations standing for weights[i]
+    identical patients each, computed with the nearest-neighbor chain
+    algorithm. It is an average linkage of the expanded patients, once
+    identical patients are merged at height 0, equal to scipy's on
+    distinct distances (the merge order of tied distances may differ).
+    The algorithm updates a float64 copy of the condensed distance
+    matrix, n (n - 1) / 2 values for n observations, and runs n merges
+    of O(n) vectorized steps each.
+    Returns a scipy linkage matrix, cluster sizes count patients.
+    """
+    check_type(np.ndarray, dist_mat)
+    check_type(np.ndarray, weights)
+    if dist_mat.ndim == 2:  # squareform returns a copy
+        dist = np.asarray(squareform(dist_mat, checks=False), dtype=np.float64)
+    else:
+        dist = np.array(dist_mat, dtype=np.float64)  # updated in place
+    nobs = weights.shape[0]
+    if dist.shape != (nobs * (nobs - 1) // 2,) or weights.ndim != 1:
+        errmsg = "Mismatching distance matrix and weights"
+        exception_handler(ValueError, errmsg, False)
+    if nobs < 2:
+        return np.empty((0, 4), dtype=np.float64)
+    others = np.arange(nobs)
+    # condensed position of (i, j), i < j: offset[i] + j
+    offset = nobs * others - others * (others + 1) // 2 - others - 1
+
+    def row_positions(a: int) -> np.ndarray:
+        # condensed positions of the distances between a and every slot
+        # (the position of (a, a) is a placeholder)
+        return np.where(others < a, offset[others] + a, offset[a] + others)
+
+    def row(a: int) -> np.ndarray:
+        values = dist[row_positions(a)]
+        values[a] = np.inf
+        return values
+
+    size = weights.astype(np.float64)
+    merges = np.empty((nobs - 1, 3), dtype=np.float64)  # slot, slot, height
+    chain = []
+    active = np.ones(nobs, dtype=bool)
+    for k in range(nobs - 1):
+        if not chain:
+            chain.append(int(np.flatnonzero(active)[0]))
+        while True:
+            a = chain[-1]
+            dist_a = row(a)
+            b = int(np.argmin(dist_a))
+            # on ties, prefer the previous chain element to stop the chain
+            if len(chain) > 1 and dist_a[chain[-2]] == dist_a[b]:
+                b = chain[-2]
+            if len(chain) > 1 and b == chain[-2]:
+                break
+            chain.append(b)
+        chain.pop()
+        chain.pop()
+        merges[k] = a, b, dist_a[b]
+        # Lance-Williams update, the merged cluster takes slot b
+        dist_b = row(b)
+        merged = (size[a] * dist_a + size[b] * dist_b) / (size[a] + size[b])
+        merged[~active] = np.inf
+        merged[a] = np.inf  # slot a is no longer active
+        # placeholders are redirected to (a, b), which is set to inf
+        positions = row_positions(b)
+        positions[b] = positions[a]
+        dist[positions] = merged
+        positions = row_positions(a)
+        positions[a] = positions[b]
+        dist[positions] = np.inf
+        size[b] += size[a]
+        active[a] = False
+    return _label_merges(merges, weights)
+
+
+def _label_merges(merges: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """(PRIVATE) Sort the merges by height and assign scipy cluster
+    labels (observations 0..n-1, n + k for the k-th merge).
+    """
+    nobs = merges.shape[0] + 1
+    merges = merges[np.argsort(merges[:, 2], kind="stable")]
+    parent = np.arange(nobs)  # union-find over observation slots
+    label = np.arange(nobs)
+    size = weights.astype(np.float64)
+    linkage = np.empty((nobs - 1, 4), dtype=np.float64)
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for k, (a, b, height) in enumerate(merges):
+        root_a, root_b = find(int(a)), find(int(b))
+        label_a, label_b = label[root_a], label[root_b]
+        linkage[k] = (
+            min(label_a, label_b),
+            max(label_a, label_b),
+            height,
+            size[root_a] + size[root_b],
+        )
+        parent[root_a] = root_b
+        label[root_b] = nobs + k
+        size[root_b] += size[root_a]
+    return linkage
+
+
+def expand_linkage(
+    linkage: np.ndarray, inverse: np.ndarray, weights: np.ndarray
+) -> np.ndarray:
+    """Expand a linkage computed on unique profiles to the patients.
+    Patients sharing a profile are first merged at height 0, then the
+    profiles linkage is replayed on the resulting clusters.
+    """
+    check_type(np.ndarray, linkage)
+    check_type(np.ndarray, inverse)
+    check_type(np.ndarray, weights)
+    nobs, npat = weights.shape[0], inverse.shape[0]
+    if linkage.shape[0] != max(nobs - 1, 0) or weights.sum() != npat:
+        errmsg = "Mismatching linkage, profiles and patients"
+        exception_handler(ValueError, errmsg, False)
+    expanded = np.empty((npat - 1, 4), dtype=np.float64)
+    representative = np.empty(nobs, dtype=np.int64)  # profile cluster label
+    patients = np.argsort(inverse, kind="stable")  # patients grouped by profile
+    bounds = np.concatenate(([0], np.cumsum(weights)))
+    k = 0
+    for profile in range(nobs):
+        members = patients[bounds[profile] : bounds[profile + 1]]
+        current = members[0]
+        for i, patient in enumerate(members[1:]):
+            expanded[k] = min(current, patient), max(current, patient), 0, i + 2
+            current = npat + k
+            k += 1
+        representative[profile] = current
+    # profiles linkage labels: profiles first, then merged clusters
+    labels = np.concatenate((representative, npat + k + np.arange(nobs - 1)))
+    merged = labels[linkage[:, :2].astype(np.int64)]
+    expanded[k:, 0] = merged.min(axis=1)
+    expanded[k:, 1] = merged.max(axis=1)
+    expanded[k:, 2:] = linkage[:, 2:]
+    return expanded
+
+
+def observation_linkage(linkage: np.ndarray) -> np.ndarray:
+    """Return a copy of a weighted linkage where cluster sizes count the
+    clustered observations (unique profiles) instead of the patients, as
+    expected when plotting the profiles distance matrix.
+    """
+    check_type(np.ndarray, linkage)
+    nobs = linkage.shape[0] + 1
+    sizes = np.concatenate((np.ones(nobs), np.zeros(nobs - 1)))
+    counted = linkage.copy()
+    for k, (a, b) in enumerate(linkage[:, :2].astype(np.int64)):
+        sizes[nobs + k] = sizes[a] + sizes[b]
+    counted[:, 3] = sizes[nobs:]
+    return counted
+
+
+def compute_linkage(
+    dist_mat: np.ndarray, weights: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Average linkage straight from a square or condensed distance matrix
+    (integer matrices store mismatch counts). When weights are given,
+    observations are unique profiles weighted by their multiplicity.
+    """
+    check_type(np.ndarray, dist_mat)
+    if dist_mat.ndim == 2:
+        dist_mat = squareform(dist_mat, checks=False)
+    condensed = np.asarray(as_euclidean(dist_mat), dtype=np.float64)
+    if weights is None:
+        return average_linkage(condensed, method="average")
+    return weighted_average_linkage(condensed, weights)
+
+
+def aggregate_clusters(
+    dist_mat: np.ndarray,
+    linkage: np.ndarray,
+    max_clusters: int,
+    weights: Optional[np.ndarray] = None,
+    block_size: int = AGGREGATION_BLOCK_SIZE,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cut the dendrogram in at most max_clusters clusters and return the
+    average distance between (and within) clusters, the number of
+    patients in each cluster and the cluster of each observation.
+    The distance matrix is read by blocks of rows.
+    """
+    check_type(np.ndarray, dist_mat)
+    check_type(np.ndarray, linkage)
+    check_type(int, max_clusters)
+    if max_clusters < 2:
+        errmsg = f"Forbidden number of clusters ({max_clusters})"
+        exception_handler(ValueError, errmsg, False)
+    nobs = linkage.shape[0] + 1
+    if weights is None:
+        weights = np.ones(nobs, dtype=np.int64)
+    # cluster sizes are irrelevant to the cut, scipy expects observations
+    labels = fcluster(
+        observation_linkage(linkage), t=max_clusters, criterion="maxclust"
+    ) - 1
+    nclusters = int(labels.max()) + 1
+    sizes = np.bincount(labels, weights=weights, minlength=nclusters)
+    # weighted cluster membership, distances are summed per cluster
+    membership = np.zeros((nobs, nclusters), dtype=np.float64)
+    membership[np.arange(nobs), labels] = weights
+    totals = np.zeros((nclusters, nclusters), dtype=np.float64)
+    for start in range(0, nobs, block_size):
+        stop = min(start + block_size, nobs)
+        block = distance_rows(dist_mat, start, stop) @ membership
+        totals += membership[start:stop].T @ block
+    return totals / np.outer(sizes, sizes), sizes, labels
@@ -0,0 +1,118 @@
+"""ContingencyCube class definition.
+The ContingencyCube counts the patients by age group, sex and outcome
+in a single bincount pass over the category codes (see stratify). All
+descriptive plots are drawn from the cube.
+"""
+from utils import exception_handler, check_type
+from categorical import category_codes
+from stratify import joint_counts
+
+from typing import List
+
+import pandas as pd
+import numpy as np
+
+
+AGE_COLUMN = "Age.at.diagnosis"
+SEX_COLUMN = "Sex"
+OUTCOME_COLUMN = "Last.known.patient.status"
+AGE_GROUPS = [
+    "<= 25 years",
+    "26 - 45 years",
+    "46 - 65 years",
+    "66 - 85 years",
+    "> 85 years",
+]
+SEXES = ["Male", "Female"]
+OUTCOMES = ["Recovered", "Dead from COVID-19"]
+
+
+class ContingencyCube:
+    """Patients counts by age group, sex and outcome. Each axis has a
+    trailing slot counting the other (or missing) values, so marginal
+    counts include every patient.
+
+    ...
+
+    Attributes
+    ----------
+    counts : numpy.ndarray
+        Age groups x sexes x outcomes counts array.
+
+    Methods
+    -------
+    from_counts(counts)
+        Restore a cube from its counts array.
+    update(dataset)
+        Add the patients of a dataset (chunk) to the counts.
+    age_counts()
+        Patients by age group.
+    age_sex_counts()
+        Patients by age group and sex.
+    outcome_age_counts()
+        Patients by outcome and age group.
+    outcome_sex_counts()
+        Patients by outcome and sex.
+    """
+
+    _axes = [AGE_GROUPS, SEXES, OUTCOMES]
+    _columns = [AGE_COLUMN, SEX_COLUMN, OUTCOME_COLUMN]
+
+    def __init__(self) -> None:
+        self._counts = np.zeros(
+            [len(labels) + 1 for labels in self._axes], dtype=np.int64
+        )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {self._counts.sum()} patients>"
+
+    @classmethod
+    def from_counts(cls, counts: np.ndarray, debug: bool = False) -> "ContingencyCube":
+        cube = cls()
+        check_type(np.ndarray, counts, debug)
+        if counts.shape != cube.counts.shape:
+            errmsg = f"Forbidden contingency counts shape ({counts.shape})"
+            exception_handler(ValueError, errmsg, debug)
+        cube._counts += counts
+        return cube
+
+    @classmethod
+    def from_dataframe(
+        cls, dataset: pd.DataFrame, debug: bool = False
+    ) -> "ContingencyCube":
+        cube = cls()
+        cube.update(dataset, debug)
+        return cube
+
+    def update(self, dataset: pd.DataFrame, debug: bool = False) -> None:
+        check_type(pd.DataFrame, dataset, debug)
+        missing = set(self._columns) - set(dataset.columns)
+        if missing:
+            errmsg = f"Missing columns: {', '.join(sorted(missing))}"
+            exception_handler(KeyError, errmsg, debug)
+        # unknown values are counted in the last slot
+        codes = []
+        for col, labels in zip(self._columns, self._axes):
+            col_codes, _ = category_codes(dataset[col], labels)
+            codes.append(np.where(col_codes < 0, len(labels), col_codes))
+        self._counts += joint_counts(codes, self._counts.shape)
+
+    def _get_counts(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._counts
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._get_counts()
+
+    def age_counts(self) -> List[int]:
+        return self._counts[: len(AGE_GROUPS)].sum(axis=(1, 2)).tolist()
+
+    def age_sex_counts(self) -> np.ndarray:
+        return self._counts[: len(AGE_GROUPS), : len(SEXES)].sum(axis=2)
+
+    def outcome_age_counts(self) -> np.ndarray:
+        return self._counts[: len(AGE_GROUPS), :, : len(OUTCOMES)].sum(axis=1).T
+
+    def outcome_sex_counts(self) -> np.ndarray:
+        return self._counts[:, : len(SEXES), : len(OUTCOMES)].sum(axis=0).T
@@ -0,0 +1,181 @@
+"""CsvInput class definition.
+The CsvInput validates the dataset file and keeps it open for the
+loaders. The dialect is sniffed and the header checked on the first
+buffered block of the file, which the loaders then consume from the same
+handle: the file is opened and read once per run.
+"""
+from utils import exception_handler, check_type
+
+from typing import Dict, List, Optional, Union
+
+import hashlib
+import csv
+import io
+import os
+
+
+SNIFF_SIZE = 65536  # bytes buffered to sniff the dialect and read the header
+HASH_BLOCK_SIZE = 1 << 20  # bytes hashed at a time
+
+
+class CsvInput:
+    """Validated and open dataset CSV file.
+
+    ...
+
+    Attributes
+    ----------
+    csv_file : str
+        Dataset file.
+    separator : str
+        Fields separator.
+    dialect : csv.Dialect
+        Sniffed CSV dialect.
+    header : List[str]
+        Dataset columns.
+
+    Methods
+    -------
+    open(csv_file, separator, debug)
+        Open and validate a dataset file (None if not a CSV file).
+    sample()
+        First buffered bytes of the file.
+    rewind()
+        Return the file handle, at the beginning of the file.
+    reader_options()
+        pandas reader options matching the sniffed dialect.
+    content_digest()
+        SHA-256 digest of the file content.
+    close()
+        Close the file.
+    """
+
+    def __init__(
+        self,
+        csv_file: str,
+        separator: str,
+        handle: io.BufferedReader,
+        dialect: csv.Dialect,
+        header: List[str],
+    ) -> None:
+        check_type(str, csv_file)
+        check_type(str, separator)
+        check_type(list, header)
+        self._csv_file = csv_file
+        self._separator = separator
+        self._handle = handle
+        self._dialect = dialect
+        self._header = header
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {self._csv_file}, {len(self._header)} columns>"
+
+    def __enter__(self) -> "CsvInput":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @classmethod
+    def open(
+        cls, csv_file: str, separator: str, debug: bool = False
+    ) -> Optional["CsvInput"]:
+        check_type(str, csv_file, debug)
+        check_type(str, separator, debug)
+        if not os.path.isfile(csv_file):
+            errmsg = f"Unable to locate {csv_file}"
+            exception_handler(FileNotFoundError, errmsg, debug)
+        if not separator:
+            errmsg = f"Forbidden separator ({separator})"
+            exception_handler(ValueError, errmsg, debug)
+        # a single read fills the buffer, peeking does not consume it
+        handle = open(csv_file, mode="rb", buffering=SNIFF_SIZE)
+        text = _peek_lines(handle).decode(errors="replace")
+        try:
+            dialect = csv.Sniffer().sniff(text, delimiters=separator)
+        except csv.Error:
+            handle.close()
+            return None  # separator not found consistently, not CSV
+        header = next(csv.reader(io.StringIO(text), dialect), [])
+        if len(header) <= 1:
+            handle.close()
+            return None
+        return cls(csv_file, separator, handle, dialect, header)
+
+    def _get_csv_file(self) -> str:
+        """(PRIVATE)"""
+        return self._csv_file
+
+    @property
+    def csv_file(self) -> str:
+        return self._get_csv_file()
+
+    def _get_separator(self) -> str:
+        """(PRIVATE)"""
+        return self._separator
+
+    @property
+    def separator(self) -> str:
+        return self._get_separator()
+
+    def _get_dialect(self) -> csv.Dialect:
+        """(PRIVATE)"""
+        return self._dialect
+
+    @property
+    def dialect(self) -> csv.Dialect:
+        return self._get_dialect()
+
+    def _get_header(self) -> List[str]:
+        """(PRIVATE)"""
+        return self._header
+
+    @property
+    def header(self) -> List[str]:
+        return self._get_header()
+
+    def sample(self) -> bytes:
+        return _peek_lines(self.rewind())
+
+    def rewind(self) -> io.BufferedReader:
+        # seeking inside the buffered block does not read the file again
+        self._handle.seek(0)
+        return self._handle
+
+    def reader_options(self) -> Dict:
+        # escaping is sniffed on the sample only, pandas defaults are kept
+        return {"sep": self._separator, "quotechar": self._dialect.quotechar}
+
+    def content_digest(self) -> "hashlib._Hash":
+        digest = hashlib.sha256()
+        handle = self.rewind()
+        for block in iter(lambda: handle.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+        self.rewind()
+        return digest
+
+    def close(self) -> None:
+        self._handle.close()
+
+
+def _peek_lines(handle: io.BufferedReader) -> bytes:
+    """(PRIVATE) Complete lines of the buffered block, without consuming it."""
+    sample = handle.peek(SNIFF_SIZE)[:SNIFF_SIZE]
+    if len(sample) == SNIFF_SIZE:  # drop the truncated last line
+        return sample[: sample.rfind(b"\n") + 1] or sample
+    return sample
+
+
+def open_csv_input(
+    csv_file: Union[str, CsvInput], separator: str, debug: bool = False
+) -> CsvInput:
+    """Return the open dataset file, opening and validating csv_file
+    when a path is given.
+    """
+    if isinstance(csv_file, CsvInput):
+        return csv_file
+    csv_input = CsvInput.open(csv_file, separator, debug)
+    if csv_input is None:
+        errmsg = f"{csv_file} does not appear to be a CSV file"
+        exception_handler(ValueError, errmsg, debug)
+    return csv_input
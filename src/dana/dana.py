@@ -4,24 +4,40 @@ functionalities and analyses.
 """
 
 
-from scipy.sparse import data
-from utils import check_type, exception_handler
-from dataset_analyzer import (
-    csv_reader,
-    print_statistics,
-    write_summary_statistics_excel,
-    compute_euclidean_distance,
+from __future__ import annotations
+
+from utils import check_type, exception_handler, PATID_START
+from patient import (
+    build_patients_table,
+    check_patient_rows,
+    lookup_patients,
+    parse_patient_ids,
+    read_patient_ids,
+)
+from row_index import load_row_index, RowIndex
+from csv_input import CsvInput, open_csv_input
+from instrumentation import StageProfiler
+from similarity import SIMILAR_PATIENTS
+from imputation import IMPUTE_NEIGHBORS
+from plot_data import (
+    generate_plots,
+    plot_age_data,
+    plot_recovery_data,
+    MAX_CLUSTERMAP_LEAVES,
 )
-from patient import build_patients_dict, build_patients_ds
-from plot_data import generate_plots
 
 from argparse import Namespace
+from typing import Iterator, List, Optional, Union, TYPE_CHECKING
 
-import pandas as pd
+import numpy as np
 
 import time
+import sys
 import os
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 __version__ = "0.0.1"
 
@@ -47,38 +63,537 @@ def dana(
     # start analysis
     dana_start = time.time()
     print_welcome(commandline_args, debug, verbose)
-    df = csv_reader(dataset, separator, {})
-    if func == "analyze":
-        dana_analyze(df, commandline_args.out, debug, verbose)
-    elif func == "introduce":
-        dana_introduce(df, commandline_args.pid, verbose, debug)
+    # stages are measured only when a run report is requested
+    profile_report = getattr(commandline_args, "profile_report", None)
+    profile_summary = getattr(commandline_args, "profile_summary", False)
+    profile_allocations = getattr(commandline_args, "profile_allocations", False)
+    profiler = StageProfiler(
+        profile_report is not None or profile_summary or profile_allocations,
+        profile_allocations,
+    )
+    profiler.set_metadata(dana_version=__version__, function=func, dataset=dataset)
+    # the dataset validated on input is read through its open handle
+    csv_input = getattr(commandline_args, "csv_input", None)
+    if csv_input is None:
+        csv_input = open_csv_input(dataset, separator, debug)
+    max_memory = getattr(commandline_args, "max_memory", None)
+    cache_dir = getattr(commandline_args, "cache_dir", None)
+    report_format = getattr(commandline_args, "report_format", "xlsx")
+    state_dir = getattr(commandline_args, "state_dir", None)
+    impute = getattr(commandline_args, "impute", None)
+    neighbors = getattr(commandline_args, "neighbors", IMPUTE_NEIGHBORS)
+    approximate = getattr(commandline_args, "approximate", False)
+    index = None
+    if func == "introduce":  # read only the requested records, when possible
+        pids = introduce_patient_ids(commandline_args, debug)
+        with profiler.stage("index"):  # stored only with --cache-dir
+            index = load_row_index(csv_input, separator, cache_dir, debug)
+    if index is not None:
+        dana_introduce_indexed(
+            index, pids, commandline_args.out, verbose, debug, profiler
+        )
+    elif func == "analyze" and state_dir is not None:
+        # analyze only the rows appended since the previous run
+        dana_analyze_incremental(
+            csv_input,
+            state_dir,
+            commandline_args.out,
+            debug,
+            verbose,
+            threads=getattr(commandline_args, "threads", 1),
+            dist_dtype=getattr(commandline_args, "dist_dtype", "float64"),
+            dedup=getattr(commandline_args, "dedup", False),
+            max_leaves=getattr(commandline_args, "max_leaves", MAX_CLUSTERMAP_LEAVES),
+            plot_jobs=getattr(commandline_args, "plot_jobs", 1),
+            profiler=profiler,
+            report_format=report_format,
+        )
+    elif func == "stratify":
+        dana_stratify(
+            csv_input,
+            separator,
+            commandline_args.by,
+            commandline_args.out,
+            verbose,
+            debug,
+            within=getattr(commandline_args, "within", None),
+            dropna=getattr(commandline_args, "dropna", False),
+            max_memory=max_memory,
+            cache_dir=cache_dir,
+            profiler=profiler,
+        )
+    elif func == "similar":
+        dana_similar(
+            csv_input,
+            separator,
+            commandline_args,
+            commandline_args.out,
+            verbose,
+            debug,
+            k=getattr(commandline_args, "top", SIMILAR_PATIENTS),
+            max_memory=max_memory,
+            cache_dir=cache_dir,  # index stored only with --cache-dir
+            profiler=profiler,
+        )
+    elif func == "preprocess":
+        dana_preprocess(
+            csv_input,
+            separator,
+            getattr(commandline_args, "rules_file", None),
+            commandline_args.out,
+            verbose,
+            debug,
+            cache_dir=cache_dir,
+            profiler=profiler,
+            impute=impute,
+            neighbors=neighbors,
+            approximate=approximate,
+            threads=getattr(commandline_args, "threads", 1),
+        )
+    elif func == "analyze" and max_memory is not None:
+        # out-of-core analysis, the dataset is never loaded as a whole
+        dana_analyze_streaming(
+            csv_input,
+            separator,
+            max_memory,
+            commandline_args.out,
+            debug,
+            verbose,
+            profiler,
+            report_format,
+        )
+    else:
+        # the dataset analysis stack (pandas) is loaded only when needed
+        from dataset_analyzer import csv_reader
+
+        categorical = getattr(commandline_args, "categorical", False)
+        with profiler.stage("read"):
+            df = csv_reader(csv_input, separator, debug, cache_dir, categorical)
+        if func == "analyze":
+            dana_analyze(
+                df,
+                commandline_args.out,
+                debug,
+                verbose,
+                threads=getattr(commandline_args, "threads", 1),
+                dist_dtype=getattr(commandline_args, "dist_dtype", "float64"),
+                condensed=getattr(commandline_args, "condensed", False),
+                distfile=getattr(commandline_args, "dist_file", None),
+                dedup=getattr(commandline_args, "dedup", False),
+                max_leaves=getattr(
+                    commandline_args, "max_leaves", MAX_CLUSTERMAP_LEAVES
+                ),
+                plot_jobs=getattr(commandline_args, "plot_jobs", 1),
+                profiler=profiler,
+                report_format=report_format,
+                impute=impute,
+                neighbors=neighbors,
+                approximate=approximate,
+            )
+        elif func == "introduce":
+            dana_introduce(df, pids, commandline_args.out, verbose, debug, profiler)
+    csv_input.close()
+    if profile_report is not None:
+        profiler.write_report(profile_report, debug)
+    if profile_summary:
+        print(profiler.summary())
 
     dana_stop = time.time()
     print_close(dana_start, dana_stop, debug)
 
 
 def dana_analyze(
-    dataset: pd.DataFrame, outdir: str, debug: bool, verbose: bool
+    dataset: pd.DataFrame,
+    outdir: str,
+    debug: bool,
+    verbose: bool,
+    threads: int = 1,
+    dist_dtype: str = "float64",
+    condensed: bool = False,
+    distfile: Optional[str] = None,
+    dedup: bool = False,
+    max_leaves: int = MAX_CLUSTERMAP_LEAVES,
+    plot_jobs: int = 1,
+    profiler: Optional[StageProfiler] = None,
+    report_format: str = "xlsx",
+    impute: Optional[str] = None,
+    neighbors: int = IMPUTE_NEIGHBORS,
+    approximate: bool = False,
+) -> None:
+    from dataset_analyzer import (
+        compute_dataset_profile,
+        print_statistics,
+        write_summary_statistics,
+        compute_euclidean_distance,
+        compute_profiles_distance,
+    )
+
+    # profile the dataset once, the statistics are shared by reporting stages
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    with profiler.stage("profile"):
+        profile = compute_dataset_profile(dataset, debug, verbose)
+        print_statistics(profile, debug, verbose)  # print dataset summary statistics
+    with profiler.stage("report"):
+        write_summary_statistics(
+            profile, outdir, report_format, debug, verbose
+        )  # write summary statistics report
+    patients = dataset  # statistics and plots describe the raw dataset
+    if impute is not None:  # incomplete patients are kept in the distances
+        from imputation import impute_dataset
+
+        with profiler.stage("impute"):
+            patients = impute_dataset(
+                dataset, impute, neighbors, approximate, threads, debug, verbose
+            )
+    weights = None
+    with profiler.stage("distance"):
+        if dedup:  # distances between unique patient profiles
+            profiles, dist_mat = compute_profiles_distance(
+                patients,
+                debug,
+                verbose,
+                dtype=dist_dtype,
+                condensed=condensed,
+                threads=threads,
+                distfile=distfile,
+            )
+            weights = profiles.weights
+        else:
+            dist_mat = compute_euclidean_distance(
+                patients,
+                debug,
+                verbose,
+                dtype=dist_dtype,
+                condensed=condensed,
+                threads=threads,
+                distfile=distfile,
+            )  # compute euclidean distance between patients
+    generate_plots(
+        dataset,
+        dist_mat,
+        outdir,
+        debug,
+        verbose,
+        weights,
+        max_leaves,
+        plot_jobs,
+        profiler,
+    )
+
+
+def dana_analyze_streaming(
+    dataset: Union[str, CsvInput],
+    separator: str,
+    max_memory: int,
+    outdir: str,
+    debug: bool,
+    verbose: bool,
+    profiler: Optional[StageProfiler] = None,
+    report_format: str = "xlsx",
+) -> None:
+    from dataset_analyzer import (
+        stream_dataset_profile,
+        print_statistics,
+        write_summary_statistics,
+    )
+    from contingency import ContingencyCube
+
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    # statistics and plots counts are computed chunk by chunk and merged
+    cube = ContingencyCube()
+    with profiler.stage("read_profile"):  # reading and profiling overlap
+        profile = stream_dataset_profile(
+            dataset, separator, max_memory, debug, verbose, cube
+        )
+        print_statistics(profile, debug, verbose)  # print dataset summary statistics
+    with profiler.stage("report"):
+        write_summary_statistics(
+            profile, outdir, report_format, debug, verbose
+        )  # write summary statistics report
+    with profiler.stage("plot_age"):
+        plot_age_data(cube, outdir, debug, verbose)
+    with profiler.stage("plot_recovery"):
+        plot_recovery_data(cube, outdir, debug, verbose)
+    # the distance matrix is quadratic in the number of patients
+    print("Streaming mode: skipping patients distance computation and clustering")
+
+
+def dana_analyze_incremental(
+    dataset: CsvInput,
+    state_dir: str,
+    outdir: str,
+    debug: bool,
+    verbose: bool,
+    threads: int = 1,
+    dist_dtype: str = "float64",
+    dedup: bool = False,
+    max_leaves: int = MAX_CLUSTERMAP_LEAVES,
+    plot_jobs: int = 1,
+    profiler: Optional[StageProfiler] = None,
+    report_format: str = "xlsx",
+) -> None:
+    from dataset_analyzer import print_statistics, write_summary_statistics
+    from incremental import load_analysis_state, read_appended_rows
+
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    # only the rows appended since the stored analysis are read
+    with profiler.stage("state"):
+        state = load_analysis_state(
+            state_dir, dataset, dist_dtype, dedup, debug, verbose
+        )
+    with profiler.stage("read"):
+        rows, size = read_appended_rows(dataset, state.size, debug)
+        if verbose:
+            print(f"{rows.shape[0]} new rows to analyze")
+    with profiler.stage("update"):
+        state.update(rows, size, threads, debug, verbose)
+        if state.profile is None:
+            errmsg = f"Empty dataset {dataset.csv_file}; unable to analyze it"
+            exception_handler(ValueError, errmsg, debug)
+        profile = state.profile.infer_column_types()
+        print_statistics(profile, debug, verbose)  # print dataset summary statistics
+        state.save(dataset, debug)
+    with profiler.stage("report"):
+        write_summary_statistics(
+            profile, outdir, report_format, debug, verbose
+        )  # write summary statistics report
+    generate_plots(
+        state.cube,
+        state.dist_mat,
+        outdir,
+        debug,
+        verbose,
+        state.weights,
+        max_leaves,
+        plot_jobs,
+        profiler,
+    )
+
+
+def dana_stratify(
+    dataset: CsvInput,
+    separator: str,
+    columns: List[str],
+    outfile: Optional[str],
+    verbose: bool,
+    debug: bool,
+    within: Optional[List[str]] = None,
+    dropna: bool = False,
+    max_memory: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    profiler: Optional[StageProfiler] = None,
 ) -> None:
-    print_statistics(dataset, debug, verbose)  # print dataset summary statistics
-    write_summary_statistics_excel(
-        dataset, outdir, debug, verbose
-    )  # write excel file with summary statistics
-    dist_mat = compute_euclidean_distance(
-        dataset, debug, verbose
-    )  # compute euclidean distance between patients
-    generate_plots(dataset, dist_mat, outdir, debug, verbose)
+    from dataset_analyzer import csv_reader, csv_chunk_reader
+    from stratify import StratifiedCounts
 
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    # only the stratifying columns are parsed
+    with profiler.stage("stratify"):
+        if max_memory is None:
+            chunks = [
+                csv_reader(dataset, separator, debug, cache_dir, usecols=columns)
+            ]
+        else:  # chunks are read as raw strings, typed alike
+            chunks = csv_chunk_reader(
+                dataset, separator, max_memory, debug, usecols=columns, dtype=str
+            )
+        counts = StratifiedCounts.empty(list(columns))
+        for chunk in chunks:
+            counts.update(chunk, debug)
+    table = counts.to_frame(within, dropna)
+    if outfile is not None:
+        try:
+            table.to_csv(outfile, index=False)
+        except OSError as e:
+            errmsg = f"An error occurred while writing the stratified counts to {outfile}"
+            exception_handler(e.__class__, errmsg, debug)
+        if verbose:
+            print(f"Stratified counts written to {outfile}")
+        return
+    print(f"Patients by {' x '.join(columns)} ({counts.total} rows):")
+    print(table.to_string(index=False))
+    if len(columns) > 1:  # one-way marginals
+        for col in columns:
+            print(f"\nPatients by {col}:")
+            print(counts.marginal([col]).to_frame(dropna=dropna).to_string(index=False))
 
-def dana_introduce(dataset: pd.DataFrame, pid: int, verbose: bool, debug: bool) -> None:
+
+def dana_similar(
+    dataset: CsvInput,
+    separator: str,
+    commandline_args: Namespace,
+    outfile: Optional[str],
+    verbose: bool,
+    debug: bool,
+    k: int = SIMILAR_PATIENTS,
+    max_memory: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    profiler: Optional[StageProfiler] = None,
+) -> None:
+    from similarity import load_similarity_index, read_query_rows
+
+    import pandas as pd
+
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    with profiler.stage("index"):
+        index = load_similarity_index(
+            dataset, separator, cache_dir, max_memory, debug, verbose
+        )
+    query_file = getattr(commandline_args, "query_file", None)
+    with profiler.stage("similar"):
+        if query_file is not None:  # compared on the query file columns
+            rows = read_query_rows(query_file, separator, debug)
+            query = index.encode(rows, debug)
+            exclude, mask = None, index.mask(rows.columns.tolist())
+            queries = pd.Series(np.arange(1, query.shape[0] + 1), name="query_row")
+        else:  # indexed patients, never similar to themselves
+            pids = introduce_patient_ids(commandline_args, debug)
+            rows = index.rows(pids)
+            check_patient_rows(pids, rows, debug)
+            pids, rows = pids[rows >= 0], rows[rows >= 0]
+            query, exclude, mask = index.profiles(rows), rows, None
+            queries = pd.Series(pids, name="query_pid")
+        nearest, distances = index.nearest(query, k, exclude, mask)
+    # Euclidean distances between the one-hot encoded patients
+    table = pd.DataFrame(
+        {
+            queries.name: np.repeat(queries.to_numpy(), nearest.shape[1]),
+            "rank": np.tile(np.arange(1, nearest.shape[1] + 1), nearest.shape[0]),
+            "pid": nearest.ravel() + PATID_START,
+            "distance": np.round(np.sqrt(distances.ravel()), 4),
+        }
+    )
+    if outfile is not None:
+        try:
+            table.to_csv(outfile, index=False)
+        except OSError as e:
+            errmsg = f"An error occurred while writing the similar patients to {outfile}"
+            exception_handler(e.__class__, errmsg, debug)
+        if verbose:
+            print(f"Similar patients written to {outfile}")
+        return
+    print(f"Patients most similar to {queries.shape[0]} queries ({len(index)} patients):")
+    print(table.to_string(index=False))
+
+
+def dana_preprocess(
+    dataset: CsvInput,
+    separator: str,
+    rules_file: Optional[str],
+    outfile: str,
+    verbose: bool,
+    debug: bool,
+    cache_dir: Optional[str] = None,
+    profiler: Optional[StageProfiler] = None,
+    impute: Optional[str] = None,
+    neighbors: int = IMPUTE_NEIGHBORS,
+    approximate: bool = False,
+    threads: int = 1,
+) -> None:
+    from dataset_analyzer import csv_reader
+    from preprocess import PreprocessRules, preprocess_dataset
+
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    # without rules, column types are inferred
+    if rules_file is None:
+        rules = PreprocessRules.from_dict({}, debug)
+    else:
+        rules = PreprocessRules.load(rules_file, debug)
+    with profiler.stage("read"):  # values are parsed by the rules
+        df = csv_reader(dataset, separator, debug, cache_dir, dtype=str)
+    with profiler.stage("preprocess"):
+        df = preprocess_dataset(df, rules, debug, verbose)
+    if impute is not None:  # after the rules, on the typed values
+        from imputation import impute_dataset
+
+        with profiler.stage("impute"):
+            df = impute_dataset(
+                df, impute, neighbors, approximate, threads, debug, verbose
+            )
+    # same separator as the raw dataset, read as is by the analysis
+    with profiler.stage("write"):
+        try:
+            df.to_csv(outfile, sep=separator, index=False)
+        except OSError as e:
+            errmsg = f"An error occurred while writing the preprocessed dataset to {outfile}"
+            exception_handler(e.__class__, errmsg, debug)
+    print(f"Preprocessed dataset ({df.shape[0]} rows, {df.shape[1]} columns) written to {outfile}")
+
+
+def introduce_patient_ids(commandline_args: Namespace, debug: bool) -> np.ndarray:
+    # IDs and ID ranges given on command line and in the IDs file
+    pids = list(getattr(commandline_args, "pid", None) or [])
+    pid_file = getattr(commandline_args, "pid_file", None)
+    if pid_file is not None:
+        pids += read_patient_ids(pid_file, debug)
+    return parse_patient_ids(pids, debug)
+
+
+def dana_introduce(
+    dataset: pd.DataFrame,
+    pids: np.ndarray,
+    outfile: Optional[str],
+    verbose: bool,
+    debug: bool,
+    profiler: Optional[StageProfiler] = None,
+) -> None:
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    with profiler.stage("patients"):
+        try:
+            pats = build_patients_table(dataset, verbose, debug)
+        except ValueError as e:
+            errmsg = "An error occurred while building the patients table"
+            exception_handler(e, errmsg, debug)
+    with profiler.stage("lookup"):
+        rows = pats.rows(pids)  # all patients looked up at once
+        check_patient_rows(pids, rows, debug)
+        write_patient_cards(pats.cards(rows[rows >= 0]), outfile, verbose, debug)
+
+
+def dana_introduce_indexed(
+    index: RowIndex,
+    pids: np.ndarray,
+    outfile: Optional[str],
+    verbose: bool,
+    debug: bool,
+    profiler: Optional[StageProfiler] = None,
+) -> None:
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    if verbose:
+        print(f"Reading {pids.shape[0]} patients from the dataset row index")
+    with profiler.stage("lookup"):
+        rows = index.rows(pids)
+        check_patient_rows(pids, rows, debug)
+        cards = lookup_patients(index, rows[rows >= 0])
+        write_patient_cards(cards, outfile, verbose, debug)
+
+
+def write_patient_cards(
+    cards: Iterator[str], outfile: Optional[str], verbose: bool, debug: bool
+) -> None:
+    # records are written as soon as each batch is formatted
+    if outfile is None:
+        for batch in cards:
+            sys.stdout.write(batch)
+        return
+    check_type(str, outfile, debug)
     try:
-        pats_dict = build_patients_dict(dataset, verbose, debug)
-        pats = build_patients_ds(dataset, verbose, debug)
-    except ValueError as e:
-        errmsg = "An error occurred while building the patients dictionary"
-        exception_handler(e, errmsg, debug)
-    print(pats_dict[pid])
-    print(pats[pid])
+        with open(outfile, mode="w") as outstream:
+            for batch in cards:
+                outstream.write(batch)
+    except OSError as e:
+        errmsg = f"An error occurred while writing patient records to {outfile}"
+        exception_handler(e.__class__, errmsg, debug)
+    if verbose:
+        print(f"Patient records written to {outfile}")
 
 
 def print_welcome(
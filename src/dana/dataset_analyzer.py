@@ -1,37 +1,102 @@
 """DANA analysis core functions.
+Clustering, machine learning and report writing libraries are imported
+by the functions using them.
 """
+from __future__ import annotations
+
 from utils import exception_handler, check_type
+from dataset_profile import DatasetProfile, count_values
+from parse_cache import compute_cache_key, load_cached_dataset, store_cached_dataset
+from csv_input import CsvInput, open_csv_input
+from summary_report import write_summary_report
+from categorical import to_categorical, onehot_encode
+from distance import (
+    encode_dataset,
+    blocked_distances,
+    load_distances,
+    save_distance_metadata,
+)
 
-from sklearn.metrics.pairwise import euclidean_distances
-from sklearn.preprocessing import OneHotEncoder
-from xlsxwriter.worksheet import Worksheet
-from xlsxwriter.workbook import Workbook
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, Optional, Tuple, Union, TYPE_CHECKING
 from numpy import ndarray
 
 import pandas as pd
-import numpy as np
 
-import string
-import os
+import io
+
+if TYPE_CHECKING:
+    from clustering import PatientProfiles
+    from contingency import ContingencyCube
+
+
+CHUNK_SAMPLE_ROWS = 1000  # rows read to estimate the in-memory size of a row
+CHUNK_MEMORY_FRACTION = 0.25  # memory budget share reserved to a single chunk
 
 
 def csv_reader(
-    csv_file: str, separator: str, debug: bool, **kwargs: Dict
+    csv_file: Union[str, CsvInput],
+    separator: str,
+    debug: bool,
+    cache_dir: Optional[str] = None,
+    categorical: bool = False,
+    **kwargs: Dict,
 ) -> pd.DataFrame:
-    check_type(str, csv_file, debug)
-    if not os.path.isfile(csv_file):
-        errmsg = f"Unable to locate {csv_file}"
-        exception_handler(FileNotFoundError, errmsg, debug)
-    check_type(str, separator, debug)
-    if not separator:
-        errmsg = f"Forbidden separator ({separator})"
-        exception_handler(ValueError, errmsg, debug)
-    df = pd.read_csv(csv_file, sep=separator, **kwargs)
+    # the file validated on input is parsed from its open handle
+    csv_input = open_csv_input(csv_file, separator, debug)
+    if cache_dir is not None:  # look for an already parsed copy
+        key = compute_cache_key(csv_input, separator, kwargs, debug)
+        df = load_cached_dataset(cache_dir, key, debug, categorical)
+        if df is not None:
+            return df
+    df = pd.read_csv(csv_input.rewind(), **csv_input.reader_options(), **kwargs)
     assert not df.empty  # check that dataframe is not empty
+    if cache_dir is not None:
+        store_cached_dataset(df, cache_dir, key, csv_input.csv_file, debug)
+    if categorical:  # store text columns as category codes
+        df = to_categorical(df, debug)
     return df
 
 
+def compute_chunksize(
+    csv_input: CsvInput, max_memory: int, debug: bool, **kwargs: Dict
+) -> int:
+    check_type(int, max_memory, debug)
+    if max_memory <= 0:
+        errmsg = f"Forbidden memory limit ({max_memory} MB)"
+        exception_handler(ValueError, errmsg, debug)
+    # estimate the in-memory size of a row on the first rows of the file;
+    # the parser needs some extra room on top of the parsed chunk
+    sample = pd.read_csv(
+        io.BytesIO(csv_input.sample()),
+        nrows=CHUNK_SAMPLE_ROWS,
+        **csv_input.reader_options(),
+        **kwargs,
+    )
+    assert not sample.empty
+    row_size = sample.memory_usage(index=True, deep=True).sum() / sample.shape[0]
+    budget = max_memory * 1024 * 1024 * CHUNK_MEMORY_FRACTION
+    return max(1, int(budget / row_size))
+
+
+def csv_chunk_reader(
+    csv_file: Union[str, CsvInput],
+    separator: str,
+    max_memory: int,
+    debug: bool,
+    **kwargs: Dict,
+) -> Iterator[pd.DataFrame]:
+    csv_input = open_csv_input(csv_file, separator, debug)
+    chunksize = compute_chunksize(csv_input, max_memory, debug, **kwargs)
+    with pd.read_csv(
+        csv_input.rewind(),
+        chunksize=chunksize,
+        **csv_input.reader_options(),
+        **kwargs,
+    ) as reader:
+        for chunk in reader:
+            yield chunk
+
+
 def compute_shape(
     dataset: pd.DataFrame, debug: bool = False, verbose: bool = False
 ) -> Tuple[int, int]:
@@ -62,43 +127,69 @@ def compute_column_type(
     return column_types
 
 
-def compute_count_stats(
-    dataset: pd.DataFrame, debug: bool, verbose: bool
-) -> Dict[str, Dict[str, str]]:
+def compute_dataset_profile(
+    dataset: pd.DataFrame, debug: bool = False, verbose: bool = False
+) -> DatasetProfile:
     check_type(pd.DataFrame, dataset, debug)
     if dataset.empty:
         errmsg = f"Empty {pd.DataFrame.__name__} object; unable to print statistics"
         exception_handler(ValueError, errmsg, debug)
     column_types = compute_column_type(dataset, debug, verbose)
-    cols = dataset.columns.tolist()
-    columns_stats = {}  # dictionary with columns statistics
-    for col in cols:
-        counts = dataset[col].value_counts().to_dict()
-        indexes = list(counts.keys())
-        values = np.array(list(counts.values()))
-        unique_vals_num = len(indexes)
-        most_freq_val = indexes[int(np.where(values == values.max())[0])]
-        less_freq_val = indexes[int(np.where(values == values.min())[0])]
-        columns_stats[col] = {
-            "type": column_types[col],
-            "index": indexes,
-            "counts": ["%.2f%%" % (val * 100) for val in (values / values.sum())],
-            "values_num": unique_vals_num,
-            "most_freq": most_freq_val,
-            "less_freq": less_freq_val,
-        }
-        assert len(columns_stats[col]["index"]) == len(columns_stats[col]["counts"])
-    return columns_stats
-
-
-def print_statistics(dataset: pd.DataFrame, debug: bool, verbose: bool) -> None:
-    check_type(pd.DataFrame, dataset, debug)
-    if dataset.empty:
-        errmsg = f"Empty {pd.DataFrame.__name__} object; unable to print statistics"
-        exception_handler(ValueError, errmsg, debug)
-    dims = compute_shape(dataset, debug, verbose)
+    counts = {col: count_values(dataset[col]) for col in dataset.columns}
+    return DatasetProfile(dataset.shape[0], column_types, counts)
+
+
+def stream_dataset_profile(
+    csv_file: Union[str, CsvInput],
+    separator: str,
+    max_memory: int,
+    debug: bool = False,
+    verbose: bool = False,
+    cube: Optional[ContingencyCube] = None,
+    **kwargs: Dict,
+) -> DatasetProfile:
+    # chunks are read as raw strings, otherwise the same column may be
+    # typed differently across chunks; types are recovered once at the end
+    kwargs["dtype"] = str
+    profile = None
+    for i, chunk in enumerate(
+        csv_chunk_reader(csv_file, separator, max_memory, debug, **kwargs)
+    ):
+        if verbose:
+            print(f"Profiling chunk {i + 1} ({chunk.shape[0]} rows)")
+        chunk_profile = compute_dataset_profile(chunk, debug, verbose)
+        if cube is not None:  # descriptive plots counts, in the same pass
+            cube.update(chunk, debug)
+        profile = chunk_profile if profile is None else profile.merge(chunk_profile)
+    assert profile is not None  # check that dataset is not empty
+    return profile.infer_column_types()
+
+
+def get_dataset_profile(
+    dataset: Union[pd.DataFrame, DatasetProfile],
+    debug: bool = False,
+    verbose: bool = False,
+) -> DatasetProfile:
+    # reuse the profile when already available
+    if isinstance(dataset, DatasetProfile):
+        return dataset
+    return compute_dataset_profile(dataset, debug, verbose)
+
+
+def compute_count_stats(
+    dataset: Union[pd.DataFrame, DatasetProfile], debug: bool, verbose: bool
+) -> Dict[str, Dict[str, str]]:
+    profile = get_dataset_profile(dataset, debug, verbose)
+    return profile.to_count_stats()
+
+
+def print_statistics(
+    dataset: Union[pd.DataFrame, DatasetProfile], debug: bool, verbose: bool
+) -> None:
+    profile = get_dataset_profile(dataset, debug, verbose)
+    dims = profile.shape
     print(f"There are {dims[0]} rows and {dims[1]} columns.")
-    columns_stat = compute_count_stats(dataset, debug, verbose)
+    columns_stat = profile.to_count_stats()
     for col in columns_stat.keys():
         print(
             str(
@@ -113,102 +204,60 @@ def print_statistics(dataset: pd.DataFrame, debug: bool, verbose: bool) -> None:
             print(f"\t\t- {idx}: {values[i]}")
 
 
-def format_excel_column(
-    df: pd.DataFrame,
-    workbook: Workbook,
-    worksheet: Worksheet,
-    columns: List[str],
-    colors: Dict[str, str],
-    col_type: str,
-    excel_headers: Dict[int, str],
+def write_summary_statistics(
+    dataset: Union[pd.DataFrame, DatasetProfile],
+    outdir: str,
+    report_format: str = "xlsx",
     debug: bool = False,
     verbose: bool = False,
-) -> None:
-    check_type(pd.DataFrame, df, debug)
-    if df.empty:
-        errmsg = f"Empty {pd.DataFrame.__name__} object; unable to write statistics"
-        exception_handler(ValueError, errmsg, debug)
-    check_type(Workbook, workbook, debug)
-    check_type(Worksheet, worksheet, debug)
-    check_type(list, columns, debug)
-    check_type(dict, colors, debug)
-    check_type(str, col_type, debug)
-    check_type(dict, excel_headers, debug)
-    try:
-        color = colors[col_type]
-    except IndexError as e:
-        errmsg = f"Unrecognized column type to color ({col_type})"
-        exception_handler(e, errmsg, debug)
-    for col in columns:
-        frmt = workbook.add_format({"bg_color": color})
-        excel_header = str(excel_headers[df.columns.get_loc(col)])
-        worksheet.conditional_format(
-            excel_header + "2:" + excel_header + str(df.shape[0] + 1),
-            {"type": "no_blanks", "format": frmt},
-        )
+) -> str:
+    check_type(str, outdir, debug)
+    profile = get_dataset_profile(dataset, debug, verbose)
+    return write_summary_report(profile, outdir, report_format, debug, verbose)
 
 
 def write_summary_statistics_excel(
-    dataset: pd.DataFrame, outdir: str, debug: bool = False, verbose: bool = False
+    dataset: Union[pd.DataFrame, DatasetProfile],
+    outdir: str,
+    debug: bool = False,
+    verbose: bool = False,
 ) -> None:
-    check_type(pd.DataFrame, dataset, debug)
-    if dataset.empty:
-        errmsg = f"Empty {pd.DataFrame.__name__} object; unable to write statistics"
-        exception_handler(ValueError, errmsg, debug)
-    check_type(str, outdir, debug)
-    columns_stats = compute_count_stats(dataset, debug, verbose)
-    df = {}
-    for col in columns_stats.keys():
-        df[col] = {
-            "var_type": columns_stats[col]["type"],
-            "values_number": columns_stats[col]["values_num"],
-            "most_frequent_value": columns_stats[col]["most_freq"],
-            "less_frequent_value": columns_stats[col]["less_freq"],
-        }
-    df = pd.DataFrame(df)
-    # write excel report
-    outfile = os.path.join(outdir, "summary.xlsx")
-    writer = pd.ExcelWriter(outfile, engine="xlsxwriter")
-    df.to_excel(writer, sheet_name="Sheet1")
-    workbook = writer.book
-    worksheet = writer.sheets["Sheet1"]
-    # color columns according to variable type
-    excel_header_dict = dict(
-        zip(range(25), list(string.ascii_uppercase)[1:])
-    )  # skip column 'A' (index col)
-    # recover numerical and categorical columns
-    df_t = df.T
-    cat_cols = df_t[df_t.var_type == "categorical"].index.tolist()
-    num_cols = df_t[df_t.var_type == "numerical"].index.tolist()
-    colors = {"categorical": "#68AB25", "numerical": "#9F25AB"}  # columns' colors
-    # format categorical columns
-    format_excel_column(
-        df,
-        workbook,
-        worksheet,
-        cat_cols,
-        colors,
-        "categorical",
-        excel_header_dict,
-        debug,
-        verbose,
-    )
-    # format numerical columns
-    format_excel_column(
-        df,
-        workbook,
-        worksheet,
-        num_cols,
-        colors,
-        "numerical",
-        excel_header_dict,
-        debug,
-    )
-    writer.save()
+    write_summary_statistics(dataset, outdir, "xlsx", debug, verbose)
+
+
+def codes_distance(
+    codes: ndarray,
+    dtype: str,
+    condensed: bool,
+    threads: int,
+    distfile: Optional[str],
+    verbose: bool,
+) -> ndarray:
+    if distfile is not None:  # reuse the matrix computed by a previous run
+        stored = load_distances(distfile, codes)
+        if (
+            stored is not None
+            and stored[1]["condensed"] == condensed
+            and stored[0].dtype == dtype
+        ):
+            if verbose:
+                print(f"Loading distance matrix from {distfile}")
+            return stored[0]
+    dist_mat = blocked_distances(codes, dtype, condensed, threads, distfile)
+    if distfile is not None:
+        save_distance_metadata(distfile, codes, condensed)
+    return dist_mat
 
 
 def compute_euclidean_distance(
-    dataset: pd.DataFrame, debug: bool, verbose: bool
+    dataset: pd.DataFrame,
+    debug: bool,
+    verbose: bool,
+    engine: str = "codes",
+    dtype: str = "float64",
+    condensed: bool = False,
+    threads: int = 1,
+    distfile: Optional[str] = None,
 ) -> ndarray:
     check_type(pd.DataFrame, dataset, debug)
     if dataset.empty:
@@ -217,8 +266,46 @@ def compute_euclidean_distance(
     # handle na values presence in the dataset
     if any(dataset.isnull().any().tolist()):
         dataset = dataset.dropna()  # remove rows with na values
-    enc = OneHotEncoder(handle_unknown="ignore")
-    enc.fit(dataset)
-    ohc_data = enc.transform(dataset).toarray()
+    check_type(str, engine, debug)
+    if engine == "codes":  # mismatching columns counted on category codes
+        codes = encode_dataset(dataset, debug)
+        return codes_distance(codes, dtype, condensed, threads, distfile, verbose)
+    if engine != "onehot":
+        errmsg = f"Unknown distance engine ({engine})"
+        exception_handler(ValueError, errmsg, debug)
+    if dtype != "float64" or condensed or distfile is not None:
+        errmsg = f"Distance matrix options not supported by {engine} engine"
+        exception_handler(ValueError, errmsg, debug)
+    from sklearn.metrics.pairwise import euclidean_distances
+
+    ohc_data = onehot_encode(dataset, debug).toarray()
     dist_mat = euclidean_distances(ohc_data)
     return dist_mat
+
+
+def compute_profiles_distance(
+    dataset: pd.DataFrame,
+    debug: bool,
+    verbose: bool,
+    dtype: str = "float64",
+    condensed: bool = False,
+    threads: int = 1,
+    distfile: Optional[str] = None,
+) -> Tuple[PatientProfiles, ndarray]:
+    check_type(pd.DataFrame, dataset, debug)
+    if dataset.empty:
+        errmsg = f"Empty {pd.DataFrame.__name__} object; unable to write statistics"
+        exception_handler(ValueError, errmsg, debug)
+    # handle na values presence in the dataset
+    if any(dataset.isnull().any().tolist()):
+        dataset = dataset.dropna()  # remove rows with na values
+    from clustering import PatientProfiles
+
+    # identical patients are collapsed into weighted unique profiles
+    profiles = PatientProfiles(encode_dataset(dataset, debug))
+    if verbose:
+        print(f"{len(profiles)} unique profiles out of {dataset.shape[0]} patients")
+    dist_mat = codes_distance(
+        profiles.codes, dtype, condensed, threads, distfile, verbose
+    )
+    return profiles, dist_mat
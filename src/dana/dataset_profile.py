@@ -0,0 +1,231 @@
+"""DatasetProfile class definition.
+The DatasetProfile collects, in a single pass over the dataset,
+the summary statistics shared by all DANA reporting stages.
+"""
+from utils import exception_handler, check_type
+
+from typing import Dict, List, Optional
+
+import pandas as pd
+import numpy as np
+
+
+class DatasetProfile:
+    """Summary statistics of a dataset (column types, value counts,
+    cardinality, most and less frequent values). The profile is
+    computed once and reused by every reporting stage.
+
+    ...
+
+    Attributes
+    ----------
+    shape : Tuple[int, int]
+        Number of rows and columns of the profiled dataset.
+    columns : List[str]
+        Dataset columns, in their original order.
+    column_types : Dict[str, str]
+        Variable type ("numerical" or "categorical") of each column.
+
+    Methods
+    -------
+    value_counts(col)
+        Return the value counts of a column (descending order).
+    merge(other)
+        Merge the profile with the profile of another dataset chunk.
+    infer_column_types()
+        Recover numerical columns from a profile computed on raw strings.
+    to_count_stats()
+        Return the per-column statistics dictionary.
+    to_dict()
+        Return the profile as a JSON serializable dictionary.
+    from_dict(profile)
+        Restore a profile from its dictionary.
+    """
+
+    def __init__(
+        self,
+        nrow: int,
+        column_types: Dict[str, str],
+        counts: Dict[str, pd.Series],
+    ) -> None:
+        check_type(int, nrow)
+        check_type(dict, column_types)
+        check_type(dict, counts)
+        if column_types.keys() != counts.keys():
+            errmsg = "Mismatching column types and value counts"
+            exception_handler(ValueError, errmsg, False)
+        self._nrow = nrow
+        self._column_types = column_types
+        self._counts = counts
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {self._nrow} rows, {len(self._counts)} columns>"
+
+    def _get_shape(self) -> tuple:
+        """(PRIVATE)"""
+        return self._nrow, len(self._counts)
+
+    @property
+    def shape(self) -> tuple:
+        return self._get_shape()
+
+    def _get_columns(self) -> List[str]:
+        """(PRIVATE)"""
+        return list(self._counts.keys())
+
+    @property
+    def columns(self) -> List[str]:
+        return self._get_columns()
+
+    def _get_column_types(self) -> Dict[str, str]:
+        """(PRIVATE)"""
+        return self._column_types
+
+    @property
+    def column_types(self) -> Dict[str, str]:
+        return self._get_column_types()
+
+    def value_counts(self, col: str) -> pd.Series:
+        try:
+            return self._counts[col]
+        except KeyError as e:
+            errmsg = f"Unknown column ({col})"
+            exception_handler(e, errmsg, False)
+
+    def values_num(self, col: str) -> int:
+        return self.value_counts(col).shape[0]
+
+    def most_freq(self, col: str) -> Optional[object]:
+        counts = self.value_counts(col)
+        return counts.index[0] if not counts.empty else None
+
+    def less_freq(self, col: str) -> Optional[object]:
+        counts = self.value_counts(col)
+        return counts.index[-1] if not counts.empty else None
+
+    def frequencies(self, col: str) -> List[str]:
+        counts = self.value_counts(col).to_numpy()
+        if counts.sum() == 0:
+            return []
+        return ["%.2f%%" % (val * 100) for val in (counts / counts.sum())]
+
+    def merge(self, other: "DatasetProfile") -> "DatasetProfile":
+        check_type(DatasetProfile, other)
+        if self.columns != other.columns:
+            errmsg = "Unable to merge profiles computed on different columns"
+            exception_handler(ValueError, errmsg, False)
+        column_types = {}
+        for col in self.columns:
+            # a column is numerical only if it is numerical in every chunk
+            column_types[col] = (
+                "numerical"
+                if self._column_types[col] == other.column_types[col] == "numerical"
+                else "categorical"
+            )
+        counts = {
+            col: merge_counts(self.value_counts(col), other.value_counts(col))
+            for col in self.columns
+        }
+        return DatasetProfile(self._nrow + other.shape[0], column_types, counts)
+
+    def infer_column_types(self) -> "DatasetProfile":
+        column_types, counts = {}, {}
+        for col in self.columns:
+            col_counts = self.value_counts(col)
+            values = pd.to_numeric(pd.Series(col_counts.index), errors="coerce")
+            if col_counts.empty or values.isnull().any():  # categorical column
+                column_types[col] = self._column_types[col]
+                counts[col] = col_counts
+                continue
+            if col_counts.sum() < self._nrow:  # missing values force floats
+                values = values.astype(float)
+            # different strings may encode the same number (e.g. 1 and 1.0)
+            col_counts = pd.Series(col_counts.to_numpy(), index=pd.Index(values))
+            col_counts = col_counts.groupby(level=0, sort=False).sum()
+            order = np.argsort(-col_counts.to_numpy(), kind="stable")
+            column_types[col] = "numerical"
+            counts[col] = col_counts.iloc[order]
+        return DatasetProfile(self._nrow, column_types, counts)
+
+    def to_count_stats(self) -> Dict[str, Dict[str, str]]:
+        columns_stats = {}  # dictionary with columns statistics
+        for col in self._counts.keys():
+            columns_stats[col] = {
+                "type": self._column_types[col],
+                "index": self.value_counts(col).index.tolist(),
+                "counts": self.frequencies(col),
+                "values_num": self.values_num(col),
+                "most_freq": self.most_freq(col),
+                "less_freq": self.less_freq(col),
+            }
+            assert len(columns_stats[col]["index"]) == len(columns_stats[col]["counts"])
+        return columns_stats
+
+    def to_dict(self) -> Dict:
+        return {
+            "rows": self._nrow,
+            "columns": [
+                {
+                    "name": col,
+                    "type": self._column_types[col],
+                    "values": [
+                        v.item() if hasattr(v, "item") else v
+                        for v in self._counts[col].index
+                    ],
+                    "counts": self._counts[col].tolist(),
+                }
+                for col in self.columns
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, profile: Dict) -> "DatasetProfile":
+        check_type(dict, profile)
+        try:
+            column_types = {c["name"]: c["type"] for c in profile["columns"]}
+            counts = {
+                c["name"]: pd.Series(
+                    np.asarray(c["counts"], dtype=np.int64),
+                    index=pd.Index(c["values"], dtype=object),
+                )
+                for c in profile["columns"]
+            }
+            return cls(int(profile["rows"]), column_types, counts)
+        except (KeyError, TypeError) as e:
+            errmsg = "Malformed dataset profile"
+            exception_handler(e.__class__, errmsg, False)
+
+
+def count_values(column: pd.Series) -> pd.Series:
+    """Count the values of a column with a single factorize and
+    bincount pass. Missing values are not counted, values are sorted by
+    descending count (ties keep their first appearance order), as done
+    by pandas value_counts().
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):  # count codes directly
+        codes = column.cat.codes.to_numpy()
+        uniques = column.cat.categories
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        # sort categories by first appearance, skipping unused ones
+        first = np.full(len(uniques), codes.shape[0])
+        np.minimum.at(first, codes[codes >= 0], np.flatnonzero(codes >= 0))
+        observed = np.argsort(first, kind="stable")[: np.count_nonzero(counts)]
+        counts, uniques = counts[observed], uniques.take(observed)
+    else:
+        codes, uniques = pd.factorize(column, sort=False)
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    order = np.argsort(-counts, kind="stable")
+    return pd.Series(counts[order], index=pd.Index(uniques).take(order))
+
+
+def merge_counts(counts1: pd.Series, counts2: pd.Series) -> pd.Series:
+    """Sum two value counts Series. Values keep their first appearance
+    order (counts1 before counts2) and are then sorted by descending count.
+    """
+    index = counts1.index.append(counts2.index[~counts2.index.isin(counts1.index)])
+    counts = (
+        counts1.reindex(index, fill_value=0).to_numpy()
+        + counts2.reindex(index, fill_value=0).to_numpy()
+    )
+    order = np.argsort(-counts, kind="stable")
+    return pd.Series(counts[order], index=index.take(order))
@@ -0,0 +1,313 @@
+"""Distance engine for one-hot encoded categorical data.
+Two one-hot encoded patients differ by two indicators for each column
+with different values, hence their squared Euclidean distance is twice
+the number of mismatching columns. Distances are computed directly on
+the integer category codes, without building the one-hot matrix.
+
+Distance matrices are computed by tiles, in parallel, and can be written
+to disk-backed .npy files. Integer matrices store the mismatch counts,
+floating point matrices store the Euclidean distances.
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+import hashlib
+import json
+import os
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+DISTANCE_BLOCK_SIZE = 1024  # rows compared at a time
+DISTANCE_DTYPES = ["float64", "float32", "uint8"]
+
+
+def encode_dataset(dataset: pd.DataFrame, debug: bool = False) -> np.ndarray:
+    """Return the rows x columns matrix of category codes of the dataset."""
+    from categorical import category_codes, codes_dtype
+
+    import pandas as pd
+
+    check_type(pd.DataFrame, dataset, debug)
+    if dataset.isnull().any().any():
+        errmsg = "Missing values found; unable to encode dataset"
+        exception_handler(ValueError, errmsg, debug)
+    columns = []
+    for col in dataset.columns:
+        column = dataset[col]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # same codes whether the dataset is categorical or not
+            column = column.cat.remove_unused_categories()
+        columns.append(category_codes(column))
+    dtype = codes_dtype(max(len(categories) for _, categories in columns))
+    codes = np.empty(dataset.shape, dtype=dtype)
+    for j, (col_codes, _) in enumerate(columns):
+        codes[:, j] = col_codes
+    return codes
+
+
+def count_mismatches(
+    codes_a: np.ndarray, codes_b: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Count the mismatching columns between each row of codes_a and each
+    row of codes_b (codes_a itself if not given).
+    """
+    if codes_b is None:
+        codes_b = codes_a
+    if codes_a.shape[1] != codes_b.shape[1]:
+        errmsg = "Mismatching number of columns"
+        exception_handler(ValueError, errmsg, False)
+    dtype = np.uint8 if codes_a.shape[1] <= np.iinfo(np.uint8).max else np.uint16
+    mismatches = np.zeros((codes_a.shape[0], codes_b.shape[0]), dtype=dtype)
+    mismatch = np.empty(mismatches.shape, dtype=bool)  # reused for each column
+    # compare contiguous columns
+    codes_a, codes_b = np.ascontiguousarray(codes_a.T), np.ascontiguousarray(codes_b.T)
+    for col_a, col_b in zip(codes_a, codes_b):
+        np.not_equal(col_a[:, None], col_b[None, :], out=mismatch)
+        mismatches += mismatch
+    return mismatches
+
+
+def mismatches_to_euclidean(
+    mismatches: np.ndarray, ncol: int, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    # one lookup per distance, instead of computing each square root
+    # (clip mode avoids buffering the output, codes are always in range)
+    dtype = np.float64 if out is None else out.dtype
+    distances = np.sqrt(2 * np.arange(ncol + 1, dtype=np.float64)).astype(dtype)
+    return np.take(distances, mismatches, out=out, mode="clip")
+
+
+def as_euclidean(dist_mat: np.ndarray) -> np.ndarray:
+    """Return the Euclidean distances stored in dist_mat. Integer
+    matrices store mismatch counts and are converted.
+    """
+    check_type(np.ndarray, dist_mat)
+    if not np.issubdtype(dist_mat.dtype, np.integer):
+        return dist_mat
+    return mismatches_to_euclidean(dist_mat, np.iinfo(dist_mat.dtype).max)
+
+
+def condensed_offset(row: int, nrow: int) -> int:
+    # position of the (row, row + 1) distance in the condensed matrix
+    return nrow * row - row * (row + 1) // 2
+
+
+def _store_distances(mismatches: np.ndarray, out: np.ndarray, ncol: int) -> None:
+    """(PRIVATE) Store mismatch counts in out, converted to Euclidean
+    distances in floating point matrices, without temporary copies.
+    """
+    if np.issubdtype(out.dtype, np.integer):
+        out[...] = mismatches
+    else:
+        mismatches_to_euclidean(mismatches, ncol, out=out)
+
+
+def _fill_distance_tile(
+    codes: np.ndarray,
+    dist_mat: np.ndarray,
+    rows: Tuple[int, int],
+    cols: Tuple[int, int],
+    condensed: bool,
+) -> None:
+    """(PRIVATE) Compute the distances between the rows and the cols
+    ranges of codes, and store them in the matrix (and in the mirrored
+    tile, in square matrices). Condensed matrices store the upper
+    triangle only. Tiles write disjoint regions, so they can be filled
+    concurrently, and each takes block x block temporary values.
+    """
+    (row_start, row_stop), (col_start, col_stop) = rows, cols
+    nrow, ncol = codes.shape
+    mismatches = count_mismatches(
+        codes[row_start:row_stop], codes[col_start:col_stop]
+    )
+    if condensed:
+        for i, row in enumerate(range(row_start, row_stop)):
+            first = max(col_start, row + 1)  # upper triangle only
+            if first >= col_stop:
+                continue
+            offset = condensed_offset(row, nrow) + first - row - 1
+            _store_distances(
+                mismatches[i, first - col_start :],
+                dist_mat[offset : offset + col_stop - first],
+                ncol,
+            )
+        return
+    _store_distances(mismatches, dist_mat[row_start:row_stop, col_start:col_stop], ncol)
+    if row_start != col_start:  # distances are symmetric
+        dist_mat[col_start:col_stop, row_start:row_stop] = dist_mat[
+            row_start:row_stop, col_start:col_stop
+        ].T
+
+
+def blocked_distances(
+    codes: np.ndarray,
+    dtype: str = "float64",
+    condensed: bool = False,
+    threads: int = 1,
+    outfile: Optional[str] = None,
+    block_size: int = DISTANCE_BLOCK_SIZE,
+) -> np.ndarray:
+    """Compute the distance matrix between the rows of codes, filling row
+    tiles in parallel. The matrix is either square or condensed (upper
+    triangle, as by scipy's squareform), and it is written to a .npy
+    memory-mapped file when outfile is given.
+    """
+    check_type(np.ndarray, codes)
+    check_type(str, dtype)
+    check_type(bool, condensed)
+    check_type(int, threads)
+    check_type(int, block_size)
+    if dtype not in DISTANCE_DTYPES:
+        errmsg = f"Forbidden distance matrix type ({dtype})"
+        exception_handler(ValueError, errmsg, False)
+    if dtype == "uint8" and codes.shape[1] > np.iinfo(np.uint8).max:
+        errmsg = f"Too many columns to store mismatch counts as {dtype}"
+        exception_handler(ValueError, errmsg, False)
+    if threads < 1 or block_size < 1:
+        errmsg = f"Forbidden threads ({threads}) or block size ({block_size})"
+        exception_handler(ValueError, errmsg, False)
+    nrow = codes.shape[0]
+    shape = (nrow * (nrow - 1) // 2,) if condensed else (nrow, nrow)
+    if outfile is None:
+        dist_mat = np.empty(shape, dtype=dtype)
+    else:
+        dist_mat = np.lib.format.open_memmap(
+            outfile, mode="w+", dtype=dtype, shape=shape
+        )
+    blocks = [
+        (start, min(start + block_size, nrow)) for start in range(0, nrow, block_size)
+    ]
+    # numpy releases the GIL while comparing codes, threads run in parallel
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(
+                _fill_distance_tile, codes, dist_mat, rows, cols, condensed
+            )
+            for i, rows in enumerate(blocks)
+            for cols in blocks[i:]
+        ]
+        for future in futures:
+            future.result()  # raise errors occurred in tiles
+    if isinstance(dist_mat, np.memmap):
+        dist_mat.flush()
+    return dist_mat
+
+
+def extend_distances(
+    dist_mat: np.ndarray,
+    codes: np.ndarray,
+    threads: int = 1,
+    outfile: Optional[str] = None,
+    block_size: int = DISTANCE_BLOCK_SIZE,
+) -> np.ndarray:
+    """Extend the square distance matrix of the first rows of codes to
+    all its rows. Distances between old rows are copied, only the rows
+    appended to codes are compared. The matrix keeps its type and is
+    written to a .npy memory-mapped file when outfile is given.
+    """
+    check_type(np.ndarray, dist_mat)
+    check_type(np.ndarray, codes)
+    check_type(int, threads)
+    check_type(int, block_size)
+    nold, nrow = dist_mat.shape[0], codes.shape[0]
+    if dist_mat.ndim != 2 or dist_mat.shape != (nold, nold) or nold > nrow:
+        errmsg = f"Forbidden distance matrix shape ({dist_mat.shape})"
+        exception_handler(ValueError, errmsg, False)
+    if threads < 1 or block_size < 1:
+        errmsg = f"Forbidden threads ({threads}) or block size ({block_size})"
+        exception_handler(ValueError, errmsg, False)
+    shape = (nrow, nrow)
+    if outfile is None:
+        extended = np.empty(shape, dtype=dist_mat.dtype)
+    else:
+        extended = np.lib.format.open_memmap(
+            outfile, mode="w+", dtype=dist_mat.dtype, shape=shape
+        )
+    for start in range(0, nold, block_size):  # bounded copy of old rows
+        stop = min(start + block_size, nold)
+        extended[start:stop, :nold] = dist_mat[start:stop]
+    old_blocks = [
+        (start, min(start + block_size, nold)) for start in range(0, nold, block_size)
+    ]
+    new_blocks = [
+        (start, min(start + block_size, nrow))
+        for start in range(nold, nrow, block_size)
+    ]
+    # appended rows are compared to the old rows and to the appended rows
+    # up to their own block, the mirrored tiles fill the rest
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(_fill_distance_tile, codes, extended, rows, cols, False)
+            for i, rows in enumerate(new_blocks)
+            for cols in old_blocks + new_blocks[: i + 1]
+        ]
+        for future in futures:
+            future.result()  # raise errors occurred in tiles
+    if isinstance(extended, np.memmap):
+        extended.flush()
+    return extended
+
+
+def distance_rows(dist_mat: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Return the rows [start, stop) of a square or condensed distance
+    matrix as Euclidean distances, reading only the required entries.
+    """
+    check_type(np.ndarray, dist_mat)
+    if dist_mat.ndim == 2:
+        return as_euclidean(np.asarray(dist_mat[start:stop]))
+    nrow = int(np.ceil(np.sqrt(2 * dist_mat.shape[0])))  # n (n - 1) / 2 entries
+    rows = np.arange(start, stop)[:, None]
+    cols = np.arange(nrow)[None, :]
+    low, high = np.minimum(rows, cols), np.maximum(rows, cols)
+    index = nrow * low - low * (low + 1) // 2 + high - low - 1
+    diagonal = rows == cols
+    index[diagonal] = 0
+    block = as_euclidean(np.asarray(dist_mat[index]))
+    block[diagonal] = 0
+    return block
+
+
+def codes_fingerprint(codes: np.ndarray) -> str:
+    digest = hashlib.sha256(np.ascontiguousarray(codes).tobytes())
+    digest.update(str(codes.shape).encode())
+    return digest.hexdigest()
+
+
+def distance_metadata_file(distfile: str) -> str:
+    return os.path.splitext(distfile)[0] + ".json"
+
+
+def save_distance_metadata(distfile: str, codes: np.ndarray, condensed: bool) -> None:
+    metadata = {
+        "fingerprint": codes_fingerprint(codes),
+        "rows": codes.shape[0],
+        "condensed": condensed,
+    }
+    with open(distance_metadata_file(distfile), mode="w") as outfile:
+        json.dump(metadata, outfile)
+
+
+def load_distances(
+    distfile: str, codes: Optional[np.ndarray] = None
+) -> Optional[Tuple[np.ndarray, Dict]]:
+    """Memory-map a distance matrix saved by a previous run. When codes
+    are given, the matrix is returned only if it was computed on them.
+    """
+    check_type(str, distfile)
+    try:
+        with open(distance_metadata_file(distfile), mode="r") as infile:
+            metadata = json.load(infile)
+        if codes is not None and metadata["fingerprint"] != codes_fingerprint(codes):
+            return None  # computed on a different dataset
+        dist_mat = np.load(distfile, mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
+    return dist_mat, metadata
@@ -0,0 +1,279 @@
+"""Missing values imputation.
+Incomplete patients are kept in the analysis by filling their missing
+values, either with the mode (median for numerical columns) of each
+column, or with the values of their nearest complete patients (KNN).
+
+Neighbors are compared on the category codes of the columns the
+incomplete patient has, as by the distance engine (missing values
+mismatch every complete patient alike). The exact search compares
+batches of incomplete patients with every complete patient, in parallel
+threads, and takes quadratic time. The approximate search looks up
+candidate neighbors in hash tables (bit sampling LSH): each table groups
+the complete patients by the values of a few random columns, and an
+incomplete patient is compared only to a bounded number of patients of
+its group in each table, so the search takes near-linear time. Tables
+also group the complete patients by the subsets of their columns, so
+that incomplete patients are hashed on the table columns they have.
+Patients with fewer than k candidate neighbors are compared to every
+complete patient, as by the exact search. The approximate search pays
+off on large cohorts only, and smaller ones are searched exactly.
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type, print_warning
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+IMPUTE_METHODS = ["mode", "median", "knn"]
+IMPUTE_NEIGHBORS = 5  # neighbors voting the imputed values
+IMPUTE_BLOCK_SIZE = 1 << 22  # patient pairs compared at a time
+LSH_TABLES = 8  # hash tables of the approximate search
+LSH_COLUMNS = 4  # columns hashed by each table
+LSH_CANDIDATES = 32  # patients compared in each table group
+LSH_SEED = 0  # tables are sampled reproducibly
+# complete patients from which the approximate search is faster than the
+# exact one (see benchmarks/impute_benchmark.py)
+APPROXIMATE_MIN_DONORS = 2000
+
+
+def fill_columns(dataset: pd.DataFrame, method: str) -> pd.DataFrame:
+    """Fill the missing values of each column with its mode or, with
+    the median method, the median of numerical columns.
+    """
+    from preprocess import fill_missing
+
+    import pandas as pd
+
+    filled = {}
+    for col in dataset.columns:
+        numerical = pd.api.types.is_numeric_dtype(dataset[col].dtype)
+        strategy = "median" if method == "median" and numerical else "mode"
+        filled[col] = fill_missing(dataset[col], strategy)
+    return pd.DataFrame(filled, index=dataset.index)
+
+
+def encode_missing(dataset: pd.DataFrame) -> Tuple[np.ndarray, List[pd.Index]]:
+    """Category codes of the dataset columns (-1 for missing values) and
+    the categories of each column.
+    """
+    from categorical import category_codes, codes_dtype
+
+    columns = [category_codes(dataset[col]) for col in dataset.columns]
+    dtype = codes_dtype(max(len(categories) for _, categories in columns))
+    codes = np.empty(dataset.shape, dtype=dtype)
+    for j, (col_codes, _) in enumerate(columns):
+        codes[:, j] = col_codes
+    return codes, [categories for _, categories in columns]
+
+
+def exact_neighbors(queries: np.ndarray, donors: np.ndarray, k: int) -> np.ndarray:
+    """Rows of the k donors nearest to each query row (rows x k)."""
+    from distance import count_mismatches
+
+    k = min(k, donors.shape[0])
+    mismatches = count_mismatches(queries, donors)
+    nearest = np.argpartition(mismatches, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(mismatches, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def lsh_tables(
+    queries: np.ndarray, donors: np.ndarray, seed: int = LSH_SEED
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Hash tables of the donors, as (columns, sorted keys, donor rows)
+    tuples. Columns are sampled by how often the queries have them, and
+    donors sharing a key are shuffled, so that the first ones of each
+    group are a random sample.
+
+    Each donor is hashed once for every non-empty subset of the table
+    columns, the other columns set to -1 as missing values, so that
+    queries missing some of the table columns are hashed on the ones
+    they have.
+    """
+    from categorical import row_keys
+
+    rng = np.random.default_rng(seed)
+    present = (queries >= 0).mean(axis=0) + 1e-9
+    ncol = min(LSH_COLUMNS, donors.shape[1])
+    # column subsets of the tables, the empty subset excluded
+    subsets = (np.arange(1, 1 << ncol)[:, None] >> np.arange(ncol)) & 1 == 1
+    tables = []
+    for _ in range(LSH_TABLES):
+        columns = np.sort(
+            rng.choice(donors.shape[1], ncol, replace=False, p=present / present.sum())
+        )
+        masked = np.where(subsets[:, None, :], donors[:, columns], -1)
+        keys = row_keys(masked.reshape(-1, ncol).astype(donors.dtype))
+        rows = np.tile(np.arange(donors.shape[0]), subsets.shape[0])
+        order = np.lexsort((rng.permutation(keys.shape[0]), keys))
+        tables.append((columns, keys[order], rows[order]))
+    return tables
+
+
+def approximate_neighbors(
+    queries: np.ndarray,
+    donors: np.ndarray,
+    k: int,
+    tables: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+) -> np.ndarray:
+    """Rows of the k donors nearest to each query row among the donors
+    sharing a hash table group with it (rows x k, -1 when fewer).
+    """
+    from categorical import row_keys
+
+    # candidates of each query, LSH_CANDIDATES slots in each table
+    slots = np.arange(LSH_CANDIDATES)
+    candidates = np.empty((queries.shape[0], len(tables) * LSH_CANDIDATES), np.int64)
+    for t, (columns, keys, rows) in enumerate(tables):
+        # missing values select the table keys of the present columns
+        query_keys = row_keys(queries[:, columns])
+        first = np.searchsorted(keys, query_keys, side="left")
+        last = np.searchsorted(keys, query_keys, side="right")
+        group = first[:, None] + slots
+        candidates[:, t * LSH_CANDIDATES : (t + 1) * LSH_CANDIDATES] = np.where(
+            group < last[:, None], rows[np.minimum(group, rows.shape[0] - 1)], -1
+        )
+    found = candidates >= 0
+    candidates = np.maximum(candidates, 0)
+    mismatches = np.zeros(candidates.shape, dtype=np.uint16)
+    for query_col, donor_col in zip(queries.T, np.ascontiguousarray(donors.T)):
+        mismatches += query_col[:, None] != donor_col[candidates]
+    # candidates ranked by mismatches, then rows (empty slots last)
+    ranks = mismatches.astype(np.int64) * donors.shape[0] + candidates
+    ranks[~found] = np.iinfo(np.int64).max
+    # a donor fills a slot in each table at most, so the k * LSH_TABLES
+    # best slots hold the k best distinct candidates
+    best = min(k * len(tables), ranks.shape[1])
+    if best < ranks.shape[1]:
+        ranks = np.partition(ranks, best - 1, axis=1)[:, :best]
+    ranks.sort(axis=1)
+    distinct = np.ones(ranks.shape, dtype=bool)
+    distinct[:, 1:] = ranks[:, 1:] != ranks[:, :-1]
+    distinct &= ranks != np.iinfo(np.int64).max
+    position = np.cumsum(distinct, axis=1) - 1
+    kept = distinct & (position < k)
+    nearest = np.full((queries.shape[0], k), -1, dtype=np.int64)
+    query_rows, _ = np.nonzero(kept)
+    nearest[query_rows, position[kept]] = ranks[kept] % donors.shape[0]
+    return nearest
+
+
+def vote_codes(codes: np.ndarray) -> np.ndarray:
+    """Most frequent code of each row (-1 codes do not vote), ties
+    broken by the first neighbor.
+    """
+    votes = np.zeros(codes.shape, dtype=np.int64)
+    for j in range(codes.shape[1]):
+        votes[:, j] = (codes == codes[:, j, None]).sum(axis=1)
+    votes[codes < 0] = -1
+    return np.take_along_axis(codes, votes.argmax(axis=1)[:, None], axis=1)[:, 0]
+
+
+def impute_dataset(
+    dataset: pd.DataFrame,
+    method: str = "knn",
+    neighbors: int = IMPUTE_NEIGHBORS,
+    approximate: bool = False,
+    threads: int = 1,
+    debug: bool = False,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Fill the missing values of the dataset. The KNN method fills the
+    values of categorical columns with the most frequent one among the
+    neighbors, and the values of numerical columns with their mean
+    (rounded in integer columns).
+    """
+    from preprocess import fill_missing
+
+    import pandas as pd
+
+    check_type(pd.DataFrame, dataset, debug)
+    check_type(str, method, debug)
+    check_type(int, neighbors, debug)
+    check_type(int, threads, debug)
+    if method not in IMPUTE_METHODS:
+        errmsg = f"Unknown imputation method ({method})"
+        exception_handler(ValueError, errmsg, debug)
+    if neighbors < 1:
+        errmsg = f"Forbidden number of imputation neighbors ({neighbors})"
+        exception_handler(ValueError, errmsg, debug)
+    missing = dataset.isna().to_numpy()
+    incomplete = np.flatnonzero(missing.any(axis=1))
+    if incomplete.shape[0] == 0:
+        return dataset
+    if verbose:
+        print(f"Imputing {int(missing.sum())} missing values of {incomplete.shape[0]} patients")
+    if method != "knn":
+        return fill_columns(dataset, method)
+    codes, categories = encode_missing(dataset)
+    complete = np.flatnonzero(~missing.any(axis=1))
+    if complete.shape[0] == 0:
+        print_warning("No complete patient to impute missing values from, using modes")
+        return fill_columns(dataset, "mode")
+    donors = codes[complete]
+    if approximate and donors.shape[0] < APPROXIMATE_MIN_DONORS:
+        approximate = False  # the exact search is faster
+        if verbose:
+            print(f"Exact neighbors search among {donors.shape[0]} complete patients")
+    # incomplete patients are imputed by independent batches
+    batch_size = max(1, IMPUTE_BLOCK_SIZE // donors.shape[0])
+    if approximate:
+        tables = lsh_tables(codes[incomplete], donors)
+        batch_size = max(1, IMPUTE_BLOCK_SIZE // (LSH_TABLES * LSH_CANDIDATES))
+    batches = [
+        incomplete[start : start + batch_size]
+        for start in range(0, incomplete.shape[0], batch_size)
+    ]
+
+    def search(rows: np.ndarray) -> np.ndarray:
+        if not approximate:
+            return exact_neighbors(codes[rows], donors, neighbors)
+        nearest = approximate_neighbors(codes[rows], donors, neighbors, tables)
+        # patients with too few candidates are compared to all donors
+        k = min(neighbors, donors.shape[0])
+        unmatched = np.flatnonzero(nearest[:, k - 1] < 0)
+        exact_size = max(1, IMPUTE_BLOCK_SIZE // donors.shape[0])
+        for start in range(0, unmatched.shape[0], exact_size):
+            batch = unmatched[start : start + exact_size]
+            nearest[batch, :k] = exact_neighbors(codes[rows[batch]], donors, k)
+        return nearest
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        nearest = np.concatenate(list(executor.map(search, batches)))
+    nearest = np.where(nearest >= 0, complete[np.maximum(nearest, 0)], -1)
+    imputed = {}
+    for j, col in enumerate(dataset.columns):
+        column = dataset[col]
+        rows = np.flatnonzero(missing[incomplete, j])
+        if rows.shape[0] == 0:
+            imputed[col] = column
+            continue
+        donor_rows = nearest[rows]
+        if pd.api.types.is_numeric_dtype(column.dtype):
+            values = column.to_numpy(dtype=np.float64, na_value=np.nan)
+            donor_values = np.where(
+                donor_rows >= 0, values[np.maximum(donor_rows, 0)], np.nan
+            )
+            counts = (~np.isnan(donor_values)).sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                fills = np.nansum(donor_values, axis=1) / counts
+            present = values[~np.isnan(values)]
+            if (present % 1 == 0).all():  # integer values stay integers
+                fills = np.round(fills)
+        else:
+            donor_codes = np.where(
+                donor_rows >= 0, codes[np.maximum(donor_rows, 0), j], -1
+            )
+            labels = np.append(categories[j].to_numpy(dtype=object), None)
+            fills = labels[vote_codes(donor_codes)]
+        column = column.copy()
+        column.iloc[incomplete[rows]] = fills
+        imputed[col] = fill_missing(column, "mode")  # patients without neighbors
+    return pd.DataFrame(imputed, index=dataset.index)
@@ -0,0 +1,454 @@
+"""Incremental re-analysis of growing datasets.
+Registry releases are cumulative: each release appends new patients to
+the previous one. The AnalysisState stores what an analysis computed
+(value counts, contingency counts, encoder categories, category codes or
+unique profiles of complete patients, distance matrix) together with the
+size and digest of the analyzed file. When the new file starts with the
+analyzed content, only the appended rows are parsed: counts are merged,
+new categories extend the encoders, and only the distances involving
+new patients (or new unique profiles) are computed. Otherwise, the
+analysis starts from scratch.
+
+Rows are read as raw strings, as in the streaming analysis, so that
+values are encoded the same way in every release.
+"""
+from __future__ import annotations
+
+from utils import check_type, print_warning
+from csv_input import CsvInput, HASH_BLOCK_SIZE
+
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+import tempfile
+import hashlib
+import shutil
+import json
+import os
+
+if TYPE_CHECKING:
+    from contingency import ContingencyCube
+    from dataset_profile import DatasetProfile
+
+    import pandas as pd
+
+
+STATE_FORMAT_VERSION = 1  # bump when the state layout changes
+STATE_FILE = "state.json"
+CUBE_FILE = "cube.npy"
+CODES_FILE = "codes.npy"
+WEIGHTS_FILE = "weights.npy"
+DISTANCES_FILE = "distances.npy"
+STATE_FILES = [CUBE_FILE, CODES_FILE, WEIGHTS_FILE, DISTANCES_FILE, STATE_FILE]
+
+
+class AnalysisState:
+    """Analysis results of a dataset release, updated with the rows
+    appended by later releases.
+
+    ...
+
+    Attributes
+    ----------
+    size : int
+        Bytes of the analyzed dataset file.
+    profile : DatasetProfile
+        Raw strings profile of the analyzed rows.
+    cube : ContingencyCube
+        Patients counts of the descriptive plots.
+    categories : List[List[str]]
+        Encoder categories of each column (append-only).
+    codes : numpy.ndarray
+        Category codes of the complete patients (unique profiles when
+        deduplicated).
+    weights : numpy.ndarray
+        Patients sharing each unique profile (None if not deduplicated).
+    dist_mat : numpy.ndarray
+        Square distance matrix between the rows of codes.
+
+    Methods
+    -------
+    empty(state_dir, columns, dist_dtype, dedup)
+        State of a dataset analyzed from scratch.
+    load(state_dir, csv_input, dist_dtype, dedup, debug)
+        Load the state of a previous analysis of the dataset, if valid.
+    update(rows, size, threads, debug, verbose)
+        Add appended rows to the analysis.
+    save(csv_input, debug)
+        Store the state for the next release.
+    """
+
+    def __init__(
+        self,
+        state_dir: str,
+        size: int,
+        profile: Optional[DatasetProfile],
+        cube: ContingencyCube,
+        categories: List[List[str]],
+        codes: np.ndarray,
+        weights: Optional[np.ndarray],
+        dist_mat: np.ndarray,
+        dist_dtype: str,
+    ) -> None:
+        check_type(str, state_dir)
+        check_type(int, size)
+        check_type(list, categories)
+        check_type(np.ndarray, codes)
+        check_type(np.ndarray, dist_mat)
+        self._size = size
+        self._profile = profile
+        self._cube = cube
+        self._categories = categories
+        self._codes = codes
+        self._weights = weights
+        self._dist_mat = dist_mat
+        self._dist_dtype = dist_dtype
+        self._state_dir = state_dir
+        self._workdir = None  # updated files, moved in state_dir on save
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {self._size} bytes, {self._codes.shape[0]} encoded rows>"
+
+    @classmethod
+    def empty(
+        cls, state_dir: str, columns: List[str], dist_dtype: str, dedup: bool
+    ) -> "AnalysisState":
+        from contingency import ContingencyCube
+
+        return cls(
+            state_dir,
+            0,
+            None,
+            ContingencyCube(),
+            [[] for _ in columns],
+            np.empty((0, len(columns)), dtype=np.int8),
+            np.empty(0, dtype=np.int64) if dedup else None,
+            np.empty((0, 0), dtype=dist_dtype),
+            dist_dtype,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        state_dir: str,
+        csv_input: CsvInput,
+        dist_dtype: str,
+        dedup: bool,
+        debug: bool = False,
+    ) -> Optional["AnalysisState"]:
+        from contingency import ContingencyCube
+        from dataset_profile import DatasetProfile
+
+        check_type(str, state_dir, debug)
+        check_type(CsvInput, csv_input, debug)
+        try:
+            with open(os.path.join(state_dir, STATE_FILE), mode="r") as infile:
+                metadata = json.load(infile)
+            if (
+                metadata["version"] != STATE_FORMAT_VERSION
+                or metadata["columns"] != csv_input.header
+                or metadata["separator"] != csv_input.separator
+                or metadata["dist_dtype"] != dist_dtype
+                or metadata["dedup"] != dedup
+            ):
+                return None  # computed with different settings
+            if not is_appended(csv_input, metadata["size"], metadata["digest"]):
+                return None  # analyzed rows changed
+            profile = DatasetProfile.from_dict(metadata["profile"])
+            cube = ContingencyCube.from_counts(
+                np.load(os.path.join(state_dir, CUBE_FILE)), debug
+            )
+            codes = np.load(os.path.join(state_dir, CODES_FILE))
+            weights = (
+                np.load(os.path.join(state_dir, WEIGHTS_FILE)) if dedup else None
+            )
+            dist_mat = np.load(os.path.join(state_dir, DISTANCES_FILE), mmap_mode="r")
+        except (OSError, ValueError, KeyError, TypeError):
+            return None  # missing or unreadable state, analyze from scratch
+        nrow = codes.shape[0]
+        if (
+            dist_mat.shape != (nrow, nrow)
+            or dist_mat.dtype != dist_dtype
+            or (weights is not None and weights.shape != (nrow,))
+            or len(metadata["categories"]) != codes.shape[1]
+        ):
+            print_warning(f"Inconsistent analysis state in {state_dir}, ignored")
+            return None
+        return cls(
+            state_dir,
+            metadata["size"],
+            profile,
+            cube,
+            metadata["categories"],
+            codes,
+            weights,
+            dist_mat,
+            dist_dtype,
+        )
+
+    def _get_size(self) -> int:
+        """(PRIVATE)"""
+        return self._size
+
+    @property
+    def size(self) -> int:
+        return self._get_size()
+
+    def _get_profile(self) -> Optional[DatasetProfile]:
+        """(PRIVATE)"""
+        return self._profile
+
+    @property
+    def profile(self) -> Optional[DatasetProfile]:
+        return self._get_profile()
+
+    def _get_cube(self) -> ContingencyCube:
+        """(PRIVATE)"""
+        return self._cube
+
+    @property
+    def cube(self) -> ContingencyCube:
+        return self._get_cube()
+
+    def _get_categories(self) -> List[List[str]]:
+        """(PRIVATE)"""
+        return self._categories
+
+    @property
+    def categories(self) -> List[List[str]]:
+        return self._get_categories()
+
+    def _get_codes(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._codes
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._get_codes()
+
+    def _get_weights(self) -> Optional[np.ndarray]:
+        """(PRIVATE)"""
+        return self._weights
+
+    @property
+    def weights(self) -> Optional[np.ndarray]:
+        return self._get_weights()
+
+    def _get_dist_mat(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._dist_mat
+
+    @property
+    def dist_mat(self) -> np.ndarray:
+        return self._get_dist_mat()
+
+    def update(
+        self,
+        rows: pd.DataFrame,
+        size: int,
+        threads: int = 1,
+        debug: bool = False,
+        verbose: bool = False,
+    ) -> None:
+        """Add the rows appended to the analyzed file, which now takes
+        size bytes.
+        """
+        from dataset_analyzer import compute_dataset_profile
+        from distance import extend_distances
+
+        check_type(int, size, debug)
+        self._size = size
+        if rows.empty:
+            return
+        profile = compute_dataset_profile(rows, debug, verbose)
+        self._profile = profile if self._profile is None else self._profile.merge(profile)
+        self._cube.update(rows, debug)
+        complete = rows.dropna()
+        if complete.empty:
+            return
+        codes = np.concatenate(
+            [self._codes, self._encode(complete)], dtype=self._codes_dtype()
+        )
+        if self._weights is not None:  # new patients as unique profiles
+            codes, self._weights = merge_profiles(
+                self._codes.shape[0], codes, self._weights
+            )
+        if verbose:
+            print(f"Comparing {codes.shape[0] - self._codes.shape[0]} new rows")
+        # the extended matrix is written aside the stored one
+        self._dist_mat = extend_distances(
+            self._dist_mat,
+            codes,
+            threads,
+            outfile=os.path.join(self._get_workdir(), DISTANCES_FILE),
+        )
+        self._codes = codes
+
+    def _get_workdir(self) -> str:
+        """(PRIVATE)"""
+        if self._workdir is None:
+            os.makedirs(self._state_dir, exist_ok=True)
+            self._workdir = tempfile.mkdtemp(prefix=".tmp-", dir=self._state_dir)
+        return self._workdir
+
+    def _encode(self, rows: pd.DataFrame) -> np.ndarray:
+        """(PRIVATE) Category codes of the rows. Unseen values extend the
+        column categories, so codes of analyzed rows stay valid.
+        """
+        import pandas as pd
+
+        codes = np.empty(rows.shape, dtype=np.int64)
+        for j, col in enumerate(rows.columns):
+            categories = self._categories[j]
+            values = rows[col].astype(str)
+            known = pd.Index(categories, dtype=object)
+            unseen = pd.Index(values.unique()).difference(known)
+            categories.extend(sorted(unseen.tolist()))
+            codes[:, j] = pd.Index(categories, dtype=object).get_indexer(values)
+        return codes
+
+    def _codes_dtype(self) -> np.dtype:
+        """(PRIVATE)"""
+        from categorical import codes_dtype
+
+        return codes_dtype(max([len(c) for c in self._categories] + [1]))
+
+    def save(self, csv_input: CsvInput, debug: bool = False) -> None:
+        """Store the state in its directory. Files are written aside and
+        moved in place, the state file last.
+        """
+        check_type(CsvInput, csv_input, debug)
+        state_dir = self._state_dir
+        try:
+            tmpdir = self._get_workdir()
+            np.save(os.path.join(tmpdir, CUBE_FILE), self._cube.counts)
+            np.save(os.path.join(tmpdir, CODES_FILE), self._codes)
+            if self._weights is not None:
+                np.save(os.path.join(tmpdir, WEIGHTS_FILE), self._weights)
+            if not any(  # neither extended nor stored yet
+                os.path.isfile(os.path.join(d, DISTANCES_FILE))
+                for d in [tmpdir, state_dir]
+            ):
+                np.save(os.path.join(tmpdir, DISTANCES_FILE), self._dist_mat)
+            metadata = {
+                "version": STATE_FORMAT_VERSION,
+                "source": os.path.abspath(csv_input.csv_file),
+                "columns": csv_input.header,
+                "separator": csv_input.separator,
+                "size": self._size,
+                "digest": prefix_digest(csv_input, self._size),
+                "dist_dtype": self._dist_dtype,
+                "dedup": self._weights is not None,
+                "profile": self._profile.to_dict(),
+                "categories": self._categories,
+            }
+            with open(os.path.join(tmpdir, STATE_FILE), mode="w") as outfile:
+                json.dump(metadata, outfile)
+            for fname in STATE_FILES:
+                if os.path.isfile(os.path.join(tmpdir, fname)):
+                    os.replace(
+                        os.path.join(tmpdir, fname), os.path.join(state_dir, fname)
+                    )
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            self._workdir = None
+        except OSError as e:
+            print_warning(f"Unable to store the analysis state in {state_dir} ({e})")
+
+
+def prefix_digest(csv_input: CsvInput, size: int) -> str:
+    """SHA-256 digest of the first size bytes of the dataset file."""
+    digest = hashlib.sha256()
+    handle = csv_input.rewind()
+    remaining = size
+    while remaining > 0:
+        block = handle.read(min(HASH_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        digest.update(block)
+        remaining -= len(block)
+    csv_input.rewind()
+    return digest.hexdigest()
+
+
+def is_appended(csv_input: CsvInput, size: int, digest: str) -> bool:
+    """Whether the dataset file starts with the analyzed content, ending
+    on a complete line.
+    """
+    if os.path.getsize(csv_input.csv_file) < size:
+        return False
+    handle = csv_input.rewind()
+    if size > 0:
+        handle.seek(size - 1)
+        if handle.read(1) != b"\n" and os.path.getsize(csv_input.csv_file) > size:
+            return False  # the last analyzed line may have been extended
+    return prefix_digest(csv_input, size) == digest
+
+
+def read_appended_rows(
+    csv_input: CsvInput, offset: int, debug: bool = False
+) -> Tuple[pd.DataFrame, int]:
+    """Read the rows following offset bytes of the dataset file as raw
+    strings. Returns the rows and the file size.
+    """
+    import pandas as pd
+
+    check_type(int, offset, debug)
+    size = os.path.getsize(csv_input.csv_file)
+    options = {**csv_input.reader_options(), "dtype": str}
+    handle = csv_input.rewind()
+    if offset == 0:  # first release, header included
+        rows = pd.read_csv(handle, **options)
+    elif offset == size:
+        rows = pd.DataFrame(columns=csv_input.header, dtype=str)
+    else:
+        handle.seek(offset)
+        rows = pd.read_csv(handle, header=None, names=csv_input.header, **options)
+    csv_input.rewind()
+    return rows, size
+
+
+def merge_profiles(
+    nold: int, codes: np.ndarray, weights: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge the rows of codes following the nold unique profiles into
+    the profiles table. New profiles are appended, in first appearance
+    order, so analyzed profiles keep their position.
+    """
+    from categorical import row_keys
+
+    keys = row_keys(codes)
+    old, new = keys[:nold], keys[nold:]
+    order = np.argsort(old, kind="stable")
+    pos = np.minimum(np.searchsorted(old[order], new), max(nold - 1, 0))
+    known = (old[order][pos] == new) if nold > 0 else np.zeros(new.shape, dtype=bool)
+    weights = weights.copy()
+    np.add.at(weights, order[pos[known]], 1)
+    unseen = codes[nold:][~known]
+    _, first, counts = np.unique(
+        row_keys(unseen), return_index=True, return_counts=True
+    )
+    appearance = np.argsort(first, kind="stable")
+    profiles = np.concatenate([codes[:nold], unseen[first[appearance]]])
+    return profiles, np.concatenate([weights, counts[appearance]])
+
+
+def load_analysis_state(
+    state_dir: str,
+    csv_input: CsvInput,
+    dist_dtype: str,
+    dedup: bool,
+    debug: bool = False,
+    verbose: bool = False,
+) -> AnalysisState:
+    """Load the state of the previous analysis of the dataset, or an
+    empty state when the dataset is analyzed from scratch.
+    """
+    state = AnalysisState.load(state_dir, csv_input, dist_dtype, dedup, debug)
+    if state is not None:
+        if verbose:
+            print(f"Resuming the analysis of the first {state.size} bytes")
+        return state
+    if verbose:
+        print(f"No reusable analysis state in {state_dir}, analyzing from scratch")
+    return AnalysisState.empty(state_dir, csv_input.header, dist_dtype, dedup)
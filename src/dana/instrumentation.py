@@ -0,0 +1,205 @@
+"""Per-stage instrumentation of DANA runs.
+The StageProfiler records the wall time, CPU time, peak RSS and allocated
+memory of each pipeline stage, and writes them as a JSON run report or a
+summary table. A disabled profiler measures nothing. Allocations are
+traced with tracemalloc, which slows down Python code: they are recorded
+only on request.
+"""
+from utils import exception_handler, check_type
+
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import tracemalloc
+import resource
+import datetime
+import platform
+import json
+import time
+import sys
+import os
+import re
+
+
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+MB = 1024 * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the process peak RSS (Linux only). Returns False when the
+    peak cannot be reset, then the process high-water mark is reported.
+    """
+    try:
+        with open(PROC_CLEAR_REFS, mode="w") as outfile:
+            outfile.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open(PROC_STATUS, mode="r") as infile:
+            match = re.search(r"VmHWM:\s+(\d+) kB", infile.read())
+        if match:
+            return int(match.group(1)) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (MB if sys.platform == "darwin" else 1024)
+
+
+class StageProfiler:
+    """Measures of the pipeline stages of a run.
+
+    ...
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether stages are measured.
+    stages : List[Dict]
+        Measures of each completed stage, in order.
+
+    Methods
+    -------
+    stage(name)
+        Context manager measuring a stage.
+    add(record)
+        Add a stage measured elsewhere (e.g. in a worker process).
+    report()
+        Run report, as a dictionary.
+    write_report(outfile)
+        Write the run report as JSON.
+    summary()
+        Human-readable summary table of the stages.
+    """
+
+    def __init__(self, enabled: bool = False, trace_allocations: bool = False) -> None:
+        check_type(bool, enabled)
+        check_type(bool, trace_allocations)
+        self._enabled = enabled
+        self._trace = enabled and trace_allocations
+        self._stages = []
+        self._start = time.perf_counter(), time.process_time()
+        self._started = datetime.datetime.now().isoformat(timespec="seconds")
+        self._metadata = {}
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {len(self._stages)} stages>"
+
+    def _get_enabled(self) -> bool:
+        """(PRIVATE)"""
+        return self._enabled
+
+    @property
+    def enabled(self) -> bool:
+        return self._get_enabled()
+
+    def _get_stages(self) -> List[Dict]:
+        """(PRIVATE)"""
+        return self._stages
+
+    @property
+    def stages(self) -> List[Dict]:
+        return self._get_stages()
+
+    def set_metadata(self, **metadata: Any) -> None:
+        self._metadata.update(metadata)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        check_type(str, name)
+        if not self._enabled:
+            yield
+            return
+        exact_rss = reset_peak_rss()
+        if self._trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu,
+                "peak_rss_mb": peak_rss_mb(),
+                "peak_rss_exact": exact_rss,
+                "pid": os.getpid(),
+            }
+            if self._trace:
+                current, peak = tracemalloc.get_traced_memory()
+                record["alloc_peak_mb"] = (peak - allocated) / MB
+                record["alloc_net_mb"] = (current - allocated) / MB
+            self._stages.append(record)
+
+    def add(self, record: Optional[Dict]) -> None:
+        if record is not None and self._enabled:
+            check_type(dict, record)
+            self._stages.append(record)
+
+    def report(self) -> Dict:
+        wall, cpu = self._start
+        if self._trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {
+            "started": self._started,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            **self._metadata,
+            "total": {
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu,
+            },
+            "stages": self._stages,
+        }
+
+    def write_report(self, outfile: str, debug: bool = False) -> None:
+        check_type(str, outfile, debug)
+        try:
+            with open(outfile, mode="w") as outstream:
+                json.dump(self.report(), outstream, indent=2)
+                outstream.write("\n")
+        except OSError as e:
+            errmsg = f"An error occurred while writing the run report to {outfile}"
+            exception_handler(e.__class__, errmsg, debug)
+
+    def summary(self) -> str:
+        header = f"{'Stage':<20}{'Wall (s)':>10}{'CPU (s)':>10}{'Peak RSS (MB)':>15}"
+        if self._trace:
+            header += f"{'Alloc peak (MB)':>17}"
+        lines = [header, "-" * len(header)]
+        for record in self._stages:
+            line = (
+                f"{record['stage']:<20}{record['wall_s']:>10.2f}"
+                f"{record['cpu_s']:>10.2f}{record['peak_rss_mb']:>15.1f}"
+            )
+            if "alloc_peak_mb" in record:
+                line += f"{record['alloc_peak_mb']:>17.1f}"
+            lines.append(line)
+        wall, cpu = self._start
+        lines.append("-" * len(header))
+        lines.append(
+            f"{'Total (run)':<20}{time.perf_counter() - wall:>10.2f}"
+            f"{time.process_time() - cpu:>10.2f}"
+        )
+        return "\n".join(lines)
+
+
+def profiled_call(
+    name: str, enabled: bool, function: Callable, *args: Any
+) -> Tuple[Any, Optional[Dict]]:
+    """Call function as a profiled stage and return its result and the
+    stage measures (None if disabled). Used by worker processes, which
+    send their measures back to the main profiler.
+    """
+    profiler = StageProfiler(enabled, trace_allocations=False)
+    with profiler.stage(name):
+        result = function(*args)
+    return result, profiler.stages[0] if enabled else None
@@ -0,0 +1,154 @@
+"""Persistent columnar cache of parsed datasets.
+Parsed datasets are stored on disk, one binary array per column, and
+loaded on later runs. Text columns are stored as integer category codes
+plus their categories, as a list of strings or, for other categories
+(e.g. dates), as a binary array keeping their dtype. Cache entries are
+content-addressed on the dataset file hash, the separator and the reader
+options.
+"""
+from utils import exception_handler, check_type, print_warning
+from categorical import codes_dtype
+from csv_input import CsvInput, HASH_BLOCK_SIZE
+
+from typing import Dict, Optional, Union
+
+import pandas as pd
+import numpy as np
+
+import tempfile
+import hashlib
+import shutil
+import json
+import os
+
+
+CACHE_FORMAT_VERSION = 2  # bump when the cache layout changes
+METADATA_FILE = "metadata.json"
+
+
+def compute_cache_key(
+    csv_file: Union[str, CsvInput],
+    separator: str,
+    reader_options: Dict,
+    debug: bool = False,
+) -> str:
+    check_type(str, separator, debug)
+    check_type(dict, reader_options, debug)
+    if isinstance(csv_file, CsvInput):  # hashed through the open dataset file
+        digest = csv_file.content_digest()
+    else:
+        check_type(str, csv_file, debug)
+        digest = hashlib.sha256()
+        with open(csv_file, mode="rb") as handle:
+            for block in iter(lambda: handle.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    options = json.dumps(
+        {
+            "version": CACHE_FORMAT_VERSION,
+            "separator": separator,
+            "options": reader_options,
+            "pandas": pd.__version__,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    digest.update(options.encode())
+    return digest.hexdigest()
+
+
+def store_cached_dataset(
+    dataset: pd.DataFrame, cache_dir: str, key: str, csv_file: str, debug: bool
+) -> None:
+    check_type(pd.DataFrame, dataset, debug)
+    check_type(str, cache_dir, debug)
+    check_type(str, key, debug)
+    tmpdir = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write the entry aside and move it in place once complete
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+        columns = []
+        for i, col in enumerate(dataset.columns):
+            column = dataset[col]
+            fname = f"col{i}.npy"
+            if pd.api.types.is_numeric_dtype(column.dtype):
+                np.save(os.path.join(tmpdir, fname), column.to_numpy())
+                columns.append({"name": col, "file": fname, "dtype": None})
+                continue
+            codes, categories = pd.factorize(column, sort=True)
+            codes = codes.astype(codes_dtype(len(categories)))
+            np.save(os.path.join(tmpdir, fname), codes)
+            entry = {"name": col, "file": fname, "dtype": str(column.dtype)}
+            categories = pd.Index(categories)
+            if all(isinstance(c, str) for c in categories):
+                entry["categories"] = categories.tolist()
+            else:  # categories keep their dtype (not pickled)
+                entry["categories_file"] = f"categories{i}.npy"
+                np.save(
+                    os.path.join(tmpdir, entry["categories_file"]),
+                    categories.to_numpy(),
+                    allow_pickle=False,
+                )
+            columns.append(entry)
+        metadata = {
+            "source": os.path.abspath(csv_file),
+            "rows": dataset.shape[0],
+            "columns": columns,
+        }
+        with open(os.path.join(tmpdir, METADATA_FILE), mode="w") as outfile:
+            json.dump(metadata, outfile)
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry):  # stored meanwhile by a concurrent run
+            shutil.rmtree(tmpdir)
+        else:
+            os.rename(tmpdir, entry)
+        invalidate_cached_dataset(cache_dir, csv_file, key)
+    except (OSError, ValueError) as e:  # ValueError: categories of mixed types
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        print_warning(f"Unable to cache {csv_file} in {cache_dir} ({e})")
+
+
+def load_cached_dataset(
+    cache_dir: str, key: str, debug: bool = False, categorical: bool = False
+) -> Optional[pd.DataFrame]:
+    check_type(str, cache_dir, debug)
+    check_type(str, key, debug)
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, METADATA_FILE), mode="r") as infile:
+            metadata = json.load(infile)
+        data = {}
+        for column in metadata["columns"]:
+            values = np.load(os.path.join(entry, column["file"]))
+            if column["dtype"] is not None:
+                if "categories_file" in column:
+                    categories = np.load(os.path.join(entry, column["categories_file"]))
+                else:
+                    categories = column["categories"]
+                values = pd.Categorical.from_codes(values, categories)
+                if not categorical:  # decode category codes
+                    values = pd.Series(values).astype(column["dtype"])
+            data[column["name"]] = values
+    except (OSError, ValueError, KeyError):
+        return None  # missing or unreadable entry, parse the dataset again
+    dataset = pd.DataFrame(data, columns=[c["name"] for c in metadata["columns"]])
+    if dataset.shape[0] != metadata["rows"]:
+        errmsg = f"Corrupted cache entry ({entry})"
+        exception_handler(ValueError, errmsg, debug)
+    return dataset
+
+
+def invalidate_cached_dataset(cache_dir: str, csv_file: str, key: str) -> None:
+    # remove the entries storing previous versions of the dataset
+    source = os.path.abspath(csv_file)
+    for entry in os.listdir(cache_dir):
+        if entry == key or entry.startswith("."):
+            continue
+        try:
+            with open(os.path.join(cache_dir, entry, METADATA_FILE)) as infile:
+                if json.load(infile)["source"] != source:
+                    continue
+        except (OSError, ValueError, KeyError):
+            continue
+        shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
@@ -1,16 +1,34 @@
 """Patient class definition.
 The Patients class extends the basic Dict class to 
 encode a disctionary of patients.
+The PatientTable class stores the patients as contiguous arrays of
+category codes, and returns lightweight Patient views on access.
 """
-from utils import exception_handler, check_type, PATID_START, T
+from __future__ import annotations
 
-from typing import List, Iterator, Dict
+from utils import exception_handler, check_type, print_warning, PATID_START, T
+from row_index import RowIndex
+
+from typing import List, Iterator, Dict, Sequence, Union, TYPE_CHECKING
+
+import numpy as np
 
-import pandas as pd
 import os
 
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+PATIENT_COLUMNS = ["Age.at.diagnosis", "Sex", "Last.known.patient.status"]
+MISSING_VALUE = "NA"  # reported for missing patient fields
+PATIENT_CARD = "PID: {}\n\t- age:\t{}\n\t- sex:\t{}\n\t- outcome:\t{}\n"
+PATIENT_BATCH_SIZE = 4096  # patient cards formatted (and written) at a time
+MAX_QUERY_PATIENTS = 1000000  # patient IDs expanded from a query
+
 
 class Patient:
+    __slots__ = ("_patid", "_age", "_sex", "_pat_status")
+
     def __init__(self, patid: int, age: str, sex: str, pat_status: str) -> None:
         check_type(int, patid)
         if patid <= 99999:
@@ -28,12 +46,7 @@ class Patient:
         return f"<{self.__class__.__name__} object: {os.stat(self).st_size} bytes required>"
 
     def __str__(self) -> str:
-        return str(
-            f"PID: {self.patid}\n"
-            f"\t- age:\t{self.age}\n"
-            f"\t- sex:\t{self.sex}\n"
-            f"\t- outcome:\t{self.pat_status}\n"
-        )
+        return PATIENT_CARD.format(self.patid, self.age, self.sex, self.pat_status)
 
     def _get_patid(self) -> int:
         """(PRIVATE)"""
@@ -75,7 +88,7 @@ class Patients(Dict[int, Patient]):
         return f"<{self.__class__.__name__} object: {len(self.values())}, {os.stat(self).st_size} bytes>"
 
     def __len__(self) -> int:
-        return len(self.values())
+        return dict.__len__(self)
 
     def __iter__(self) -> Iterator[Patient]:
         return PatientsIterator(self)
@@ -115,16 +128,170 @@ class Patients(Dict[int, Patient]):
 class PatientsIterator:
     def __init__(self, patients: Patients) -> None:
         check_type(Patients, patients)
-        self._patients = list(patients.values())
-        self._index = 0
+        self._patients = iter(patients.values())  # no copy of the patients
 
     def __next__(self) -> Patient:
-        if self._index < len(self._patients):
-            pat = self._patients[self._index]
-            self._index += 1
-            assert isinstance(pat, Patient)
-            return pat
-        raise StopIteration
+        pat = next(self._patients)  # raises StopIteration when exhausted
+        assert isinstance(pat, Patient)
+        return pat
+
+
+class PatientView(Patient):
+    """Read-only Patient reading its fields from a row of a PatientTable.
+    Views are created on access and store only the table and the row.
+    """
+
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table: "PatientTable", row: int) -> None:
+        self._table = table
+        self._row = row
+
+    def _get_patid(self) -> int:
+        """(PRIVATE)"""
+        return int(self._table.patids[self._row])
+
+    def _get_age(self) -> str:
+        """(PRIVATE)"""
+        return self._table.value("age", self._row)
+
+    def _get_sex(self) -> str:
+        """(PRIVATE)"""
+        return self._table.value("sex", self._row)
+
+    def _get_pat_status(self) -> str:
+        """(PRIVATE)"""
+        return self._table.value("pat_status", self._row)
+
+
+class PatientTable:
+    """Columnar patients table. Patient IDs and fields are stored as
+    contiguous arrays (fields as category codes), Patient objects are
+    built only on access, as PatientView objects.
+
+    ...
+
+    Attributes
+    ----------
+    patids : numpy.ndarray
+        Patient IDs.
+
+    Methods
+    -------
+    from_dataframe(dataset, debug)
+        Build the table from the dataset, with vectorized operations.
+    rows(pids)
+        Table rows of the given patient IDs.
+    value(field, row)
+        Value of a patient field.
+    cards(rows)
+        Printed records of the patients at the given rows.
+    to_patients()
+        Patients dictionary of the table patients (views).
+    """
+
+    _fields = ["age", "sex", "pat_status"]  # PATIENT_COLUMNS attributes
+
+    def __init__(
+        self,
+        patids: np.ndarray,
+        codes: Dict[str, np.ndarray],
+        categories: Dict[str, np.ndarray],
+    ) -> None:
+        check_type(np.ndarray, patids)
+        check_type(dict, codes)
+        check_type(dict, categories)
+        if patids.size and patids.min() <= 99999:
+            errmsg = f"Forbidden  patient ID ({patids.min()})"
+            exception_handler(ValueError, errmsg, False)
+        if any(codes[field].shape != patids.shape for field in self._fields):
+            errmsg = "Mismatching patient IDs and fields"
+            exception_handler(ValueError, errmsg, False)
+        self._patids = patids
+        self._codes = codes
+        # missing values (code -1) are read from the trailing slot
+        self._categories = {
+            field: np.append(categories[field].astype(object), MISSING_VALUE)
+            for field in self._fields
+        }
+        self._order = np.argsort(patids, kind="stable")  # for ID lookups
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {len(self)} patients>"
+
+    def __len__(self) -> int:
+        return self._patids.shape[0]
+
+    def __contains__(self, pid: int) -> bool:
+        return bool(self.rows([pid])[0] >= 0)
+
+    def __getitem__(self, pid: int) -> PatientView:
+        row = int(self.rows([pid])[0])
+        if row < 0:
+            errmsg = f"Unknown patient ID ({pid})"
+            exception_handler(KeyError, errmsg, False)
+        return PatientView(self, row)
+
+    def __iter__(self) -> Iterator[PatientView]:
+        return (PatientView(self, row) for row in range(len(self)))
+
+    @classmethod
+    def from_dataframe(cls, dataset: pd.DataFrame, debug: bool = False) -> "PatientTable":
+        from categorical import category_codes, codes_dtype
+
+        import pandas as pd
+
+        check_type(pd.DataFrame, dataset, debug)
+        patids = dataset.index.to_numpy(dtype=np.int64) + PATID_START
+        codes, categories = {}, {}
+        for field, col in zip(cls._fields, PATIENT_COLUMNS):
+            col_codes, col_categories = category_codes(dataset[col])
+            codes[field] = col_codes.astype(codes_dtype(len(col_categories)))
+            categories[field] = col_categories.to_numpy()
+        return cls(patids, codes, categories)
+
+    def _get_patids(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._patids
+
+    @property
+    def patids(self) -> np.ndarray:
+        return self._get_patids()
+
+    def rows(self, pids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        """Return the table rows of the patient IDs (-1 for unknown IDs)."""
+        pids = np.asarray(pids, dtype=np.int64)
+        positions = np.searchsorted(self._patids, pids, sorter=self._order)
+        positions = np.minimum(positions, len(self) - 1)
+        rows = self._order[positions] if len(self) else np.zeros_like(pids)
+        found = len(self) > 0 and self._patids[rows] == pids
+        return np.where(found, rows, -1)
+
+    def value(self, field: str, row: int) -> str:
+        return self._categories[field][self._codes[field][row]]
+
+    def values(self, field: str, rows: np.ndarray) -> np.ndarray:
+        return self._categories[field][self._codes[field][rows]]
+
+    def cards(
+        self, rows: np.ndarray, batch_size: int = PATIENT_BATCH_SIZE
+    ) -> Iterator[str]:
+        """Yield the printed patient records of the given rows, by batches.
+        Fields are decoded for a whole batch at once.
+        """
+        for start in range(0, rows.shape[0], batch_size):
+            batch = rows[start : start + batch_size]
+            fields = [self.values(field, batch) for field in self._fields]
+            yield "".join(
+                PATIENT_CARD.format(*values) + "\n"
+                for values in zip(self._patids[batch].tolist(), *fields)
+            )
+
+    def to_patients(self) -> "Patients":
+        patients = Patients()
+        for patient in self:
+            dict.__setitem__(patients, patient.patid, patient)
+        return patients
 
 
 def initialize_patient(row: List[T], patid: int) -> Patient:
@@ -136,19 +303,123 @@ def initialize_patient(row: List[T], patid: int) -> Patient:
     return patient
 
 
+def patient_rows(dataset: pd.DataFrame) -> Iterator[Dict[str, str]]:
+    """Yield the patient fields of each dataset row. Fields are decoded
+    column-wise from their category codes, instead of building a full
+    pandas row for each patient.
+    """
+    from categorical import category_codes
+
+    columns = []
+    for col in PATIENT_COLUMNS:
+        codes, categories = category_codes(dataset[col])
+        # missing values (code -1) are mapped to the trailing None
+        lookup = np.append(categories.to_numpy(dtype=object), None)
+        columns.append(lookup[codes])
+    for values in zip(*columns):
+        yield dict(zip(PATIENT_COLUMNS, values))
+
+
 def build_patients_dict(
     dataset: pd.DataFrame, verbose: bool, debug: bool
 ) -> Dict[int, Patient]:
+    import pandas as pd
+
     check_type(pd.DataFrame, dataset, debug)
-    patslist = dataset.apply(lambda x: initialize_patient(x, x.name), axis=1)
+    patslist = (
+        initialize_patient(row, patid)
+        for patid, row in zip(dataset.index, patient_rows(dataset))
+    )
     patsdict = {patient.patid: patient for patient in patslist}
     return patsdict
 
 
 def build_patients_ds(dataset: pd.DataFrame, verbose: bool, debug: bool) -> Patients:
+    import pandas as pd
+
     check_type(pd.DataFrame, dataset, debug)
     patients = Patients()
-    patslist = dataset.apply(lambda x: initialize_patient(x, x.name), axis=1)
-    for pat in patslist:
+    for patid, row in zip(dataset.index, patient_rows(dataset)):
+        pat = initialize_patient(row, patid)
         patients[pat.patid] = pat
     return patients
+
+
+def parse_patient_ids(pids: List[str], debug: bool = False) -> np.ndarray:
+    """Expand patient IDs and inclusive ID ranges (e.g. 1000010-1000020)
+    to an array of patient IDs, in the given order. At most
+    MAX_QUERY_PATIENTS IDs are expanded.
+    """
+    check_type(list, pids, debug)
+    chunks, requested = [], 0
+    for pid in pids:
+        first, sep, last = pid.strip().partition("-")
+        if not (first.isdigit() and (not sep or last.isdigit())):
+            errmsg = f"Forbidden patient ID or range ({pid})"
+            exception_handler(ValueError, errmsg, debug)
+        first, last = int(first), int(last) if sep else int(first)
+        if last < first:
+            errmsg = f"Forbidden patient ID range ({pid})"
+            exception_handler(ValueError, errmsg, debug)
+        requested += last - first + 1  # checked before expanding the range
+        if requested > MAX_QUERY_PATIENTS:
+            errmsg = f"Too many patients requested (more than {MAX_QUERY_PATIENTS})"
+            exception_handler(ValueError, errmsg, debug)
+        chunks.append(np.arange(first, last + 1, dtype=np.int64))
+    if not chunks:
+        errmsg = "No patient ID given"
+        exception_handler(ValueError, errmsg, debug)
+    return np.concatenate(chunks)
+
+
+def read_patient_ids(pid_file: str, debug: bool = False) -> List[str]:
+    # IDs and ranges separated by whitespaces or commas
+    check_type(str, pid_file, debug)
+    if not os.path.isfile(pid_file):
+        errmsg = f"Unable to locate {pid_file}"
+        exception_handler(FileNotFoundError, errmsg, debug)
+    with open(pid_file, mode="r") as infile:
+        return infile.read().replace(",", " ").split()
+
+
+def check_patient_rows(pids: np.ndarray, rows: np.ndarray, debug: bool = False) -> None:
+    """Fail when none of the patient IDs is known, warn about the unknown
+    ones otherwise.
+    """
+    unknown = pids[rows < 0]
+    if unknown.shape[0] == 0:
+        return
+    shown = ", ".join(str(pid) for pid in unknown[:10].tolist())
+    if unknown.shape[0] > 10:
+        shown += ", ..."
+    if unknown.shape[0] == pids.shape[0]:
+        errmsg = f"Unknown patient ID ({shown})"
+        exception_handler(KeyError, errmsg, debug)
+    print_warning(f"Skipping {unknown.shape[0]} unknown patient IDs ({shown})")
+
+
+def lookup_patients(
+    index: RowIndex, rows: np.ndarray, batch_size: int = PATIENT_BATCH_SIZE
+) -> Iterator[str]:
+    """Yield the printed records of the patients at the given dataset
+    rows, read through the row index, by batches.
+    """
+    check_type(RowIndex, index)
+    batch = []
+    for row, record in zip(rows.tolist(), index.records(rows, PATIENT_COLUMNS)):
+        fields = [
+            MISSING_VALUE if record[col] is None else record[col]
+            for col in PATIENT_COLUMNS
+        ]
+        batch.append(PATIENT_CARD.format(row + PATID_START, *fields) + "\n")
+        if len(batch) == batch_size:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
+
+
+def build_patients_table(
+    dataset: pd.DataFrame, verbose: bool, debug: bool
+) -> PatientTable:
+    return PatientTable.from_dataframe(dataset, debug)
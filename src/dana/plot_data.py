@@ -1,21 +1,62 @@
 """Plotting functionalities
+Plotting and clustering libraries are imported by the functions using
+them, so importing this module stays cheap.
 """
-from utils import check_type
+from __future__ import annotations
 
-import seaborn as sns
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
+from utils import check_type, exception_handler
+from distance import as_euclidean
+from instrumentation import StageProfiler, profiled_call
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, Union, TYPE_CHECKING
+from types import ModuleType
 
-import scipy.cluster.hierarchy as hc
-import scipy.spatial as sp
+import numpy as np
 
 import os
 
+if TYPE_CHECKING:
+    from contingency import ContingencyCube
+
+    import pandas as pd
+
+
+MAX_CLUSTERMAP_LEAVES = 500  # clustermap rows and columns drawn at most
+PLOTS_NUM = 3  # figures drawn by generate_plots
+
+
+def _import_pyplot() -> ModuleType:
+    """(PRIVATE) Import pyplot on the non-interactive Agg backend, figures
+    are only saved.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def get_contingency_cube(
+    dataset: Union[pd.DataFrame, ContingencyCube], debug: bool = False
+) -> ContingencyCube:
+    from contingency import ContingencyCube
+
+    # reuse the counts when already available
+    if isinstance(dataset, ContingencyCube):
+        return dataset
+    return ContingencyCube.from_dataframe(dataset, debug)
+
 
 def plot_age_data(
-    dataset: pd.DataFrame, outdir: str, debug: bool, erbose: bool
+    dataset: Union[pd.DataFrame, ContingencyCube],
+    outdir: str,
+    debug: bool,
+    erbose: bool,
 ) -> None:
+    plt = _import_pyplot()
+
+    cube = get_contingency_cube(dataset, debug)
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 18))
     labels = [
         "<= 25 years",
@@ -25,31 +66,22 @@ def plot_age_data(
         "> 85 years",
     ]
     # age distribution
-    counts_dict = dataset["Age.at.diagnosis"].value_counts().to_dict()
-    counts = [counts_dict[age] for age in labels]
+    counts = cube.age_counts()
     colors = ["#138B29", "#EE9C0D", "#C51307", "#23429B", "#B64220"]
     assert len(labels) == len(counts)
     ax1.bar(labels, counts, color=colors, width=0.4)
     ax1.set_xlabel("Age group", size=18)
     ax1.set_ylabel("Total number", size=18)
     ax1.set_ylim(0, max(counts) + 100)
-    ax1.set_xticklabels(labels, {"fontsize": 14, "rotation": 70})
+    ax1.set_xticklabels(labels, fontdict={"fontsize": 14, "rotation": 70})
     ax1.set_title("Age distribution", fontsize=20, fontweight="bold")
 
     # age by sex distribution
     colors = ["#0D58B7", "#DC661A"]
     series_labels = ["Male", "Female"]
-    barplot_data = {}
-    for age in labels:
-        males_num = dataset[
-            (dataset["Age.at.diagnosis"] == age) & (dataset["Sex"] == "Male")
-        ].shape[0]
-        females_num = dataset[
-            (dataset["Age.at.diagnosis"] == age) & (dataset["Sex"] == "Female")
-        ].shape[0]
-        barplot_data[age] = [males_num, females_num]
-    counts_males = [barplot_data[age][0] for age in labels]
-    counts_females = [barplot_data[age][1] for age in labels]
+    barplot_data = cube.age_sex_counts()
+    counts_males = barplot_data[:, 0].tolist()
+    counts_females = barplot_data[:, 1].tolist()
     x = np.arange(len(labels))
     width = 0.2
     ax2.set_ylim(0, max([max(counts_males), max(counts_females)]) + 100)
@@ -59,18 +91,25 @@ def plot_age_data(
     ax2.tick_params(axis="y", labelsize=14)
     ax2.set_ylabel("Total number", size=18)
     ax2.set_xticks(x)
-    ax2.set_xticklabels(labels, {"fontsize": 14, "rotation": 70})
+    ax2.set_xticklabels(labels, fontdict={"fontsize": 14, "rotation": 70})
     ax2.legend(series_labels, prop={"size": 18})
     ax2.set_xlabel("Age group", size=18)
     ax2.set_title("Age distribution by sex", fontsize=20, fontweight="bold")
     plt.suptitle("Descriptive Analysis", fontsize=26, fontweight="bold")
     outfile = os.path.join(outdir, "age_data.png")
     plt.savefig(outfile, format="png")
+    plt.close(fig)  # release the figure as soon as it is saved
 
 
 def plot_recovery_data(
-    dataset: pd.DataFrame, outdir: str, debug: bool, erbose: bool
+    dataset: Union[pd.DataFrame, ContingencyCube],
+    outdir: str,
+    debug: bool,
+    erbose: bool,
 ) -> None:
+    plt = _import_pyplot()
+
+    cube = get_contingency_cube(dataset, debug)
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 18))
     colors = ["#31B417", "#989B98"]
     series_labels = ["Recovered", "Dead from COVID-19"]
@@ -82,21 +121,7 @@ def plot_recovery_data(
         "66 - 85 years",
         "> 85 years",
     ]
-    stack_data_rec = {}
-    for age in labels:
-        stack_data_rec[age] = dataset[
-            (dataset["Last.known.patient.status"] == "Recovered")
-            & (dataset["Age.at.diagnosis"] == age)
-        ].shape[0]
-    stack_data_dead = {}
-    for age in labels:
-        stack_data_dead[age] = dataset[
-            (dataset["Last.known.patient.status"] == "Dead from COVID-19")
-            & (dataset["Age.at.diagnosis"] == age)
-        ].shape[0]
-    stack_data = np.array(
-        [list(stack_data_rec.values()), list(stack_data_dead.values())]
-    )
+    stack_data = cube.outcome_age_counts()
     stack_data_pct = np.array(
         [
             [
@@ -121,29 +146,15 @@ def plot_recovery_data(
         )
         cumul_size += counts
     ax1.set_xticks(ind)
-    ax1.set_xticklabels(labels, {"fontsize": 14, "rotation": 70})
+    ax1.set_xticklabels(labels, fontdict={"fontsize": 14, "rotation": 70})
     ax1.set_yticks([20 * i for i in range(6)])
-    ax1.set_yticklabels([f"{20 * i}%" for i in range(6)], {"fontsize": 14})
+    ax1.set_yticklabels([f"{20 * i}%" for i in range(6)], fontdict={"fontsize": 14})
     ax1.set_ylabel("Patients number", size=18)
     ax1.legend(series_labels, prop={"size": 18})
 
     # stacked bar chart by sex
     labels = ["Male", "Female"]
-    stack_data_rec = {}
-    for sex in labels:
-        stack_data_rec[sex] = dataset[
-            (dataset["Last.known.patient.status"] == "Recovered")
-            & (dataset["Sex"] == sex)
-        ].shape[0]
-    stack_data_dead = {}
-    for sex in labels:
-        stack_data_dead[sex] = dataset[
-            (dataset["Last.known.patient.status"] == "Dead from COVID-19")
-            & (dataset["Sex"] == sex)
-        ].shape[0]
-    stack_data = np.array(
-        [list(stack_data_rec.values()), list(stack_data_dead.values())]
-    )
+    stack_data = cube.outcome_sex_counts()
     stack_data_pct = np.array(
         [
             [
@@ -168,30 +179,158 @@ def plot_recovery_data(
         )
         cumul_size += counts
     ax2.set_xticks(ind)
-    ax2.set_xticklabels(labels, {"fontsize": 14, "rotation": 70})
+    ax2.set_xticklabels(labels, fontdict={"fontsize": 14, "rotation": 70})
     ax2.set_yticks([20 * i for i in range(6)])
-    ax2.set_yticklabels([f"{20 * i}%" for i in range(6)], {"fontsize": 14})
+    ax2.set_yticklabels([f"{20 * i}%" for i in range(6)], fontdict={"fontsize": 14})
     ax2.set_ylabel("Patients number", size=18)
     ax2.legend(series_labels, prop={"size": 18})
     outfile = os.path.join(outdir, "recovery_data.png")
     plt.savefig(outfile, format="png")
+    plt.close(fig)  # release the figure as soon as it is saved
 
 
-def plot_clusters(
-    dist_mat: np.ndarray, outdir: str, debug: bool, verbose: bool
-) -> None:
+def cluster_plot_data(
+    dist_mat: np.ndarray,
+    verbose: bool,
+    weights: Optional[np.ndarray] = None,
+    max_leaves: int = MAX_CLUSTERMAP_LEAVES,
+) -> Tuple[np.ndarray, np.ndarray]:
+    from clustering import (
+        compute_linkage,
+        aggregate_clusters,
+        weighted_average_linkage,
+        observation_linkage,
+    )
+    from scipy.spatial.distance import squareform
+
     check_type(np.ndarray, dist_mat)
+    check_type(int, max_leaves)
+    # square or condensed matrices, integer matrices store mismatch counts
+    linkage = compute_linkage(dist_mat, weights)
+    nobs = linkage.shape[0] + 1
+    if nobs > max_leaves:
+        # draw the average distances between at most max_leaves clusters,
+        # linked as clusters of the original dendrogram
+        dist_mat, sizes, _ = aggregate_clusters(dist_mat, linkage, max_leaves, weights)
+        linkage = weighted_average_linkage(
+            squareform(dist_mat, checks=False), sizes
+        )
+        if verbose:
+            print(f"Clustermap: {nobs} observations aggregated in {sizes.shape[0]} clusters")
+    elif dist_mat.ndim == 1:
+        dist_mat = squareform(as_euclidean(dist_mat))
+    else:
+        dist_mat = as_euclidean(dist_mat)
+    return dist_mat, observation_linkage(linkage)  # sizes count the drawn rows
+
+
+def render_clusters(dist_mat: np.ndarray, linkage: np.ndarray, outdir: str) -> None:
+    check_type(np.ndarray, dist_mat)
+    check_type(np.ndarray, linkage)
     check_type(str, outdir)
     outfile = os.path.join(outdir, "distance_matrix.png")
-    linkage = hc.linkage(sp.distance.squareform(dist_mat), method="average")
-    fig = plt.figure(figsize=(15, 15))
-    sns.clustermap(dist_mat, row_linkage=linkage, col_linkage=linkage)
-    plt.savefig(outfile, format="png")
+    plt = _import_pyplot()
+    import seaborn as sns
+
+    grid = sns.clustermap(dist_mat, row_linkage=linkage, col_linkage=linkage)
+    grid.fig.savefig(outfile, format="png")
+    plt.close(grid.fig)  # release the figure as soon as it is saved
+
+
+def plot_clusters(
+    dist_mat: np.ndarray,
+    outdir: str,
+    debug: bool,
+    verbose: bool,
+    weights: Optional[np.ndarray] = None,
+    max_leaves: int = MAX_CLUSTERMAP_LEAVES,
+) -> None:
+    check_type(str, outdir)
+    dist_mat, linkage = cluster_plot_data(dist_mat, verbose, weights, max_leaves)
+    render_clusters(dist_mat, linkage, outdir)
+
+
+def _init_plot_worker() -> None:
+    """(PRIVATE) Import pyplot once per worker, on a non-interactive
+    backend.
+    """
+    _import_pyplot()
 
 
 def generate_plots(
-    dataset: pd.DataFrame, dist_mat: np.ndarray, outdir: str, debug: bool, verbose: bool
+    dataset: Union[pd.DataFrame, ContingencyCube],
+    dist_mat: np.ndarray,
+    outdir: str,
+    debug: bool,
+    verbose: bool,
+    weights: Optional[np.ndarray] = None,
+    max_leaves: int = MAX_CLUSTERMAP_LEAVES,
+    jobs: int = 1,
+    profiler: Optional[StageProfiler] = None,
 ) -> None:
-    plot_age_data(dataset, outdir, debug, verbose)
-    plot_recovery_data(dataset, outdir, debug, verbose)
-    plot_clusters(dist_mat, outdir, debug, verbose)
+    check_type(int, jobs, debug)
+    if jobs < 1:
+        errmsg = f"Forbidden number of plotting processes ({jobs})"
+        exception_handler(ValueError, errmsg, debug)
+    if profiler is None:
+        profiler = StageProfiler()  # disabled
+    cube = get_contingency_cube(dataset, debug)  # shared by descriptive plots
+    if jobs == 1:
+        with profiler.stage("plot_age"):
+            plot_age_data(cube, outdir, debug, verbose)
+        with profiler.stage("plot_recovery"):
+            plot_recovery_data(cube, outdir, debug, verbose)
+        with profiler.stage("cluster"):
+            cluster_mat, linkage = cluster_plot_data(
+                dist_mat, verbose, weights, max_leaves
+            )
+        with profiler.stage("plot_clusters"):
+            render_clusters(cluster_mat, linkage, outdir)
+        return
+    # each figure is rendered by a separate process, which receives only
+    # the data it draws
+    with ProcessPoolExecutor(
+        max_workers=min(jobs, PLOTS_NUM), initializer=_init_plot_worker
+    ) as executor:
+        # workers measure their own stages and send the measures back
+        futures = [
+            executor.submit(
+                profiled_call,
+                "plot_age",
+                profiler.enabled,
+                plot_age_data,
+                cube,
+                outdir,
+                debug,
+                verbose,
+            ),
+            executor.submit(
+                profiled_call,
+                "plot_recovery",
+                profiler.enabled,
+                plot_recovery_data,
+                cube,
+                outdir,
+                debug,
+                verbose,
+            ),
+        ]
+        # clustering runs meanwhile, only its result is sent to the worker
+        with profiler.stage("cluster"):
+            cluster_mat, linkage = cluster_plot_data(
+                dist_mat, verbose, weights, max_leaves
+            )
+        futures.append(
+            executor.submit(
+                profiled_call,
+                "plot_clusters",
+                profiler.enabled,
+                render_clusters,
+                cluster_mat,
+                linkage,
+                outdir,
+            )
+        )
+        for future in futures:
+            _, record = future.result()  # raise errors occurred while plotting
+            profiler.add(record)
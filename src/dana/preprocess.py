@@ -0,0 +1,358 @@
+"""Clinical dataset preprocessing.
+Raw registry extracts are cleaned by declarative rules, read from a
+JSON file, before the analysis:
+
+{
+    "decimal": ",",
+    "defaults": {"categorical": {"fillna": "mode"}},
+    "columns": {
+        "LEUCOCITI": {"type": "numerical", "units": ["10^9"]},
+        "START": {"type": "date", "format": "%d/%m/%Y"}
+    },
+    "derived": {"AGE": {"years_between": ["BIRTHDAY", "START"]}},
+    "drop": ["BIRTHDAY", "START"]
+}
+
+Column rules set the column type (numerical, categorical or date; the
+type of the columns without rules is inferred), the units of measure
+removed from the values, the decimal separator, the dates format and how
+missing values are filled (mode, mean, median or a constant value).
+Defaults rules apply to the columns of a type without their own rule.
+Derived columns are computed from the typed columns, then the dropped
+columns are removed. Text is parsed once per distinct value of a column,
+every other step works on whole columns.
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type, print_warning
+
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import json
+import re
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+COLUMN_TYPES = ["numerical", "categorical", "date"]
+FILL_STRATEGIES = ["mode", "mean", "median"]  # or a constant value
+RULE_KEYS = ["type", "units", "decimal", "format", "fillna"]
+DERIVED_RULES = ["years_between"]
+
+
+class PreprocessRules:
+    """Declarative preprocessing rules of a dataset.
+
+    ...
+
+    Attributes
+    ----------
+    decimal : str
+        Decimal separator of numerical values.
+    defaults : Dict[str, Dict]
+        Rules of the columns without their own rule, by column type.
+    columns : Dict[str, Dict]
+        Rules of the dataset columns.
+    derived : Dict[str, Dict]
+        Rules of the derived columns.
+    drop : List[str]
+        Columns removed from the preprocessed dataset.
+
+    Methods
+    -------
+    from_dict(rules, debug)
+        Validate the rules.
+    load(rules_file, debug)
+        Read the rules from a JSON file.
+    column_rule(column, column_type)
+        Rule of a dataset column.
+    """
+
+    def __init__(
+        self,
+        decimal: str,
+        defaults: Dict[str, Dict],
+        columns: Dict[str, Dict],
+        derived: Dict[str, Dict],
+        drop: List[str],
+    ) -> None:
+        check_type(str, decimal)
+        check_type(dict, defaults)
+        check_type(dict, columns)
+        check_type(dict, derived)
+        check_type(list, drop)
+        self._decimal = decimal
+        self._defaults = defaults
+        self._columns = columns
+        self._derived = derived
+        self._drop = drop
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {len(self._columns)} column rules>"
+
+    @classmethod
+    def from_dict(cls, rules: Dict, debug: bool = False) -> "PreprocessRules":
+        check_type(dict, rules, debug)
+        unknown = set(rules) - {"decimal", "defaults", "columns", "derived", "drop"}
+        if unknown:
+            errmsg = f"Unknown preprocessing rules ({', '.join(sorted(unknown))})"
+            exception_handler(ValueError, errmsg, debug)
+        decimal = rules.get("decimal", ".")
+        if not isinstance(decimal, str) or len(decimal) != 1:
+            errmsg = f"Forbidden decimal separator ({decimal})"
+            exception_handler(ValueError, errmsg, debug)
+        defaults = rules.get("defaults", {})
+        check_type(dict, defaults, debug)
+        for column_type, rule in defaults.items():
+            if column_type not in COLUMN_TYPES:
+                errmsg = f"Unknown column type in defaults rules ({column_type})"
+                exception_handler(ValueError, errmsg, debug)
+            check_rule(f"{column_type} columns", {**rule, "type": column_type}, debug)
+        columns = rules.get("columns", {})
+        check_type(dict, columns, debug)
+        for col, rule in columns.items():
+            check_rule(col, rule, debug)
+        derived = rules.get("derived", {})
+        check_type(dict, derived, debug)
+        for col, rule in derived.items():
+            check_type(dict, rule, debug)
+            kinds = [key for key in rule if key in DERIVED_RULES]
+            if len(kinds) != 1 or set(rule) - set(DERIVED_RULES) - {"fillna"}:
+                errmsg = f"Forbidden rule of derived column {col}"
+                exception_handler(ValueError, errmsg, debug)
+            sources = rule[kinds[0]]
+            if not isinstance(sources, list) or len(sources) != 2:
+                errmsg = f"Derived column {col} requires two source columns"
+                exception_handler(ValueError, errmsg, debug)
+            check_rule(col, {"fillna": rule.get("fillna")}, debug)
+        drop = rules.get("drop", [])
+        check_type(list, drop, debug)
+        return cls(decimal, defaults, columns, derived, drop)
+
+    @classmethod
+    def load(cls, rules_file: str, debug: bool = False) -> "PreprocessRules":
+        check_type(str, rules_file, debug)
+        try:
+            with open(rules_file, mode="r") as infile:
+                rules = json.load(infile)
+        except (OSError, ValueError) as e:
+            errmsg = f"An error occurred while reading the preprocessing rules {rules_file}"
+            exception_handler(e.__class__, errmsg, debug)
+        return cls.from_dict(rules, debug)
+
+    def _get_decimal(self) -> str:
+        """(PRIVATE)"""
+        return self._decimal
+
+    @property
+    def decimal(self) -> str:
+        return self._get_decimal()
+
+    def _get_defaults(self) -> Dict[str, Dict]:
+        """(PRIVATE)"""
+        return self._defaults
+
+    @property
+    def defaults(self) -> Dict[str, Dict]:
+        return self._get_defaults()
+
+    def _get_columns(self) -> Dict[str, Dict]:
+        """(PRIVATE)"""
+        return self._columns
+
+    @property
+    def columns(self) -> Dict[str, Dict]:
+        return self._get_columns()
+
+    def _get_derived(self) -> Dict[str, Dict]:
+        """(PRIVATE)"""
+        return self._derived
+
+    @property
+    def derived(self) -> Dict[str, Dict]:
+        return self._get_derived()
+
+    def _get_drop(self) -> List[str]:
+        """(PRIVATE)"""
+        return self._drop
+
+    @property
+    def drop(self) -> List[str]:
+        return self._get_drop()
+
+    def column_rule(self, column: str, column_type: str) -> Dict:
+        """Rule of the column, the defaults of its type when it has none
+        (column_type is the inferred type).
+        """
+        rule = self._columns.get(column)
+        if rule is None:
+            rule = self._defaults.get(column_type, {})
+        return {"decimal": self._decimal, "type": column_type, **rule}
+
+
+def check_rule(column: str, rule: Dict, debug: bool = False) -> None:
+    check_type(dict, rule, debug)
+    unknown = set(rule) - set(RULE_KEYS)
+    if unknown:
+        errmsg = f"Unknown rules of column {column} ({', '.join(sorted(unknown))})"
+        exception_handler(ValueError, errmsg, debug)
+    if "type" in rule and rule["type"] not in COLUMN_TYPES:
+        errmsg = f"Unknown type of column {column} ({rule['type']})"
+        exception_handler(ValueError, errmsg, debug)
+    if not isinstance(rule.get("units", []), list):
+        errmsg = f"Units of measure of column {column} must be a list"
+        exception_handler(ValueError, errmsg, debug)
+    fillna = rule.get("fillna")
+    if fillna in ("mean", "median") and rule.get("type") in ("categorical", "date"):
+        errmsg = f"Forbidden {fillna} of {rule['type']} column {column}"
+        exception_handler(ValueError, errmsg, debug)
+
+
+def strip_units(column: pd.Series, units: List[str]) -> pd.Series:
+    """Remove the units of measure (e.g. "9,26 10^9/L" -> "9,26"): the
+    text from the first unit on is removed.
+    """
+    if not units:
+        return column
+    pattern = "|".join(re.escape(unit) for unit in units)
+    return column.str.replace(f"\\s*(?:{pattern}).*$", "", regex=True)
+
+
+def parse_numbers(column: pd.Series, decimal: str = ".") -> pd.Series:
+    """Numerical values of the column, missing when not a number."""
+    import pandas as pd
+
+    if decimal != ".":
+        column = column.str.replace(decimal, ".", regex=False)
+    return pd.to_numeric(column.str.strip(), errors="coerce")
+
+
+def parse_dates(column: pd.Series, date_format: Optional[str] = None) -> pd.Series:
+    """Dates of the column (as by the format), missing when not a date."""
+    import pandas as pd
+
+    return pd.to_datetime(column.str.strip(), format=date_format, errors="coerce")
+
+
+def years_between(start: pd.Series, stop: pd.Series) -> pd.Series:
+    """Years from start to stop (e.g. age from birth year to visit date).
+    Dates are taken by their year; negative spans are missing.
+    """
+    import pandas as pd
+
+    years = [
+        col.dt.year if pd.api.types.is_datetime64_any_dtype(col) else col
+        for col in (start, stop)
+    ]
+    span = (years[1] - years[0]).round().astype("Int64")
+    return span.where(span >= 0)
+
+
+def fill_missing(column: pd.Series, fillna: object) -> pd.Series:
+    """Fill the missing values with the column mode, mean or median, or
+    with the given value.
+    """
+    if fillna is None or not column.isna().any():
+        return column
+    if fillna == "mode":
+        counts = column.value_counts()
+        if counts.empty:
+            return column
+        value = counts.index[0]  # most frequent value
+    elif fillna == "mean":
+        value = column.mean()
+    elif fillna == "median":
+        value = column.median()
+    else:
+        value = fillna
+    if column.dtype.kind == "i" and not float(value).is_integer():
+        column = column.astype("float64")  # mean of integer values
+    return column.fillna(value)
+
+
+def infer_column_type(column: pd.Series, decimal: str = ".") -> str:
+    # numerical when all the values are numbers
+    values = column.dropna()
+    if values.empty or parse_numbers(values, decimal).notna().all():
+        return "numerical"
+    return "categorical"
+
+
+def preprocess_dataset(
+    dataset: pd.DataFrame,
+    rules: PreprocessRules,
+    debug: bool = False,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Apply the preprocessing rules to the dataset, read as raw strings.
+    Returns the typed, preprocessed dataset.
+    """
+    import pandas as pd
+
+    check_type(pd.DataFrame, dataset, debug)
+    check_type(PreprocessRules, rules, debug)
+    # columns the derived columns are computed from
+    sources = [
+        col
+        for rule in rules.derived.values()
+        for key in DERIVED_RULES
+        for col in rule.get(key, [])
+    ]
+    unknown = [
+        col
+        for col in list(rules.columns) + sources + rules.drop
+        if col not in dataset.columns and col not in rules.derived
+    ]
+    if unknown:
+        errmsg = f"Preprocessing rules of unknown columns ({', '.join(unknown)})"
+        exception_handler(ValueError, errmsg, debug)
+    columns = {}
+    for col in dataset.columns:
+        if col in rules.drop and col not in sources:
+            continue  # never parsed
+        # values are parsed once each, then expanded to the rows
+        codes, uniques = pd.factorize(dataset[col])
+        values = pd.Series(uniques, dtype=dataset[col].dtype)
+        explicit = rules.columns.get(col, {})
+        values = strip_units(values, explicit.get("units", []))
+        column_type = explicit.get("type") or infer_column_type(values, rules.decimal)
+        rule = rules.column_rule(col, column_type)
+        if col not in rules.columns:
+            values = strip_units(values, rule.get("units", []))
+        if rule.get("fillna") in ("mean", "median") and rule["type"] != "numerical":
+            errmsg = f"Forbidden {rule['fillna']} of {rule['type']} column {col}"
+            exception_handler(ValueError, errmsg, debug)
+        if rule["type"] == "numerical":
+            typed = parse_numbers(values, rule["decimal"])
+            if not typed.isna().all() and (typed.dropna() % 1 == 0).all():
+                typed = typed.astype("Int64")
+        elif rule["type"] == "date":
+            typed = parse_dates(values, rule.get("format"))
+        else:
+            typed = values.str.strip()
+        typed = pd.Series(
+            typed.array.take(codes, allow_fill=True), index=dataset.index, name=col
+        )
+        invalid = 0 if rule["type"] == "categorical" else int(
+            (typed.isna().to_numpy() & (codes >= 0)).sum()
+        )
+        if invalid:
+            print_warning(f"{invalid} values of column {col} are not {rule['type']}")
+        columns[col] = fill_missing(typed, rule.get("fillna"))
+        if verbose:
+            print(f"{col}: {rule['type']}")
+    for col, rule in rules.derived.items():
+        start, stop = rule["years_between"]
+        for source in (start, stop):
+            if columns[source].dtype.kind not in "iufM":
+                errmsg = f"Derived column {col} requires numerical or date columns ({source})"
+                exception_handler(ValueError, errmsg, debug)
+        derived = years_between(columns[start], columns[stop])
+        invalid = int((derived.isna() & columns[start].notna() & columns[stop].notna()).sum())
+        if invalid:
+            print_warning(f"{invalid} negative values of derived column {col}")
+        columns[col] = fill_missing(derived, rule.get("fillna"))
+    for col in rules.drop:
+        columns.pop(col, None)
+    return pd.DataFrame(columns, index=dataset.index)
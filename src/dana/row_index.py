@@ -0,0 +1,234 @@
+"""Persistent row index of dataset files.
+The RowIndex maps each patient ID to the byte offset of its record in
+the dataset CSV, so a single patient can be read without parsing the
+whole file. Indexes are stored in the cache directory and rebuilt when
+the dataset file changes.
+"""
+from utils import exception_handler, check_type, print_warning, PATID_START
+from csv_input import CsvInput
+
+from contextlib import nullcontext
+from typing import BinaryIO, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+
+import hashlib
+import mmap
+import json
+import csv
+import os
+
+
+INDEX_FORMAT_VERSION = 1  # bump when the index layout changes
+# pandas default missing values, reported as missing patient fields
+NA_VALUES = {
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+}
+
+
+class RowIndex:
+    """Byte offsets of the records of a dataset CSV file.
+
+    ...
+
+    Attributes
+    ----------
+    header : List[str]
+        Dataset columns.
+    offsets : numpy.ndarray
+        Byte offset of each record (header excluded).
+
+    Methods
+    -------
+    build(csv_file, separator)
+        Index the records of a dataset.
+    rows(pids)
+        Record rows of the given patient IDs.
+    record(pid, columns)
+        Read the requested columns of a patient record.
+    records(rows, columns)
+        Read the requested columns of several records.
+    """
+
+    def __init__(
+        self,
+        csv_file: str,
+        separator: str,
+        header: List[str],
+        offsets: np.ndarray,
+        handle: Optional[BinaryIO] = None,
+    ) -> None:
+        check_type(str, csv_file)
+        check_type(str, separator)
+        check_type(list, header)
+        check_type(np.ndarray, offsets)
+        self._csv_file = csv_file
+        self._separator = separator
+        self._header = header
+        self._offsets = offsets
+        self._handle = handle  # already open dataset file, if any
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {len(self)} records>"
+
+    def __len__(self) -> int:
+        return self._offsets.shape[0]
+
+    @classmethod
+    def build(
+        cls, csv_file: str, separator: str, handle: Optional[BinaryIO] = None
+    ) -> Optional["RowIndex"]:
+        """Index the dataset records. Returns None when records cannot be
+        located by line (quoted fields may span several lines).
+        """
+        opened = open(csv_file, mode="rb") if handle is None else nullcontext(handle)
+        with opened as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data.find(b'"') >= 0:
+                    return None
+                buffer = np.frombuffer(data, dtype=np.uint8)
+                starts = np.concatenate(([0], np.flatnonzero(buffer == 10) + 1))
+                del buffer  # release the mmap export
+                header_end = data.find(b"\n")
+                header = data[: header_end if header_end >= 0 else len(data)]
+                size = len(data)
+        # skip blank lines, as pandas does
+        ends = np.append(starts[1:], size)
+        lengths = ends - starts
+        starts = starts[(lengths > 1) & (starts < size)]
+        header = next(csv.reader([header.decode().rstrip("\r\n")], delimiter=separator))
+        return cls(csv_file, separator, header, starts[1:].astype(np.int64), handle)
+
+    def _get_header(self) -> List[str]:
+        """(PRIVATE)"""
+        return self._header
+
+    @property
+    def header(self) -> List[str]:
+        return self._get_header()
+
+    def _get_offsets(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._offsets
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self._get_offsets()
+
+    def rows(self, pids: np.ndarray) -> np.ndarray:
+        """Return the record rows of the patient IDs (-1 for unknown IDs)."""
+        rows = np.asarray(pids, dtype=np.int64) - PATID_START
+        return np.where((rows >= 0) & (rows < len(self)), rows, -1)
+
+    def record(self, pid: int, columns: List[str]) -> Optional[Dict[str, str]]:
+        """Read the columns of the patient record (None if the patient ID
+        is unknown). Missing values are returned as None.
+        """
+        row = int(self.rows([pid])[0])
+        if row < 0:
+            return None
+        return next(self.records(np.array([row]), columns))
+
+    def records(self, rows: np.ndarray, columns: List[str]) -> Iterator[Dict[str, str]]:
+        """Read the columns of the given records, in order, from a single
+        open handle. Missing values are returned as None.
+        """
+        positions = [self._header.index(col) for col in columns]
+        if self._handle is None:
+            opened = open(self._csv_file, mode="rb")
+        else:
+            opened = nullcontext(self._handle)
+        with opened as handle:
+            for row in rows:
+                handle.seek(int(self._offsets[row]))
+                line = handle.readline().decode().rstrip("\r\n")
+                fields = next(csv.reader([line], delimiter=self._separator))
+                yield {
+                    col: (
+                        fields[i]
+                        if i < len(fields) and fields[i] not in NA_VALUES
+                        else None
+                    )
+                    for col, i in zip(columns, positions)
+                }
+
+
+def index_files(cache_dir: str, csv_file: str) -> tuple:
+    # one index per dataset path
+    name = hashlib.sha256(os.path.abspath(csv_file).encode()).hexdigest()
+    name = os.path.join(cache_dir, f"{name}.index")
+    return f"{name}.npy", f"{name}.json"
+
+
+def load_row_index(
+    csv_file: Union[str, CsvInput],
+    separator: str,
+    cache_dir: Optional[str],
+    debug: bool = False,
+) -> Optional[RowIndex]:
+    """Load the dataset row index from the cache directory, (re)building
+    it when missing or outdated. Without cache directory, the index is
+    built in memory and not stored. Returns None when the dataset records
+    cannot be indexed. Records are read through the open dataset file,
+    when given.
+    """
+    handle = None
+    if isinstance(csv_file, CsvInput):
+        csv_file, handle = csv_file.csv_file, csv_file.rewind()
+    check_type(str, csv_file, debug)
+    check_type(str, separator, debug)
+    if not os.path.isfile(csv_file):
+        errmsg = f"Unable to locate {csv_file}"
+        exception_handler(FileNotFoundError, errmsg, debug)
+    if cache_dir is None:
+        return RowIndex.build(csv_file, separator, handle)
+    check_type(str, cache_dir, debug)
+    stat = os.stat(csv_file)
+    source = {
+        "version": INDEX_FORMAT_VERSION,
+        "separator": separator,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+    offsets_file, metadata_file = index_files(cache_dir, csv_file)
+    try:
+        with open(metadata_file, mode="r") as infile:
+            metadata = json.load(infile)
+        if metadata["source"] == source:  # dataset unchanged
+            if metadata["header"] is None:
+                return None  # dataset cannot be indexed
+            offsets = np.load(offsets_file, mmap_mode="r")
+            return RowIndex(csv_file, separator, metadata["header"], offsets, handle)
+    except (OSError, ValueError, KeyError):
+        pass  # missing or unreadable index, build it
+    index = RowIndex.build(csv_file, separator, handle)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if index is not None:
+            np.save(offsets_file, index.offsets)
+        with open(metadata_file, mode="w") as outfile:
+            header = None if index is None else index.header
+            json.dump({"source": source, "header": header}, outfile)
+    except OSError as e:
+        print_warning(f"Unable to store {csv_file} row index in {cache_dir} ({e})")
+    return index
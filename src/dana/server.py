@@ -0,0 +1,400 @@
+"""Resident DANA analysis server.
+The dataset is parsed once, when the server starts, together with its
+statistics profile, the patients table and the category codes of every
+column. Requests are answered from these read-only structures, so they
+never parse data again and concurrent requests are served by separate
+threads without locking.
+
+Endpoints (HTTP GET, JSON responses):
+
+/                   dataset name and shape
+/introduce          patient records (pid=ID or pid=FIRST-LAST, repeatable;
+                    format=text for the printed records)
+/statistics         summary statistics of every column
+                    (column=NAME for the value counts of a column)
+/cohort             patients matching COLUMN=VALUE filters (repeated
+                    columns match any of the values), counted by the
+                    values of a column with by=NAME
+/similar            patients most similar to the given ones (pid=ID,
+                    repeatable; k=NUMBER of similar patients)
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type
+from patient import (
+    MISSING_VALUE,
+    PATIENT_CARD,
+    MAX_QUERY_PATIENTS,
+    parse_patient_ids,
+)
+from similarity import SimilarityIndex, SIMILAR_PATIENTS
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from argparse import Namespace
+from typing import Dict, List, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+import socketserver
+import threading
+import signal
+import json
+import stat
+import time
+import os
+
+if TYPE_CHECKING:
+    from dataset_profile import DatasetProfile
+    from patient import PatientTable
+
+    import pandas as pd
+
+
+MAX_SIMILAR_QUERIES = 100  # patients compared to the dataset by a request
+PATIENT_FIELDS = ["age", "sex", "pat_status"]  # PatientTable fields
+
+
+class QueryError(Exception):
+    """Malformed request, answered with a 400 (Bad Request) status."""
+
+
+class ServerData:
+    """Read-only analysis structures of the served dataset.
+
+    ...
+
+    Attributes
+    ----------
+    dataset : str
+        Served dataset file.
+    profile : DatasetProfile
+        Statistics profile of the dataset.
+    patients : PatientTable
+        Patients table.
+
+    Methods
+    -------
+    introduce(pids)
+        Records of the given patients.
+    statistics(column)
+        Summary statistics, or value counts of a column.
+    cohort(filters, by)
+        Patients matching the filters, optionally counted by a column.
+    similar(pids, k)
+        Patients most similar to the given patients.
+    """
+
+    def __init__(
+        self, dataset: str, df: pd.DataFrame, debug: bool = False, verbose: bool = False
+    ) -> None:
+        from dataset_analyzer import compute_dataset_profile
+        from patient import build_patients_table
+        from categorical import category_codes
+
+        check_type(str, dataset, debug)
+        self._dataset = dataset
+        self._shape = df.shape
+        self._profile = compute_dataset_profile(df, debug, verbose)
+        self._patients = build_patients_table(df, verbose, debug)
+        # category codes of every column, for cohort counts
+        self._codes, self._categories, self._lookup = {}, {}, {}
+        for col in df.columns:
+            codes, categories = category_codes(df[col])
+            labels = [value_label(c) for c in categories]
+            self._codes[col] = np.asarray(codes)
+            self._categories[col] = labels + [MISSING_VALUE]  # code -1
+            self._lookup[col] = {label: i for i, label in enumerate(labels)}
+        self._similarity = SimilarityIndex.build([df])
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {self._dataset}, {self._shape[0]} rows>"
+
+    def _get_dataset(self) -> str:
+        """(PRIVATE)"""
+        return self._dataset
+
+    @property
+    def dataset(self) -> str:
+        return self._get_dataset()
+
+    def _get_profile(self) -> DatasetProfile:
+        """(PRIVATE)"""
+        return self._profile
+
+    @property
+    def profile(self) -> DatasetProfile:
+        return self._get_profile()
+
+    def _get_patients(self) -> PatientTable:
+        """(PRIVATE)"""
+        return self._patients
+
+    @property
+    def patients(self) -> PatientTable:
+        return self._get_patients()
+
+    def info(self) -> Dict:
+        return {
+            "dataset": os.path.basename(self._dataset),
+            "rows": self._shape[0],
+            "columns": list(self._codes.keys()),
+        }
+
+    def _parse_pids(self, pids: List[str]) -> np.ndarray:
+        """(PRIVATE) Requested patient IDs and ID ranges."""
+        try:
+            return parse_patient_ids(pids, True)
+        except ValueError as e:
+            raise QueryError(str(e).strip()) from e
+
+    def introduce(self, pids: List[str]) -> Tuple[List[Dict], List[int]]:
+        """Records of the given patients and the unknown patient IDs."""
+        pids = self._parse_pids(pids)
+        rows = self._patients.rows(pids)
+        found = rows[rows >= 0]
+        fields = [
+            self._patients.values(field, found).tolist()
+            for field in PATIENT_FIELDS
+        ]
+        records = [
+            dict(zip(["pid", "age", "sex", "outcome"], values))
+            for values in zip(self._patients.patids[found].tolist(), *fields)
+        ]
+        return records, pids[rows < 0].tolist()
+
+    def statistics(self, column: str = None) -> Dict:
+        if column is None:
+            from summary_report import summary_records
+
+            return {
+                "rows": self._shape[0],
+                "columns": self._shape[1],
+                "summary": summary_records(self._profile),
+            }
+        if column not in self._codes:
+            raise QueryError(f"Unknown column ({column})")
+        counts = self._profile.value_counts(column)
+        return {
+            "column": column,
+            "type": self._profile.column_types[column],
+            "counts": dict(zip(map(value_label, counts.index), counts.tolist())),
+        }
+
+    def cohort(self, filters: Dict[str, List[str]], by: str = None) -> Dict:
+        mask = np.ones(self._shape[0], dtype=bool)
+        for col, values in filters.items():
+            if col not in self._codes:
+                raise QueryError(f"Unknown column ({col})")
+            # unknown values match no patient
+            codes = [self._lookup[col].get(value, -2) for value in values]
+            mask &= np.isin(self._codes[col], codes)
+        result = {"filters": filters, "count": int(np.count_nonzero(mask))}
+        if by is not None:
+            if by not in self._codes:
+                raise QueryError(f"Unknown column ({by})")
+            labels = self._categories[by]
+            counts = by_counts(self._codes[by][mask], len(labels))
+            result["by"] = by
+            result["counts"] = {
+                label: int(count) for label, count in zip(labels, counts) if count
+            }
+        return result
+
+    def similar(self, pids: List[str], k: int = SIMILAR_PATIENTS) -> Dict:
+        pids = self._parse_pids(pids)
+        if pids.shape[0] > MAX_SIMILAR_QUERIES:
+            raise QueryError(f"Too many query patients ({pids.shape[0]})")
+        if not 0 < k <= MAX_QUERY_PATIENTS or k * pids.shape[0] > MAX_QUERY_PATIENTS:
+            raise QueryError(f"Forbidden number of similar patients ({k})")
+        rows = self._similarity.rows(pids)
+        found = rows >= 0
+        nearest, distances = self._similarity.nearest(
+            self._similarity.profiles(rows[found]), k, rows[found]
+        )
+        patids = self._patients.patids
+        distances = np.round(np.sqrt(distances), 4)  # Euclidean distances
+        return {
+            "similar": [
+                {
+                    "pid": pid,
+                    "patients": [
+                        {"pid": p, "distance": d}
+                        for p, d in zip(patids[row].tolist(), dists.tolist())
+                    ],
+                }
+                for pid, row, dists in zip(pids[found].tolist(), nearest, distances)
+            ],
+            "unknown": pids[~found].tolist(),
+        }
+
+
+def value_label(value: object) -> str:
+    """Label of a column value in requests and responses. Integral
+    floats (integer columns with missing values) are labeled as integers.
+    """
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def by_counts(codes: np.ndarray, slots: int) -> np.ndarray:
+    """Counts of each code, missing values (code -1) in the last slot."""
+    return np.bincount(np.where(codes < 0, slots - 1, codes), minlength=slots)
+
+
+class DanaRequestHandler(BaseHTTPRequestHandler):
+    """Answers the analysis requests from the server data. Connections
+    are kept alive, so clients can send several requests on the same
+    connection.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "DANA"
+
+    def setup(self) -> None:
+        # headers and body are sent separately, do not delay the body
+        # (TCP connections only, Unix socket clients have no address)
+        self.disable_nagle_algorithm = isinstance(self.client_address, tuple)
+        super().setup()
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        data = self.server.dana_data
+        try:
+            if url.path == "/":
+                self._send_json(200, data.info())
+            elif url.path == "/introduce":
+                records, unknown = data.introduce(query_list(query, "pid"))
+                if not records:
+                    body = {"error": "Unknown patient IDs", "unknown": unknown}
+                    self._send_json(404, body)
+                elif query_value(query, "format") == "text":
+                    cards = "".join(
+                        PATIENT_CARD.format(*record.values()) + "\n"
+                        for record in records
+                    )
+                    self._send(200, cards.encode(), "text/plain; charset=utf-8")
+                else:
+                    self._send_json(200, {"patients": records, "unknown": unknown})
+            elif url.path == "/statistics":
+                self._send_json(200, data.statistics(query_value(query, "column")))
+            elif url.path == "/similar":
+                k = query_value(query, "k")
+                if k is not None and not k.isdigit():
+                    raise QueryError(f"Forbidden number of similar patients ({k})")
+                k = SIMILAR_PATIENTS if k is None else int(k)
+                result = data.similar(query_list(query, "pid"), k)
+                status = 200 if result["similar"] else 404
+                self._send_json(status, result)
+            elif url.path == "/cohort":
+                by = query_value(query, "by")
+                filters = {col: values for col, values in query.items() if col != "by"}
+                self._send_json(200, data.cohort(filters, by))
+            else:
+                self._send_json(404, {"error": f"Unknown request ({url.path})"})
+        except QueryError as e:
+            self._send_json(400, {"error": str(e)})
+
+    def _send_json(self, status: int, body: Dict) -> None:
+        self._send(status, json.dumps(body, default=str).encode(), "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return "unix"
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    """HTTP server listening on a Unix socket, one thread per connection."""
+
+    daemon_threads = True
+
+
+def query_list(query: Dict[str, List[str]], name: str) -> List[str]:
+    # repeated and comma separated values
+    return [
+        value for values in query.get(name, []) for value in values.split(",") if value
+    ]
+
+
+def query_value(query: Dict[str, List[str]], name: str) -> str:
+    values = query.get(name)
+    if values is None:
+        return None
+    if len(values) > 1:
+        raise QueryError(f"Parameter given more than once ({name})")
+    return values[0]
+
+
+def dana_serve(commandline_args: Namespace, verbose: bool, debug: bool) -> None:
+    from dataset_analyzer import csv_reader
+    from csv_input import open_csv_input
+
+    check_type(Namespace, commandline_args, debug)
+    dataset = commandline_args.dataset
+    socket_file = getattr(commandline_args, "socket", None)
+    # only a socket left by a previous server is replaced
+    if socket_file is not None and os.path.exists(socket_file):
+        if not stat.S_ISSOCK(os.stat(socket_file).st_mode):
+            errmsg = f"{socket_file} exists and is not a socket"
+            exception_handler(FileExistsError, errmsg, debug)
+    csv_input = getattr(commandline_args, "csv_input", None)
+    if csv_input is None:
+        csv_input = open_csv_input(dataset, commandline_args.separator, debug)
+    start = time.time()
+    df = csv_reader(
+        csv_input,
+        commandline_args.separator,
+        debug,
+        getattr(commandline_args, "cache_dir", None),
+        getattr(commandline_args, "categorical", False),
+    )
+    csv_input.close()
+    data = ServerData(dataset, df, debug, verbose)
+    del df  # requests are answered from the server data only
+    try:
+        if socket_file is not None:
+            if os.path.exists(socket_file):
+                os.remove(socket_file)
+            server = ThreadingUnixHTTPServer(socket_file, DanaRequestHandler)
+            address = f"unix:{socket_file}"
+        else:
+            host, port = commandline_args.host, commandline_args.port
+            server = ThreadingHTTPServer((host, port), DanaRequestHandler)
+            server.daemon_threads = True
+            address = f"http://{host}:{server.server_address[1]}"
+    except OSError as e:
+        errmsg = f"Unable to start the DANA server ({e})"
+        exception_handler(e.__class__, errmsg, debug)
+    server.dana_data = data
+    server.verbose = verbose
+    # serve_forever() runs in this thread, shutdown() must be called from another
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start(),
+    )
+    print(f"{dataset} loaded in {time.time() - start:.2f}s, serving on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down the DANA server")
+    finally:
+        server.server_close()
+        if socket_file is not None and os.path.exists(socket_file):
+            os.remove(socket_file)
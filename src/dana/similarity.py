@@ -0,0 +1,386 @@
+"""Persistent index of similar patients.
+Each patient is stored as its one-hot profile (one bit per column
+category, no bit for missing values), packed in 64-bit words. The
+Hamming distance between two packed profiles is the squared Euclidean
+distance between the one-hot encoded patients, and it is computed with
+XOR and popcount over the words, for all the indexed patients at once.
+Queries never compare patients pairwise, so the index grows linearly
+with the number of patients.
+
+Words are stored word-major (one contiguous array of all the patients
+per word) in the cache directory, and memory-mapped by later runs on the
+same dataset.
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type, print_warning, PATID_START
+from csv_input import CsvInput
+
+from typing import Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+import hashlib
+import json
+import os
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+SIMILARITY_FORMAT_VERSION = 1  # bump when the index layout changes
+SIMILAR_PATIENTS = 10  # nearest patients returned by default
+SIMILARITY_BLOCK_SIZE = 1 << 16  # patients packed or compared at a time
+QUERY_BATCH_SIZE = 16  # query profiles compared at a time
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], np.uint8)
+
+
+def popcount(words: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Set bits of each 64-bit word. np.bitwise_count is only available
+    from NumPy 2.0, older versions sum the set bits of each byte from a
+    lookup table.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words, out=out)
+    counts = POPCOUNT_TABLE[words.view(np.uint8)]
+    return counts.reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8, out=out)
+
+
+class SimilarityIndex:
+    """Bit-packed one-hot profiles of the patients of a dataset.
+
+    ...
+
+    Attributes
+    ----------
+    columns : List[str]
+        Indexed dataset columns.
+    categories : List[List[str]]
+        Categories of each column, as read from the dataset.
+    words : numpy.ndarray
+        Packed profiles, words x patients.
+
+    Methods
+    -------
+    build(chunks)
+        Index the patients of a dataset, read by chunks.
+    rows(pids)
+        Index rows of the given patient IDs.
+    encode(dataset)
+        Packed profiles of query rows.
+    mask(columns)
+        Bits of the given columns.
+    distances(query, mask)
+        Hamming distances between query profiles and all the patients.
+    nearest(query, k, exclude, mask)
+        The k patients nearest to each query profile.
+    """
+
+    def __init__(
+        self, columns: List[str], categories: List[List[str]], words: np.ndarray
+    ) -> None:
+        check_type(list, columns)
+        check_type(list, categories)
+        check_type(np.ndarray, words)
+        if len(columns) != len(categories):
+            errmsg = "Mismatching columns and categories"
+            exception_handler(ValueError, errmsg, False)
+        if words.ndim != 2 or words.shape[0] != profile_words(categories):
+            errmsg = "Mismatching categories and packed profiles"
+            exception_handler(ValueError, errmsg, False)
+        self._columns = columns
+        self._categories = categories
+        self._words = words
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {len(self)} patients>"
+
+    def __len__(self) -> int:
+        return self._words.shape[1]
+
+    @classmethod
+    def build(cls, chunks: Iterable[pd.DataFrame]) -> "SimilarityIndex":
+        """Index the patients of the dataset chunks, in order. Values not
+        seen yet extend the column categories, so the chunks are encoded
+        as they are read and packed once all the categories are known.
+        """
+        import pandas as pd
+
+        columns, categories, codes = None, None, []
+        for chunk in chunks:
+            if columns is None:
+                columns = chunk.columns.tolist()
+                categories = [[] for _ in columns]
+            chunk_codes = np.empty(chunk.shape, dtype=np.int32)
+            for j, col in enumerate(columns):
+                values = chunk[col].dropna().astype(str)
+                known = pd.Index(categories[j], dtype=object)
+                categories[j].extend(
+                    sorted(pd.Index(values.unique()).difference(known).tolist())
+                )
+                chunk_codes[:, j] = -1  # missing values set no bit
+                positions = np.flatnonzero(chunk[col].notna().to_numpy())
+                chunk_codes[positions, j] = pd.Index(
+                    categories[j], dtype=object
+                ).get_indexer(values)
+            codes.append(chunk_codes)
+        if columns is None:
+            errmsg = "Empty dataset; unable to index patients"
+            exception_handler(ValueError, errmsg, False)
+        codes = np.concatenate(codes)
+        nwords, offsets = profile_words(categories), bit_offsets(categories)
+        words = np.empty((nwords, codes.shape[0]), dtype=np.uint64)
+        for start in range(0, codes.shape[0], SIMILARITY_BLOCK_SIZE):
+            stop = start + SIMILARITY_BLOCK_SIZE
+            words[:, start:stop] = pack_profiles(codes[start:stop], offsets, nwords).T
+        return cls(columns, categories, words)
+
+    def _get_columns(self) -> List[str]:
+        """(PRIVATE)"""
+        return self._columns
+
+    @property
+    def columns(self) -> List[str]:
+        return self._get_columns()
+
+    def _get_categories(self) -> List[List[str]]:
+        """(PRIVATE)"""
+        return self._categories
+
+    @property
+    def categories(self) -> List[List[str]]:
+        return self._get_categories()
+
+    def _get_words(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._words
+
+    @property
+    def words(self) -> np.ndarray:
+        return self._get_words()
+
+    def rows(self, pids: np.ndarray) -> np.ndarray:
+        """Return the index rows of the patient IDs (-1 for unknown IDs)."""
+        rows = np.asarray(pids, dtype=np.int64) - PATID_START
+        return np.where((rows >= 0) & (rows < len(self)), rows, -1)
+
+    def profiles(self, rows: np.ndarray) -> np.ndarray:
+        """Packed profiles of the indexed patients at the given rows, as
+        rows x words.
+        """
+        return np.ascontiguousarray(self._words[:, rows].T)
+
+    def encode(self, dataset: pd.DataFrame, debug: bool = False) -> np.ndarray:
+        """Packed profiles of the dataset rows, as rows x words. Values
+        not in the index and columns not given set no bit (compare only
+        the given columns with their mask).
+        """
+        import pandas as pd
+
+        check_type(pd.DataFrame, dataset, debug)
+        unknown = [col for col in dataset.columns if col not in self._columns]
+        if unknown:
+            errmsg = f"Unknown query columns ({', '.join(unknown)})"
+            exception_handler(ValueError, errmsg, debug)
+        codes = np.full((dataset.shape[0], len(self._columns)), -1, dtype=np.int32)
+        for j, col in enumerate(self._columns):
+            if col in dataset.columns:
+                present = dataset[col].notna().to_numpy()
+                values = dataset[col][present].astype(str)
+                codes[present, j] = pd.Index(
+                    self._categories[j], dtype=object
+                ).get_indexer(values)
+        return pack_profiles(
+            codes, bit_offsets(self._categories), self._words.shape[0]
+        )
+
+    def mask(self, columns: List[str]) -> np.ndarray:
+        """Words with the bits of the given columns set."""
+        check_type(list, columns)
+        offsets = bit_offsets(self._categories)
+        bits = np.zeros(self._words.shape[0] * 64, dtype=bool)
+        for col in columns:
+            j = self._columns.index(col)
+            bits[offsets[j] : offsets[j] + len(self._categories[j])] = True
+        return np.packbits(bits, bitorder="little").view(np.uint64)
+
+    def distances(
+        self, query: np.ndarray, mask: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Hamming distances between the query profiles (rows x words) and
+        every indexed patient, as queries x patients. Only the bits set in
+        mask are compared, when given.
+        """
+        check_type(np.ndarray, query)
+        if query.ndim != 2 or query.shape[1] != self._words.shape[0]:
+            errmsg = "Mismatching query and indexed profiles"
+            exception_handler(ValueError, errmsg, False)
+        # at most 64 bits per word, summed over the words (plus one, for
+        # excluded patients)
+        dtype = np.uint16 if 64 * query.shape[1] < np.iinfo(np.uint16).max else np.uint32
+        distances = np.zeros((query.shape[0], len(self)), dtype=dtype)
+        xor = np.empty((query.shape[0], SIMILARITY_BLOCK_SIZE), dtype=np.uint64)
+        bits = np.empty(xor.shape, dtype=np.uint8)  # buffers reused by each block
+        for start in range(0, len(self), SIMILARITY_BLOCK_SIZE):
+            stop = min(start + SIMILARITY_BLOCK_SIZE, len(self))
+            size = stop - start
+            for w in range(query.shape[1]):
+                np.bitwise_xor(
+                    query[:, w, None], self._words[w, None, start:stop], out=xor[:, :size]
+                )
+                if mask is not None:
+                    np.bitwise_and(xor[:, :size], mask[w], out=xor[:, :size])
+                popcount(xor[:, :size], out=bits[:, :size])
+                distances[:, start:stop] += bits[:, :size]
+        return distances
+
+    def nearest(
+        self,
+        query: np.ndarray,
+        k: int = SIMILAR_PATIENTS,
+        exclude: Optional[np.ndarray] = None,
+        mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows and Hamming distances of the k patients nearest to each
+        query profile, nearest first (ties by row). The exclude rows (one
+        per query, -1 for none) are never returned, e.g. the queried
+        patients themselves.
+        """
+        check_type(int, k)
+        if k < 1:
+            errmsg = f"Forbidden number of similar patients ({k})"
+            exception_handler(ValueError, errmsg, False)
+        nquery = query.shape[0]
+        k = min(k, len(self) - (exclude is not None))
+        rows = np.empty((nquery, max(k, 0)), dtype=np.int64)
+        distances = np.empty((nquery, max(k, 0)), dtype=np.int64)
+        if k <= 0:
+            return rows, distances
+        for start in range(0, nquery, QUERY_BATCH_SIZE):
+            stop = min(start + QUERY_BATCH_SIZE, nquery)
+            batch = self.distances(query[start:stop], mask)
+            if exclude is not None:
+                excluded = np.flatnonzero(exclude[start:stop] >= 0)
+                # farther than any patient (at most one bit per category)
+                batch[excluded, exclude[start:stop][excluded]] = 64 * query.shape[1] + 1
+            for i in range(stop - start):
+                # distances are small integers: the k-th smallest one is
+                # found on their histogram, without sorting the patients
+                histogram = np.bincount(batch[i])
+                threshold = np.searchsorted(np.cumsum(histogram), k)
+                candidates = np.flatnonzero(batch[i] <= threshold)
+                order = np.argsort(batch[i][candidates], kind="stable")[:k]
+                rows[start + i] = candidates[order]
+                distances[start + i] = batch[i][candidates[order]]
+        return rows, distances
+
+
+def bit_offsets(categories: List[List[str]]) -> np.ndarray:
+    # first bit of each column
+    return np.concatenate(([0], np.cumsum([len(c) for c in categories])[:-1])).astype(
+        np.int64
+    )
+
+
+def profile_words(categories: List[List[str]]) -> int:
+    # 64-bit words holding one bit per category
+    return max(1, -(-sum(len(c) for c in categories) // 64))
+
+
+def pack_profiles(codes: np.ndarray, offsets: np.ndarray, nwords: int) -> np.ndarray:
+    """Pack the one-hot profiles of the rows of category codes (-1 for
+    missing values) in nwords 64-bit words, as rows x words.
+    """
+    bits = np.zeros((codes.shape[0], nwords * 64), dtype=bool)
+    rows, cols = np.nonzero(codes >= 0)
+    bits[rows, offsets[cols] + codes[rows, cols]] = True
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    return packed.view(np.uint64).reshape(codes.shape[0], nwords)
+
+
+def similarity_files(cache_dir: str, csv_file: str) -> tuple:
+    # one index per dataset path
+    name = hashlib.sha256(os.path.abspath(csv_file).encode()).hexdigest()
+    name = os.path.join(cache_dir, f"{name}.similarity")
+    return f"{name}.npy", f"{name}.json"
+
+
+def load_similarity_index(
+    csv_input: CsvInput,
+    separator: str,
+    cache_dir: Optional[str],
+    max_memory: Optional[int] = None,
+    debug: bool = False,
+    verbose: bool = False,
+) -> SimilarityIndex:
+    """Load the dataset similarity index from the cache directory,
+    (re)building it when missing or outdated. Without cache directory,
+    the index is built in memory and not stored. Values are read as raw
+    strings, by chunks of at most max_memory MB when given.
+    """
+    from dataset_analyzer import csv_reader, csv_chunk_reader
+
+    def build_index() -> SimilarityIndex:
+        if verbose:
+            print(f"Building {csv_input.csv_file} similarity index")
+        if max_memory is None:
+            chunks = [csv_reader(csv_input, separator, debug, dtype=str)]
+        else:
+            chunks = csv_chunk_reader(csv_input, separator, max_memory, debug, dtype=str)
+        return SimilarityIndex.build(chunks)
+
+    check_type(CsvInput, csv_input, debug)
+    if cache_dir is None:
+        return build_index()
+    check_type(str, cache_dir, debug)
+    csv_file = csv_input.csv_file
+    stat = os.stat(csv_file)
+    source = {
+        "version": SIMILARITY_FORMAT_VERSION,
+        "separator": separator,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+    words_file, metadata_file = similarity_files(cache_dir, csv_file)
+    try:
+        with open(metadata_file, mode="r") as infile:
+            metadata = json.load(infile)
+        if metadata["source"] == source:  # dataset unchanged
+            words = np.load(words_file, mmap_mode="r")
+            return SimilarityIndex(metadata["columns"], metadata["categories"], words)
+    except (OSError, ValueError, KeyError):
+        pass  # missing or unreadable index, build it
+    index = build_index()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(words_file, index.words)
+        with open(metadata_file, mode="w") as outfile:
+            json.dump(
+                {
+                    "source": source,
+                    "columns": index.columns,
+                    "categories": index.categories,
+                },
+                outfile,
+            )
+    except OSError as e:
+        print_warning(f"Unable to store {csv_file} similarity index in {cache_dir} ({e})")
+    return index
+
+
+def read_query_rows(query_file: str, separator: str, debug: bool = False) -> pd.DataFrame:
+    """Read the query patients, as raw strings. Query files hold some or
+    all of the dataset columns.
+    """
+    import pandas as pd
+
+    check_type(str, query_file, debug)
+    try:
+        rows = pd.read_csv(query_file, sep=separator, dtype=str)
+    except (OSError, ValueError) as e:
+        errmsg = f"An error occurred while reading the query patients in {query_file}"
+        exception_handler(e.__class__, errmsg, debug)
+    if rows.empty:
+        errmsg = f"No query patient found in {query_file}"
+        exception_handler(ValueError, errmsg, debug)
+    return rows
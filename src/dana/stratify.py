@@ -0,0 +1,214 @@
+"""Stratified counts of arbitrary column combinations.
+The values of each column are encoded as category codes, the codes of
+the stratifying columns are combined in a single mixed-radix code, and
+one bincount pass over the combined codes returns the joint counts
+tensor. Marginals and percentages are derived from the tensor, without
+reading the dataset again.
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type
+from categorical import category_codes
+
+from typing import List, Optional, Sequence
+
+import pandas as pd
+import numpy as np
+
+
+MISSING_LABEL = "NA"  # label of the missing values slot
+
+
+def mixed_radix_codes(codes: Sequence[np.ndarray], radices: Sequence[int]) -> np.ndarray:
+    """Combine the codes of several columns (each in [0, radix)) in a
+    single code, the first column being the most significant digit.
+    """
+    combined = np.zeros(codes[0].shape[0], dtype=np.int64)
+    for col_codes, radix in zip(codes, radices):
+        combined *= radix
+        combined += col_codes
+    return combined
+
+
+def joint_counts(codes: Sequence[np.ndarray], shape: Sequence[int]) -> np.ndarray:
+    """Joint counts tensor of the columns codes, with one bincount pass."""
+    if len(codes) != len(shape) or not codes:
+        errmsg = "Mismatching column codes and counts shape"
+        exception_handler(ValueError, errmsg, False)
+    combined = mixed_radix_codes(codes, shape)
+    return np.bincount(combined, minlength=int(np.prod(shape))).reshape(shape)
+
+
+class StratifiedCounts:
+    """Joint counts of the values of some dataset columns. Each axis has
+    a trailing slot counting the missing values.
+
+    ...
+
+    Attributes
+    ----------
+    columns : List[str]
+        Stratifying columns.
+    labels : List[List]
+        Values of each column (missing values slot excluded).
+    counts : numpy.ndarray
+        Joint counts tensor, one axis per column.
+    total : int
+        Number of counted rows.
+
+    Methods
+    -------
+    from_dataframe(dataset, columns, debug)
+        Count the rows of a dataset.
+    update(dataset, debug)
+        Add the rows of a dataset (chunk) to the counts.
+    marginal(columns)
+        Counts of a subset of the columns.
+    percentages(within)
+        Percentages of the counts, of all rows or within strata.
+    to_frame(within, dropna)
+        Non-empty strata as a table, with counts and percentages.
+    """
+
+    def __init__(
+        self, columns: List[str], labels: List[List], counts: np.ndarray
+    ) -> None:
+        check_type(list, columns)
+        check_type(list, labels)
+        check_type(np.ndarray, counts)
+        if not columns or len(set(columns)) != len(columns):
+            errmsg = f"Forbidden stratifying columns ({', '.join(columns)})"
+            exception_handler(ValueError, errmsg, False)
+        if counts.shape != tuple(len(col_labels) + 1 for col_labels in labels):
+            errmsg = "Mismatching labels and counts shape"
+            exception_handler(ValueError, errmsg, False)
+        self._columns = columns
+        self._labels = labels
+        self._counts = counts
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} object: {' x '.join(self._columns)}, {self.total} rows>"
+
+    @classmethod
+    def empty(cls, columns: List[str]) -> "StratifiedCounts":
+        return cls(columns, [[] for _ in columns], np.zeros([1] * len(columns), dtype=np.int64))
+
+    @classmethod
+    def from_dataframe(
+        cls, dataset: pd.DataFrame, columns: List[str], debug: bool = False
+    ) -> "StratifiedCounts":
+        counts = cls.empty(columns)
+        counts.update(dataset, debug)
+        return counts
+
+    def _get_columns(self) -> List[str]:
+        """(PRIVATE)"""
+        return self._columns
+
+    @property
+    def columns(self) -> List[str]:
+        return self._get_columns()
+
+    def _get_labels(self) -> List[List]:
+        """(PRIVATE)"""
+        return self._labels
+
+    @property
+    def labels(self) -> List[List]:
+        return self._get_labels()
+
+    def _get_counts(self) -> np.ndarray:
+        """(PRIVATE)"""
+        return self._counts
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._get_counts()
+
+    def _get_total(self) -> int:
+        """(PRIVATE)"""
+        return int(self._counts.sum())
+
+    @property
+    def total(self) -> int:
+        return self._get_total()
+
+    def update(self, dataset: pd.DataFrame, debug: bool = False) -> None:
+        check_type(pd.DataFrame, dataset, debug)
+        missing = [col for col in self._columns if col not in dataset.columns]
+        if missing:
+            errmsg = f"Missing columns: {', '.join(missing)}"
+            exception_handler(KeyError, errmsg, debug)
+        codes = []
+        for axis, col in enumerate(self._columns):
+            column = dataset[col]
+            labels = self._labels[axis]
+            # values not seen yet extend the axis, before the missing slot
+            unseen = pd.Index(column.dropna().unique()).difference(pd.Index(labels))
+            if len(unseen):
+                self._counts = np.insert(
+                    self._counts, [len(labels)] * len(unseen), 0, axis=axis
+                )
+                labels.extend(unseen.tolist())
+            col_codes, _ = category_codes(column, labels)
+            codes.append(np.where(col_codes < 0, len(labels), col_codes))
+        self._counts += joint_counts(codes, self._counts.shape)
+
+    def _axes(self, columns: List[str]) -> List[int]:
+        """(PRIVATE) Axes of the given columns."""
+        unknown = [col for col in columns if col not in self._columns]
+        if unknown:
+            errmsg = f"Unknown stratifying columns: {', '.join(unknown)}"
+            exception_handler(ValueError, errmsg, False)
+        return [self._columns.index(col) for col in columns]
+
+    def marginal(self, columns: List[str]) -> "StratifiedCounts":
+        check_type(list, columns)
+        axes = self._axes(columns)
+        others = tuple(axis for axis in range(len(self._columns)) if axis not in axes)
+        counts = self._counts.sum(axis=others)
+        # summed axes are removed in order, sort the remaining ones as given
+        counts = np.moveaxis(counts, np.argsort(np.argsort(axes)), range(len(axes)))
+        return StratifiedCounts(
+            list(columns), [list(self._labels[axis]) for axis in axes], counts
+        )
+
+    def percentages(self, within: Optional[List[str]] = None) -> np.ndarray:
+        """Percentages of the counts on all the rows or, when within
+        columns are given, on the rows of each stratum of those columns.
+        """
+        if not within:
+            totals = self._counts.sum()
+        else:
+            axes = self._axes(within)
+            others = tuple(a for a in range(len(self._columns)) if a not in axes)
+            totals = self._counts.sum(axis=others, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(totals > 0, 100 * self._counts / totals, 0.0)
+
+    def to_frame(
+        self, within: Optional[List[str]] = None, dropna: bool = False
+    ) -> pd.DataFrame:
+        """Non-empty strata, one row each, with their counts and
+        percentages (of all rows or within strata).
+        """
+        percentages = self.percentages(within)
+        counts = self._counts
+        if dropna:  # drop the missing values slots
+            strata = tuple(slice(0, len(labels)) for labels in self._labels)
+            counts, percentages = counts[strata], percentages[strata]
+        cells = np.nonzero(counts)
+        table = {}
+        for col, labels, index in zip(self._columns, self._labels, cells):
+            table[col] = np.asarray(labels + [MISSING_LABEL], dtype=object)[index]
+        table["count"] = counts[cells]
+        table["percent"] = np.round(percentages[cells], 2)
+        return pd.DataFrame(table)
+
+
+def stratify(
+    dataset: pd.DataFrame, columns: List[str], debug: bool = False
+) -> StratifiedCounts:
+    check_type(pd.DataFrame, dataset, debug)
+    check_type(list, columns, debug)
+    return StratifiedCounts.from_dataframe(dataset, columns, debug)
@@ -0,0 +1,172 @@
+"""Summary statistics report writers.
+The xlsx report is written directly with xlsxwriter in constant memory
+mode: rows are streamed to the file as they are written, and cells are
+formatted while written, with one format per variable type. Machine
+readable reports (CSV, JSON, Parquet) hold one record per dataset
+column. Parquet reports require pyarrow.
+"""
+from __future__ import annotations
+
+from utils import exception_handler, check_type
+
+from typing import Dict, List, TYPE_CHECKING
+
+import math
+import json
+import csv
+import os
+
+if TYPE_CHECKING:
+    from dataset_profile import DatasetProfile
+
+
+REPORT_FORMATS = ["xlsx", "csv", "json", "parquet"]
+REPORT_NAME = "summary"  # report file name, without extension
+REPORT_STATISTICS = [
+    "var_type",
+    "values_number",
+    "most_frequent_value",
+    "less_frequent_value",
+]
+TYPE_COLORS = {"categorical": "#68AB25", "numerical": "#9F25AB"}
+
+
+def _plain(value: object) -> object:
+    """(PRIVATE) Convert numpy scalars to Python values, missing values
+    to None (blank cells).
+    """
+    value = value.item() if hasattr(value, "item") else value
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def summary_records(profile: DatasetProfile) -> List[Dict]:
+    """Summary statistics of each dataset column, one record per column."""
+    records = []
+    for col, stats in profile.to_count_stats().items():
+        records.append(
+            {
+                "column": col,
+                "var_type": stats["type"],
+                "values_number": _plain(stats["values_num"]),
+                "most_frequent_value": _plain(stats["most_freq"]),
+                "less_frequent_value": _plain(stats["less_freq"]),
+            }
+        )
+    return records
+
+
+def _type_runs(types: List[str]) -> List[tuple]:
+    """(PRIVATE) Split the columns in runs of consecutive columns sharing
+    the same type, as (first, stop, type) tuples.
+    """
+    runs, first = [], 0
+    for i in range(1, len(types) + 1):
+        if i == len(types) or types[i] != types[first]:
+            runs.append((first, i, types[first]))
+            first = i
+    return runs
+
+
+def write_xlsx_report(records: List[Dict], outfile: str) -> None:
+    """Write the summary as a statistics x columns sheet, each column
+    colored by variable type.
+    """
+    from xlsxwriter.exceptions import FileCreateError
+    from xlsxwriter.workbook import Workbook
+
+    workbook = Workbook(outfile, {"constant_memory": True})
+    worksheet = workbook.add_worksheet("Sheet1")
+    header = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+    formats = {
+        var_type: workbook.add_format({"bg_color": color})
+        for var_type, color in TYPE_COLORS.items()
+    }
+    runs = _type_runs([record["var_type"] for record in records])
+    # constant memory mode requires rows to be written in order
+    worksheet.write_row(0, 1, [record["column"] for record in records], header)
+    for row, statistic in enumerate(REPORT_STATISTICS, start=1):
+        worksheet.write(row, 0, statistic, header)
+        values = [record[statistic] for record in records]
+        for first, stop, var_type in runs:
+            worksheet.write_row(
+                row, first + 1, values[first:stop], formats.get(var_type)
+            )
+    try:
+        workbook.close()
+    except FileCreateError as e:  # reported as the other writers errors
+        raise OSError(str(e)) from e
+
+
+def write_csv_report(records: List[Dict], outfile: str) -> None:
+    with open(outfile, mode="w", newline="") as outstream:
+        writer = csv.DictWriter(outstream, fieldnames=["column"] + REPORT_STATISTICS)
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def write_json_report(records: List[Dict], outfile: str) -> None:
+    with open(outfile, mode="w") as outstream:
+        json.dump(records, outstream, indent=2, default=str)
+        outstream.write("\n")
+
+
+def write_parquet_report(records: List[Dict], outfile: str, debug: bool) -> None:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        errmsg = 'Parquet reports require pyarrow (run "pip install pyarrow")'
+        exception_handler(ImportError, errmsg, debug)
+    # most and less frequent values mix types across columns
+    table = pa.table(
+        {
+            "column": [record["column"] for record in records],
+            "var_type": [record["var_type"] for record in records],
+            "values_number": [record["values_number"] for record in records],
+            "most_frequent_value": [
+                str(record["most_frequent_value"]) for record in records
+            ],
+            "less_frequent_value": [
+                str(record["less_frequent_value"]) for record in records
+            ],
+        }
+    )
+    pq.write_table(table, outfile)
+
+
+def write_summary_report(
+    profile: DatasetProfile,
+    outdir: str,
+    report_format: str = "xlsx",
+    debug: bool = False,
+    verbose: bool = False,
+) -> str:
+    """Write the summary statistics report in outdir and return its path."""
+    from dataset_profile import DatasetProfile
+
+    check_type(DatasetProfile, profile, debug)
+    check_type(str, outdir, debug)
+    check_type(str, report_format, debug)
+    if report_format not in REPORT_FORMATS:
+        errmsg = f"Unknown report format ({report_format})"
+        exception_handler(ValueError, errmsg, debug)
+    records = summary_records(profile)
+    if not records:
+        errmsg = "Empty dataset profile; unable to write statistics"
+        exception_handler(ValueError, errmsg, debug)
+    outfile = os.path.join(outdir, f"{REPORT_NAME}.{report_format}")
+    try:
+        if report_format == "xlsx":
+            write_xlsx_report(records, outfile)
+        elif report_format == "csv":
+            write_csv_report(records, outfile)
+        elif report_format == "json":
+            write_json_report(records, outfile)
+        else:
+            write_parquet_report(records, outfile, debug)
+    except OSError as e:
+        errmsg = f"An error occurred while writing the summary report {outfile}"
+        exception_handler(e.__class__, errmsg, debug)
+    if verbose:
+        print(f"Summary statistics written to {outfile}")
+    return outfile
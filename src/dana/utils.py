@@ -3,15 +3,15 @@
 from typing import Callable, Generic, TypeVar
 from colorama import Fore
 
-import pandas as pd
-
-import csv
 import sys
 import os
 
 
 DEFAULT_SEPARATOR = ","
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dana")
 PATID_START = 1000000
+DEFAULT_HOST = "127.0.0.1"  # address of the DANA server
+DEFAULT_PORT = 8000
 T = TypeVar("T")  # generic template type
 
 
@@ -29,6 +29,14 @@ def exception_handler(
     sys.exit(1)
 
 
+def print_warning(warnmsg: str) -> None:
+    """Print a warning message to stderr, without interrupting the
+    analysis.
+    """
+    assert isinstance(warnmsg, str)
+    sys.stderr.write(Fore.YELLOW + f"WARNING: {warnmsg}\n" + Fore.RESET)
+
+
 def check_type(var_type: Generic[T], variable: Generic[T], debug: bool = False) -> None:
     if not isinstance(variable, var_type):
         errmsg = f"Expected {var_type.__name__}, got {type(variable).__name__}"
@@ -37,27 +45,11 @@ def check_type(var_type: Generic[T], variable: Generic[T], debug: bool = False)
 
 
 def is_csv(csvfile: str, separator: str, debug: bool = False) -> bool:
-    check_type(str, csvfile, debug)
-    check_type(str, separator)
-    if not os.path.isfile(csvfile):
-        errmsg = f"Unable to locate {csvfile}"
-        exception_handler(FileNotFoundError, errmsg, debug)
-    print(separator)
-    if separator != DEFAULT_SEPARATOR:
-        if pd.read_csv(csvfile, sep=separator).shape[1] <= 1:
-            return False
-        return True
-    else:  # separator == DEFAULT_SEPARATOR
-        try:
-            handle = open(csvfile, mode="rb")
-            # Perform various checks on the dialect (e.g., lineseparator,
-            # delimiter) to make sure it's sane
-            # (see https://stackoverflow.com/questions/2984888/check-if-file-has-a-csv-format-with-python)
-            dialect = csv.Sniffer().sniff(handle.read(1024))
-            handle.seek(0)  # reset file pointer
-        except:
-            return False  # not CSV
-        finally:
-            handle.close()
-        return True  # CSV parsing went fine
-    return False  # should not be reached
+    from csv_input import CsvInput
+
+    # dialect and header checks are shared with the loaders (see CsvInput)
+    csv_input = CsvInput.open(csvfile, separator, debug)
+    if csv_input is None:
+        return False  # not CSV
+    csv_input.close()
+    return True